@@ -1 +1,3 @@
 __version__ = '2.21.1'
+
+default_app_config = 'gn_django.apps.GNDjangoConfig'
@@ -0,0 +1,53 @@
+import logging
+
+from django.apps import AppConfig
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+class GNDjangoConfig(AppConfig):
+    """
+    App config for gn django.  When the app is ready, the ``SITE_DOMAINS`` host
+    patterns are compiled in to a ``gn_django.site.resolver.SiteResolver``.
+
+    If the ``TEMPLATE_WARMUP`` setting is ``True``, every template for every
+    site is loaded in to the jinja template caches when the app is ready, so
+    that the first requests after a deploy don't have to load templates.  See ``gn_django.template.warmup``.
+
+    If the ``TEMPLATE_WATCHER`` setting is ``True``, template directories are
+    watched for changes so that jinja's ``auto_reload`` can be disabled.  See
+    ``gn_django.template.watcher``.
+    """
+
+    name = 'gn_django'
+    verbose_name = 'GN Django'
+
+    def ready(self):
+        from gn_django.site.resolver import get_site_resolver
+
+        # Compile the host patterns in SITE_DOMAINS up front
+        get_site_resolver()
+        if getattr(settings, 'TEMPLATE_WARMUP', False):
+            self.warm_templates()
+        if getattr(settings, 'TEMPLATE_WATCHER', False):
+            self.start_template_watcher()
+
+    def warm_templates(self):
+        from gn_django.template.warmup import warm_all_templates
+
+        report = warm_all_templates(
+            workers=getattr(settings, 'TEMPLATE_WARMUP_WORKERS', 4),
+            budget=getattr(settings, 'TEMPLATE_WARMUP_BUDGET', 10),
+        )
+        logger.info("Loaded %d templates in %.2fs", len(report.loaded), report.elapsed)
+        if report.skipped:
+            logger.warning("Skipped loading %d templates when the time budget ran out", report.skipped)
+        for site, template, error in report.failures:
+            logger.warning("Could not load template '%s' for %s: %s", template, site, error)
+
+    def start_template_watcher(self):
+        from gn_django.template.watcher import TemplateWatcher
+
+        self.template_watcher = TemplateWatcher()
+        self.template_watcher.start()
+        logger.info("Watching %d template directories for changes", len(self.template_watcher.directories))
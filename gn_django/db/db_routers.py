@@ -1,4 +1,22 @@
+from collections import namedtuple, Counter
+from contextvars import ContextVar
+from itertools import count
+from threading import Lock, Thread
+import logging
+import random
+import time
+
+from django.core.signals import request_started, request_finished
+from django.db import connections
+from django.utils.module_loading import import_string
+
 from gn_django.exceptions import ImproperlyConfigured
+from gn_django.site import get_current_site
+
+logger = logging.getLogger(__name__)
+
+# The primary databases written to in the current request
+_sticky_databases = ContextVar('gn_django_sticky_databases', default=frozenset())
 
 class AppsRouter:
     """
@@ -56,3 +74,398 @@ class AppsRouter:
             return db == self.DB_NAME
         return None
 
+def get_sticky_databases():
+    """
+    Get the primary databases which have been written to in the current
+    request, which routers send reads to for the rest of the request.
+    """
+    return _sticky_databases.get()
+
+def add_sticky_database(db):
+    """
+    Send reads for a primary database to the primary for the rest of the
+    current request.
+
+    Args:
+      * `db` - string - the primary database name
+    """
+    databases = _sticky_databases.get()
+    if db not in databases:
+        _sticky_databases.set(databases | {db})
+
+def clear_sticky_databases(**kwargs):
+    """
+    Forget which primary databases have been written to.  Called at the start
+    and end of each request, and can be called by background tasks between
+    units of work.
+    """
+    _sticky_databases.set(frozenset())
+
+request_started.connect(clear_sticky_databases)
+request_finished.connect(clear_sticky_databases)
+
+Shard = namedtuple('Shard', ('primary', 'replicas', 'weights', 'counter'))
+
+class SiteShardedRouter(AppsRouter):
+    """
+    A router which routes DB operations for one or more django apps to a
+    database shard chosen by the current site, and spreads reads across each
+    shard's read replicas.  Writes go to the shard's primary database, and
+    once a request has written to a primary, its reads go to that primary for
+    the rest of the request so that they see their own writes.
+
+    Requires class attributes to be specified:
+      - `APPS` - an iterable of django app labels
+      - `DB_NAME` - a string for the primary DB to route operations to when
+        the current site has no shard
+
+    Optional class attributes:
+      - `REPLICAS` - the read replicas of `DB_NAME` - either an iterable of DB
+        names, or a mapping of DB name to weight
+      - `SITE_DATABASES` - a mapping with keys as sites, or ``(site, app
+        label)`` pairs to shard an app differently, and values as mappings with
+        the keys:
+          - ``'primary'`` - the primary DB name
+          - ``'replicas'`` - optional read replicas, as for `REPLICAS`
+      - `READ_STRATEGY` - how to choose a replica for each read - either
+        ``'round_robin'`` to take each replica in turn, or ``'weighted'`` to
+        choose at random in proportion to the replicas' weights
+    """
+    REPLICAS = ()
+    SITE_DATABASES = {}
+    READ_STRATEGY = 'round_robin'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        if self.READ_STRATEGY not in ('round_robin', 'weighted'):
+            raise ImproperlyConfigured("The `READ_STRATEGY` attribute of the db router '%s' should be 'round_robin' or 'weighted'" % (self.__class__.__name__))
+        self.default_shard = self.build_shard(self.DB_NAME, self.REPLICAS)
+        self.shards = {}
+        for key, databases in self.SITE_DATABASES.items():
+            if not databases.get('primary'):
+                raise ImproperlyConfigured("There was no 'primary' database specified for '%s' in the db router '%s'" % (key, self.__class__.__name__))
+            self.shards[key] = self.build_shard(databases['primary'], databases.get('replicas', ()))
+        self.primaries = frozenset(
+            [self.default_shard.primary] + [shard.primary for shard in self.shards.values()]
+        )
+
+    def build_shard(self, primary, replicas):
+        """
+        Build a shard from a primary DB name and its replicas.
+
+        Args:
+          * `primary` - string - the primary DB name
+          * `replicas` - iterable/mapping - replica DB names, or a mapping of
+            replica DB name to weight
+
+        Returns a ``Shard`` tuple
+        """
+        if not hasattr(replicas, 'items'):
+            replicas = dict((replica, 1) for replica in replicas)
+        names = tuple(sorted(replicas))
+        return Shard(primary, names, tuple(replicas[name] for name in names), count())
+
+    def get_shard(self, app_label):
+        """
+        Get the shard for an app label and the current site.
+
+        Args:
+          * `app_label` - string - the django app label
+        """
+        site = get_current_site()
+        shard = self.shards.get((site, app_label))
+        if shard is None:
+            shard = self.shards.get(site, self.default_shard)
+        return shard
+
+    def choose_replica(self, shard, replicas=None):
+        """
+        Choose a replica of a shard to read from.
+
+        Args:
+          * `shard` - ``Shard`` - the shard
+          * `replicas` - iterable - optional subset of the shard's replicas to
+            choose from
+
+        Returns a DB name, or None if there are no replicas to choose from
+        """
+        if replicas is None:
+            names, weights = shard.replicas, shard.weights
+        else:
+            replicas = set(replicas)
+            chosen = [i for i, name in enumerate(shard.replicas) if name in replicas]
+            names = [shard.replicas[i] for i in chosen]
+            weights = [shard.weights[i] for i in chosen]
+        if not names:
+            return None
+        if self.READ_STRATEGY == 'weighted':
+            return random.choices(names, weights)[0]
+        return names[next(shard.counter) % len(names)]
+
+    def db_for_read(self, model, **hints):
+        """
+        Attempts to read app models go to a replica of the current site's
+        shard, or its primary after the request has written to it.
+        """
+        if model._meta.app_label not in self.APPS:
+            return None
+        shard = self.get_shard(model._meta.app_label)
+        if shard.primary in get_sticky_databases():
+            return shard.primary
+        return self.choose_replica(shard) or shard.primary
+
+    def db_for_write(self, model, **hints):
+        """
+        Attempts to write app models go to the primary of the current site's
+        shard.
+        """
+        if model._meta.app_label not in self.APPS:
+            return None
+        primary = self.get_shard(model._meta.app_label).primary
+        add_sticky_database(primary)
+        return primary
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        """
+        Make sure the apps' DB tables are only created in the primary
+        databases.  Replicas get their tables through replication.
+        """
+        if app_label in self.APPS:
+            return db in self.primaries
+        return None
+
+def get_replication_lag(db):
+    """
+    Get the replication lag of a read replica, by querying the replica.
+    Supports postgresql and mysql replicas; replicas of other databases are
+    assumed to have no lag.
+
+    Args:
+      * `db` - string - the replica DB name
+
+    Returns the lag in seconds, or None if the replica isn't replicating
+    """
+    connection = connections[db]
+    with connection.cursor() as cursor:
+        if connection.vendor == 'postgresql':
+            cursor.execute(
+                "SELECT CASE WHEN pg_is_in_recovery() "
+                "THEN EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) ELSE 0 END"
+            )
+            lag = cursor.fetchone()[0]
+            return float(lag) if lag is not None else None
+        if connection.vendor == 'mysql':
+            cursor.execute("SHOW SLAVE STATUS")
+            row = cursor.fetchone()
+            if row is None:
+                return 0.0
+            columns = [column[0] for column in cursor.description]
+            lag = dict(zip(columns, row)).get('Seconds_Behind_Master')
+            return float(lag) if lag is not None else None
+    return 0.0
+
+class ReplicaAwareRouter(SiteShardedRouter):
+    """
+    A ``SiteShardedRouter`` which only reads from replicas that are healthy
+    and keeping up with their primary.  Each replica is checked with a probe
+    at most once per `PROBE_INTERVAL`; a replica which fails the probe or lags
+    by more than `MAX_REPLICATION_LAG` is dropped until it passes a later
+    probe.  When all of a shard's replicas are dropped, reads fall back to the
+    primary.
+
+    Probes run in background threads, so that a slow or unreachable replica
+    doesn't hold up reads.  Reads use a replica's last known state while it's
+    probed again.  The first probe of a replica is waited for once, for up to
+    `PROBE_TIMEOUT` after it started; the replica isn't read from until that
+    probe passes.
+
+    Routing decisions are counted, and can be read with ``get_counters()`` or
+    for every router in the project with ``get_router_counters()``:
+
+      * ``reads.replica.<db>`` - reads routed to a replica
+      * ``reads.primary`` - reads routed to a primary with no replicas
+      * ``reads.primary_fallback`` - reads routed to a primary because all of
+        its replicas were dropped
+      * ``reads.sticky_primary`` - reads routed to a primary after a write
+      * ``writes.<db>`` - writes routed to a primary
+      * ``replicas.dropped.<db>`` - times a replica was dropped
+
+    Optional class attributes, along with those of ``SiteShardedRouter``:
+      - `PROBE` - a function, or import string of a function, which takes a
+        replica DB name and returns its replication lag in seconds, or None if
+        it isn't replicating.  The probe may raise an exception if the replica
+        is unreachable.  Defaults to ``get_replication_lag``.
+      - `PROBE_INTERVAL` - the number of seconds between probes of a replica
+      - `MAX_REPLICATION_LAG` - the number of seconds a replica may lag
+        before it's dropped
+      - `PROBE_TIMEOUT` - the number of seconds after the first probe of a
+        replica starts that reads wait for it
+    """
+    PROBE = 'gn_django.db.db_routers.get_replication_lag'
+    PROBE_INTERVAL = 5
+    MAX_REPLICATION_LAG = 10
+    PROBE_TIMEOUT = 0.5
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        probe = type(self).PROBE
+        self.probe = import_string(probe) if isinstance(probe, str) else probe
+        # Mapping of replica DB name to (available, time probed)
+        self.replica_states = {}
+        self.counters = Counter()
+        self._counters_lock = Lock()
+        # Mapping of replica DB name to the thread probing it
+        self._probes = {}
+        # Mapping of replica DB name to the time until which reads wait for
+        # its first probe
+        self._first_probe_deadlines = {}
+        self._probes_lock = Lock()
+
+    def count(self, decision):
+        with self._counters_lock:
+            self.counters[decision] += 1
+
+    def get_counters(self):
+        """
+        Get the routing decision counters.
+
+        Returns a mapping of decision to count
+        """
+        with self._counters_lock:
+            return dict(self.counters)
+
+    def probe_replica(self, db):
+        """
+        Probe a replica and record whether it can be read from.
+
+        Args:
+          * `db` - string - the replica DB name
+
+        Returns whether the replica is available
+        """
+        now = time.monotonic()
+        try:
+            lag = self.probe(db)
+        except Exception as e:
+            logger.warning("Could not probe the replica '%s': %s", db, e)
+            lag = None
+        available = lag is not None and lag <= self.MAX_REPLICATION_LAG
+        state = self.replica_states.get(db)
+        if not available and (state is None or state[0]):
+            logger.warning("Dropped the replica '%s' with replication lag %s", db, lag)
+            self.count('replicas.dropped.%s' % db)
+        self.replica_states[db] = (available, now)
+        return available
+
+    def _run_probe(self, db):
+        try:
+            self.probe_replica(db)
+        finally:
+            # Connections opened by the probe belong to this thread
+            connections.close_all()
+            with self._probes_lock:
+                self._probes.pop(db, None)
+                self._first_probe_deadlines.pop(db, None)
+
+    def start_probe(self, db):
+        """
+        Probe a replica in a background thread, unless it's already being
+        probed.
+
+        Args:
+          * `db` - string - the replica DB name
+
+        Returns the thread probing the replica
+        """
+        with self._probes_lock:
+            thread = self._probes.get(db)
+            if thread is None:
+                if db not in self.replica_states:
+                    self._first_probe_deadlines[db] = time.monotonic() + self.PROBE_TIMEOUT
+                thread = self._probes[db] = Thread(
+                    target=self._run_probe, args=(db,), name='gn-django-replica-probe', daemon=True
+                )
+                thread.start()
+        return thread
+
+    def is_probe_due(self, db):
+        """
+        Check whether a replica hasn't been probed within the last
+        `PROBE_INTERVAL`.
+
+        Args:
+          * `db` - string - the replica DB name
+        """
+        state = self.replica_states.get(db)
+        return state is None or time.monotonic() - state[1] >= self.PROBE_INTERVAL
+
+    def is_replica_available(self, db):
+        """
+        Check whether a replica can be read from, starting a probe of it if
+        one is due.  Reads wait for the first probe of a replica until
+        `PROBE_TIMEOUT` after it started, and treat the replica as unavailable
+        while it's pending after that.
+
+        Args:
+          * `db` - string - the replica DB name
+        """
+        state = self.replica_states.get(db)
+        if not self.is_probe_due(db):
+            return state[0]
+        thread = self.start_probe(db)
+        if state is not None:
+            # Keep using the last known state until the probe finishes
+            return state[0]
+        deadline = self._first_probe_deadlines.get(db)
+        if deadline is not None:
+            thread.join(max(0, deadline - time.monotonic()))
+        state = self.replica_states.get(db)
+        return state is not None and state[0]
+
+    def db_for_read(self, model, **hints):
+        """
+        Attempts to read app models go to an available replica of the current
+        site's shard, or its primary after the request has written to it or
+        when no replica is available.
+        """
+        if model._meta.app_label not in self.APPS:
+            return None
+        shard = self.get_shard(model._meta.app_label)
+        if shard.primary in get_sticky_databases():
+            self.count('reads.sticky_primary')
+            return shard.primary
+        if not shard.replicas:
+            self.count('reads.primary')
+            return shard.primary
+        # Start the due probes together, so that first probes share one wait
+        for db in shard.replicas:
+            if self.is_probe_due(db):
+                self.start_probe(db)
+        replica = self.choose_replica(
+            shard, [db for db in shard.replicas if self.is_replica_available(db)]
+        )
+        if replica is None:
+            self.count('reads.primary_fallback')
+            return shard.primary
+        self.count('reads.replica.%s' % replica)
+        return replica
+
+    def db_for_write(self, model, **hints):
+        db = super().db_for_write(model, **hints)
+        if db is not None:
+            self.count('writes.%s' % db)
+        return db
+
+def get_router_counters():
+    """
+    Get the routing decision counters of every router in the project's
+    ``DATABASE_ROUTERS`` setting which counts its decisions.
+
+    Returns a mapping with keys as router class names and values as mappings
+    of decision to count
+    """
+    from django.db import router
+
+    return dict(
+        (r.__class__.__name__, r.get_counters()) for r in router.routers if hasattr(r, 'get_counters')
+    )
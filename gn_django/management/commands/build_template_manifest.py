@@ -0,0 +1,30 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.template import engines
+
+from gn_django.template.loaders import file_system_loaders
+from gn_django.template.manifest import TemplateManifest
+
+class Command(BaseCommand):
+    help = 'Build a manifest of the templates in all hierarchy loader template directories'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '-o', '--output', type=str, dest='output', default=None,
+            help='Path to write the manifest to. Defaults to the TEMPLATE_MANIFEST setting.',
+        )
+
+    def handle(self, *args, **options):
+        output = options['output'] or getattr(settings, 'TEMPLATE_MANIFEST', None)
+        if not output:
+            raise CommandError("No manifest path given; use --output or set TEMPLATE_MANIFEST in the settings.")
+
+        # Instantiate the template backends so that any hierarchy loaders
+        # defined in the settings have registered their directories
+        engines.all()
+        manifest = TemplateManifest.build(sorted(file_system_loaders))
+        manifest.save(output)
+
+        template_count = sum(len(entries) for entries in manifest.directories.values())
+        self.stdout.write("Wrote %d templates from %d directories to %s" % (
+            template_count, len(manifest.directories), output))
@@ -0,0 +1,35 @@
+import os
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.template import engines
+
+from gn_django.template.bytecode import BUNDLE_SUFFIX, compile_bundle, get_hierarchy_loaders
+
+class Command(BaseCommand):
+    help = 'Precompile the templates of every template hierarchy in to jinja bytecode bundles'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '-o', '--output', type=str, dest='output', default=None,
+            help='Directory to write the bundles to. Defaults to the TEMPLATE_BYTECODE_BUNDLE setting.',
+        )
+
+    def handle(self, *args, **options):
+        output = options['output'] or getattr(settings, 'TEMPLATE_BYTECODE_BUNDLE', None)
+        if not output:
+            raise CommandError("No bundle directory given; use --output or set TEMPLATE_BYTECODE_BUNDLE in the settings.")
+        if not os.path.isdir(output):
+            os.makedirs(output)
+
+        for engine in engines.all():
+            environment = getattr(engine, 'env', None)
+            if environment is None or environment.loader is None:
+                continue
+            for hierarchy_name, loader in get_hierarchy_loaders(environment.loader):
+                cache, errors = compile_bundle(environment, loader)
+                path = os.path.join(output, "%s-%s%s" % (engine.name, hierarchy_name, BUNDLE_SUFFIX))
+                cache.save(path)
+                self.stdout.write("Compiled %d templates to %s" % (len(cache.bundle), path))
+                for template, error in errors:
+                    self.stderr.write("Could not compile '%s': %s" % (template, error))
@@ -0,0 +1,64 @@
+import json
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from gn_django.template.profiler import EVENTS, aggregate_profile_log
+
+class Command(BaseCommand):
+    help = 'Aggregate the template timings logged by TemplateProfilerMiddleware'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '-i', '--input', type=str, dest='input', default=None,
+            help='Path of the profile log. Defaults to the TEMPLATE_PROFILE_LOG setting.',
+        )
+        parser.add_argument(
+            '-e', '--event', type=str, dest='event', default=None, choices=EVENTS,
+            help='Only show timings for one event.',
+        )
+        parser.add_argument(
+            '-s', '--sort', type=str, dest='sort', default='total', choices=('total', 'mean', 'max', 'count'),
+            help='The statistic to sort by, largest first.',
+        )
+        parser.add_argument(
+            '-l', '--limit', type=int, dest='limit', default=None,
+            help='The number of rows to show.',
+        )
+        parser.add_argument(
+            '--json', action='store_true', dest='json', default=False,
+            help='Output the aggregated timings as JSON.',
+        )
+
+    def handle(self, *args, **options):
+        path = options['input'] or getattr(settings, 'TEMPLATE_PROFILE_LOG', None)
+        if not path:
+            raise CommandError("No profile log given; use --input or set TEMPLATE_PROFILE_LOG in the settings.")
+        try:
+            stats = aggregate_profile_log(path)
+        except IOError as e:
+            raise CommandError("Could not read profile log '%s': %s" % (path, e))
+
+        if options['event']:
+            stats = [stat for stat in stats if stat['event'] == options['event']]
+        stats.sort(key=lambda stat: stat[options['sort']], reverse=True)
+        if options['limit'] is not None:
+            stats = stats[:options['limit']]
+
+        if options['json']:
+            self.stdout.write(json.dumps(stats, indent=2, sort_keys=True))
+            return
+
+        self.stdout.write("%-12s %8s %10s %10s %10s %6s  %s" % (
+            'event', 'count', 'total ms', 'mean ms', 'max ms', 'hits', 'template'))
+        for stat in stats:
+            hits = ''
+            template = stat['template']
+            if stat['event'] == 'load':
+                hits = '%d%%' % (100 * stat['hits'] / stat['count'])
+                if stat['loaders']:
+                    template = '%s (%s)' % (template, ', '.join(
+                        '%s: %d' % loader for loader in sorted(stat['loaders'].items())))
+            self.stdout.write("%-12s %8d %10.2f %10.2f %10.2f %6s  %s" % (
+                stat['event'], stat['count'], stat['total'] * 1000, stat['mean'] * 1000,
+                stat['max'] * 1000, hits, template))
@@ -0,0 +1,37 @@
+from django.core.management.base import BaseCommand
+
+from gn_django.template.warmup import warm_all_templates
+
+class Command(BaseCommand):
+    help = 'Load every template for every site in to the jinja template caches'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '-w', '--workers', type=int, dest='workers', default=4,
+            help='The number of threads to load templates with.',
+        )
+        parser.add_argument(
+            '-b', '--budget', type=float, dest='budget', default=None,
+            help='The number of seconds to spend loading templates. Templates not loaded in time are skipped.',
+        )
+        parser.add_argument(
+            '-s', '--slowest', type=int, dest='slowest', default=10,
+            help='The number of slowest templates to report.',
+        )
+
+    def handle(self, *args, **options):
+        report = warm_all_templates(workers=options['workers'], budget=options['budget'])
+
+        sites = set(site for site, template, duration in report.loaded)
+        self.stdout.write("Loaded %d templates for %d sites in %.2fs" % (
+            len(report.loaded), len(sites), report.elapsed))
+        if report.skipped:
+            self.stdout.write("Skipped %d templates when the time budget ran out" % report.skipped)
+        if report.over_capacity:
+            self.stdout.write("Skipped %d templates which the template caches had no room for" % report.over_capacity)
+        if options['slowest'] and report.loaded:
+            self.stdout.write("Slowest templates:")
+            for site, template, duration in report.get_slowest(options['slowest']):
+                self.stdout.write("  %8.2fms  %s  %s" % (duration * 1000, site, template))
+        for site, template, error in report.failures:
+            self.stderr.write("Could not load '%s' for %s: %s" % (template, site, error))
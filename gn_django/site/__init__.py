@@ -1,47 +1,99 @@
-from threading import local
+from contextlib import contextmanager
+from contextvars import ContextVar
 
 from django.conf import settings
 
-_active = local()
+from .resolver import get_site_resolver
+
+# The current site, along with its settings snapshot if it's known
+_current_site = ContextVar('gn_django_current_site', default=(None, None))
 
 def get_current_site():
     """
-    Get the site for the current thread.
+    Get the site for the current context - the current thread, or the current
+    asyncio task.
     """
     if hasattr(settings, "STATIC_SITE_DOMAIN"):
         return settings.STATIC_SITE_DOMAIN
 
-    site = getattr(_active, "current_site", None)
-    return site
+    return _current_site.get()[0]
 
-def set_current_site(site):
+def get_current_site_settings():
+    """
+    Get the ``SiteSettings`` snapshot for the site of the current context, or
+    None if no site is set.
     """
-    Set the site for the current thread.
+    site_settings = _current_site.get()[1]
+    if site_settings is None or hasattr(settings, "STATIC_SITE_DOMAIN"):
+        site = get_current_site()
+        if site is None:
+            return None
+        site_settings = get_site_resolver().get_site_settings(site)
+    return site_settings
+
+def set_current_site(site, site_settings=None):
+    """
+    Set the site for the current context.  Asyncio tasks started afterwards
+    inherit the site, but setting the site within a task does not affect the
+    code which started it.
 
     Args:
       * `site` - string - the site to set
+      * `site_settings` - ``SiteSettings`` - optional settings snapshot for
+        the site.  When it's not given, it's looked up when needed.
+
+    Returns a token which can be passed to ``reset_current_site()`` to restore
+    the previous site
+    """
+    return _current_site.set((site, site_settings))
+
+def reset_current_site(token):
+    """
+    Restore the site that was current before a call to ``set_current_site()``.
+
+    Args:
+      * `token` - the token returned by ``set_current_site()``
     """
-    _active.current_site = site
+    _current_site.reset(token)
 
 def clear_current_site():
     """
-    Clear the site in the current thread, if it was set.
+    Clear the site in the current context, if it was set.
+    """
+    _current_site.set((None, None))
+
+@contextmanager
+def site_context(site):
     """
-    if hasattr(_active, "current_site"):
-        del _active.current_site
+    Context manager which sets the current site within its block and restores
+    the previous site afterwards, e.g. for background tasks and management
+    commands which run outside of a request::
+
+        with site_context('eurogamer.net'):
+            render_to_string('newsletter.j2', context)
+
+    Args:
+      * `site` - string - the site to set
+    """
+    token = set_current_site(site)
+    try:
+        yield site
+    finally:
+        reset_current_site(token)
 
 def get_namespace_for_site():
     """
     Get the namespace string for the currently active site
     domain.
     """
-    if not hasattr(settings, "SITE_NAMESPACES"):
+    resolver = get_site_resolver()
+    if resolver.namespaces is None:
         raise Exception("get_namespace_for_site function can only be called if SITE_NAMESPACES is defined in the settings.")
 
     site = get_current_site()
     if site == None:
         return None
     try:
-        return settings.SITE_NAMESPACES[site]
+        return resolver.namespaces[site]
     except KeyError:
         raise KeyError("SITE_NAMESPACES setting has no key '%s'" % site)
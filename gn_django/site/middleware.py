@@ -1,38 +1,64 @@
-from django.conf import settings
+import inspect
 
-from . import get_current_site, set_current_site, clear_current_site
+try:
+    from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+except ImportError:
+    from asyncio import iscoroutinefunction
+    markcoroutinefunction = getattr(inspect, 'markcoroutinefunction', None)
+
+from . import set_current_site, reset_current_site, clear_current_site
+from .resolver import get_site_resolver
 
 class SiteFromDomainMiddleware:
     """
     Middleware identifies the Host set for incoming requests and uses
-    `set_current_site()` to set thread local storage of the current
-    site.
+    `set_current_site()` to set the current site for the rest of the request.
+    The site's ``SiteSettings`` snapshot is set along with it, and attached to
+    the request as ``request.site_settings``.
+
+    The site is stored in a context variable, so the middleware can be used
+    in both sync and async middleware chains; when the next handler is a
+    coroutine function, the middleware is too.  The middleware is only async
+    capable where it can be marked as a coroutine function, with asgiref 3.6+
+    or python 3.12+.
     """
 
+    sync_capable = True
+    async_capable = markcoroutinefunction is not None
+
     def __init__(self, get_response):
         self.get_response = get_response
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async and markcoroutinefunction is not None:
+            # Mark the middleware as a coroutine function for django's
+            # handler, in the same way as django's own async middleware
+            markcoroutinefunction(self)
+
+    def activate(self, request):
+        # Identify the Host and lookup the site domain from the patterns in
+        # the SITE_DOMAINS django setting
+        resolver = get_site_resolver()
+        site, namespace = resolver.resolve(request.get_host())
+        request.site_settings = resolver.get_site_settings(site)
+        return set_current_site(site, request.site_settings)
 
     def __call__(self, request):
-        
-        # Identify the Host and lookup the site domain from SITE_DOMAINS
-        # in django settings
-        host = request.get_host().split(':')[0]
-        site = host
+        if self.is_async:
+            return self.__acall__(request)
+        token = self.activate(request)
         try:
-            site = settings.SITE_DOMAINS[host]
-        except KeyError:
-            raise KeyError("django setting's SITE_DOMAINS attribute does not have an entry for the host '%s'" % host)
-        # Set the thread local storage
-        set_current_site(site)
+            return self.get_response(request)
+        finally:
+            reset_current_site(token)
 
-        response = self.get_response(request)
-
-        # Clear the thread local storage
-        clear_current_site()
-
-        return response
+    async def __acall__(self, request):
+        token = self.activate(request)
+        try:
+            return await self.get_response(request)
+        finally:
+            reset_current_site(token)
 
     def process_exception(self, request, exception):
-        # Ensure that we clear the TLS for requests that raise an exception
+        # Ensure that we clear the site for requests that raise an exception
         clear_current_site()
         return None
@@ -0,0 +1,213 @@
+"""
+Resolving request hosts to sites and site namespaces.
+
+A ``SiteResolver`` is built once from the ``SITE_DOMAINS``, ``SITE_NAMESPACES``
+and ``SITE_SETTINGS`` settings, so that resolving a host or reading per-site
+settings doesn't go through the django settings proxy on every request.
+"""
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.http.request import split_domain_port
+from jinja2.utils import LRUCache
+
+from .site_settings import SiteSettings
+
+RESOLVER_SETTINGS = ('SITE_DOMAINS', 'SITE_NAMESPACES', 'SITE_RESOLVER_CACHE_SIZE', 'SITE_SETTINGS')
+
+class _Node(object):
+    __slots__ = ('children', 'exact', 'wildcard', 'suffix')
+
+    def __init__(self):
+        self.children = {}
+        self.exact = None
+        self.wildcard = None
+        self.suffix = None
+
+class SiteResolver(object):
+    """
+    Resolves hosts to a site and the site's namespace.  Host patterns are
+    compiled in to a trie of reversed domain labels, so a lookup costs one
+    dictionary lookup per label of the host whatever the number of patterns.
+    The results for recently resolved hosts are cached.
+
+    Host patterns can be:
+
+      * an exact host, e.g. ``www.eurogamer.net``
+      * a wildcard subdomain, e.g. ``*.eurogamer.net``, which matches any
+        single label subdomain - ``www.eurogamer.net`` but not
+        ``eurogamer.net`` or ``a.b.eurogamer.net``
+      * a suffix, e.g. ``.eurogamer.net``, which matches the domain and all of
+        its subdomains - in the same way as django's ``ALLOWED_HOSTS``
+
+    Exact hosts take precedence over wildcards, and wildcards over suffixes.
+    Of several matching suffixes, the longest wins.  Hosts and patterns are
+    matched case-insensitively, and any port in a host is ignored.
+
+    The resolver also holds a ``SiteSettings`` snapshot for each site.
+
+    Args:
+      * `domains` - mapping - mapping of host patterns to site, as in the
+        ``SITE_DOMAINS`` setting
+      * `namespaces` - mapping - optional mapping of site to namespace, as in
+        the ``SITE_NAMESPACES`` setting
+      * `cache_size` - int - the number of resolved hosts to cache
+      * `per_site_settings` - mapping - optional mapping of setting name to a
+        mapping of site to value, for the ``SiteSettings`` snapshots
+    """
+
+    def __init__(self, domains, namespaces=None, cache_size=1000, per_site_settings=None):
+        self.domains = {}
+        self.namespaces = dict(namespaces) if namespaces is not None else None
+        self.per_site_settings = dict(per_site_settings or {})
+        self.root = _Node()
+        self.cache = LRUCache(cache_size) if cache_size else None
+        self.site_settings = {}
+        for pattern, site in domains.items():
+            self.add(pattern, site)
+        for site in set(self.domains.values()) | set(self.namespaces or ()):
+            self.get_site_settings(site)
+
+    @classmethod
+    def from_settings(cls):
+        """
+        Build a resolver from the ``SITE_DOMAINS``, ``SITE_NAMESPACES``,
+        ``SITE_RESOLVER_CACHE_SIZE`` and ``SITE_SETTINGS`` settings.
+
+        Returns an instantiated ``SiteResolver`` object
+        """
+        return cls(
+            getattr(settings, 'SITE_DOMAINS', {}),
+            getattr(settings, 'SITE_NAMESPACES', None),
+            getattr(settings, 'SITE_RESOLVER_CACHE_SIZE', 1000),
+            dict((name, getattr(settings, name)) for name in getattr(settings, 'SITE_SETTINGS', ())),
+        )
+
+    def add(self, pattern, site):
+        """
+        Add a host pattern.
+
+        Args:
+          * `pattern` - string - the host pattern
+          * `site` - string - the site that the pattern resolves to
+        """
+        pattern = pattern.lower().rstrip('.')
+        if pattern.startswith('*.'):
+            domain, kind = pattern[2:], 'wildcard'
+        elif pattern.startswith('.'):
+            domain, kind = pattern[1:], 'suffix'
+        else:
+            domain, kind = pattern, 'exact'
+        node = self.root
+        for label in reversed(domain.split('.')):
+            node = node.children.setdefault(label, _Node())
+        setattr(node, kind, (site, self.get_namespace(site)))
+        self.domains[pattern] = site
+        self.site_settings.pop(site, None)
+        if self.cache is not None:
+            self.cache.clear()
+
+    def get_namespace(self, site):
+        """
+        Get the namespace for a site, or None if there isn't one.
+
+        Args:
+          * `site` - string - the site
+        """
+        if self.namespaces is None:
+            return None
+        return self.namespaces.get(site)
+
+    def get_site_settings(self, site):
+        """
+        Get the settings snapshot for a site.  Snapshots are built once per
+        site.
+
+        Args:
+          * `site` - string - the site
+
+        Returns a ``SiteSettings`` object
+        """
+        site_settings = self.site_settings.get(site)
+        if site_settings is None:
+            site_settings = self.site_settings[site] = SiteSettings.build(
+                site, self.domains, self.namespaces, self.per_site_settings
+            )
+        return site_settings
+
+    def match(self, domain):
+        """
+        Match a domain against the host patterns, without using the cache.
+
+        Args:
+          * `domain` - string - the lower case domain, without a port
+
+        Returns a ``(site, namespace)`` pair, or None if no pattern matches
+        """
+        labels = domain.split('.')
+        last = len(labels) - 1
+        node = self.root
+        wildcard = suffix = None
+        for depth, label in enumerate(reversed(labels)):
+            if depth and node.suffix is not None:
+                suffix = node.suffix
+            if depth == last and node.wildcard is not None:
+                wildcard = node.wildcard
+            node = node.children.get(label)
+            if node is None:
+                break
+        else:
+            if node.exact is not None:
+                return node.exact
+            if node.suffix is not None:
+                return node.suffix
+        return wildcard if wildcard is not None else suffix
+
+    def resolve(self, host):
+        """
+        Resolve a host to a site and namespace.
+
+        Args:
+          * `host` - string - the host, optionally with a port, e.g. from
+            ``request.get_host()``
+
+        Returns a ``(site, namespace)`` pair.  Raises ``KeyError`` if the host
+        doesn't match any pattern.
+        """
+        if self.cache is not None:
+            resolved = self.cache.get(host)
+            if resolved is not None:
+                return resolved
+        domain = split_domain_port(host)[0]
+        resolved = self.match(domain)
+        if resolved is None:
+            raise KeyError("django setting's SITE_DOMAINS attribute does not have an entry for the host '%s'" % domain)
+        if self.cache is not None:
+            self.cache[host] = resolved
+        return resolved
+
+_resolver = None
+
+def get_site_resolver():
+    """
+    Get the ``SiteResolver`` for the project's settings.  The resolver is built
+    the first time it's needed - normally when the ``gn_django`` app is ready -
+    and rebuilt when the settings it's built from change.
+    """
+    global _resolver
+    resolver = _resolver
+    if resolver is None:
+        resolver = _resolver = SiteResolver.from_settings()
+    return resolver
+
+def reset_site_resolver(**kwargs):
+    """
+    Forget the project's ``SiteResolver``, so that it's rebuilt from settings
+    the next time it's needed.
+    """
+    global _resolver
+    setting = kwargs.get('setting', RESOLVER_SETTINGS[0])
+    if setting in RESOLVER_SETTINGS or setting in getattr(settings, 'SITE_SETTINGS', ()):
+        _resolver = None
+
+setting_changed.connect(reset_site_resolver)
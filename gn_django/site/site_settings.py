@@ -0,0 +1,77 @@
+"""
+Immutable snapshots of the settings for each site.
+"""
+
+from types import MappingProxyType
+
+def _freeze(value):
+    if isinstance(value, dict):
+        return MappingProxyType(dict((key, _freeze(item)) for key, item in value.items()))
+    if isinstance(value, (list, set)):
+        return tuple(_freeze(item) for item in value)
+    return value
+
+class SiteSettings(object):
+    """
+    An immutable snapshot of the settings for one site, so that code which
+    needs several per-site settings can read them as plain attributes rather
+    than looking up dictionaries keyed by site in django settings.
+
+    Every snapshot has the attributes:
+
+      * ``site`` - the site
+      * ``namespace`` - the site's namespace from ``SITE_NAMESPACES``, or None
+      * ``domains`` - a sorted tuple of the ``SITE_DOMAINS`` host patterns
+        which resolve to the site
+
+    along with an attribute for each of the per-site settings named in the
+    ``SITE_SETTINGS`` setting.  Each of those settings should be a dictionary
+    keyed by site, and the attribute is the site's value - or None if the site
+    has no entry.  Dictionaries and lists in values are made read-only.
+
+    Args:
+      * `site` - string - the site
+      * `namespace` - string - the site's namespace
+      * `domains` - iterable - the host patterns which resolve to the site
+      * any other kwargs are added as attributes
+    """
+
+    def __init__(self, site, namespace=None, domains=(), **values):
+        values.update(site=site, namespace=namespace, domains=tuple(sorted(domains)))
+        for name, value in values.items():
+            object.__setattr__(self, name, _freeze(value))
+
+    @classmethod
+    def build(cls, site, domains, namespaces=None, per_site_settings=None):
+        """
+        Build the snapshot for a site from the site settings.
+
+        Args:
+          * `site` - string - the site
+          * `domains` - mapping - mapping of host patterns to site, as in the
+            ``SITE_DOMAINS`` setting
+          * `namespaces` - mapping - optional mapping of site to namespace, as
+            in the ``SITE_NAMESPACES`` setting
+          * `per_site_settings` - mapping - optional mapping of setting name to
+            a mapping of site to value
+
+        Returns an instantiated ``SiteSettings`` object
+        """
+        values = dict(
+            (name, by_site.get(site)) for name, by_site in (per_site_settings or {}).items()
+        )
+        return cls(
+            site,
+            namespace=(namespaces or {}).get(site),
+            domains=[pattern for pattern, domain_site in domains.items() if domain_site == site],
+            **values
+        )
+
+    def __setattr__(self, name, value):
+        raise AttributeError("SiteSettings objects are immutable")
+
+    def __delattr__(self, name):
+        raise AttributeError("SiteSettings objects are immutable")
+
+    def __repr__(self):
+        return "<SiteSettings: %s>" % self.site
@@ -1,5 +1,4 @@
-import weakref
-
+from gn_django.template.cache import get_loader_ref
 from . import get_current_site
 
 def get_template_cache_key_with_site(loader, template_name):
@@ -15,5 +14,4 @@ def get_template_cache_key_with_site(loader, template_name):
       * `loader` - the jinja loader object
       * `template_name` - the jinja template name
     """
-    cache_key = (weakref.ref(loader), get_current_site(), template_name)
-    return cache_key
+    return (get_loader_ref(loader), get_current_site(), template_name)
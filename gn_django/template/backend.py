@@ -1,18 +1,24 @@
-import weakref
+import contextvars
+import os
 
 from django.contrib.staticfiles.storage import staticfiles_storage
+from django.template.backends.utils import csrf_input_lazy, csrf_token_lazy
 from django.urls import reverse
 from django.conf import settings
+from django.utils.safestring import mark_safe
 from django.utils.text import slugify
 from django.utils import six
 from django.utils.module_loading import import_string
 
 import jinja2
-from django_jinja.backend import Jinja2 as DjangoJinja2
-from django_jinja import builtins as dj_jinja_builtins
+from django_jinja.backend import Jinja2 as DjangoJinja2, Template as DjangoJinjaTemplate
+from django_jinja import base as dj_jinja_base, builtins as dj_jinja_builtins
 from django_jinja.contrib._humanize.templatetags._humanize import ordinal, intcomma, intword, apnumber, naturalday, naturaltime
 
-from .extensions import SpacelessExtension, IncludeWithExtension, StaticLinkExtension, IncludeRawExtension
+from .bytecode import BundleBytecodeCache
+from .cache import PartitionedTemplateCache, get_loader_ref
+from .compiler import CodeGenerator
+from .extensions import SpacelessExtension, IncludeWithExtension, StaticLinkExtension, IncludeRawExtension, FragmentCacheExtension
 from .globals import randint
 
 class Environment(jinja2.Environment):
@@ -27,15 +33,38 @@ class Environment(jinja2.Environment):
       * `template_cache_key_cb` - a callback function for generating a template
         cache key.  When this is present, this is used instead of the default
         cache key behaviour.
+      * `bytecode_bundle` - path to a bytecode bundle file, or a directory of
+        bundle files, built by the ``compile_template_bundles`` command.  When
+        this is present and exists, the bundles are loaded in to a
+        ``BundleBytecodeCache`` at startup so that templates don't need to be
+        compiled on first use.
+      * `partitioned_cache` - dictionary of ``PartitionedTemplateCache``
+        kwargs.  When this is present, the template cache is partitioned by
+        site with per-site capacities, e.g.
+        ``{"capacity": 400, "capacities": {"eurogamer.net": 800}, "max_entries": 4000}``
+
+    Templates are compiled with ``gn_django.template.compiler.CodeGenerator``
+    so that gn django extensions can compile to custom nodes.
 
     *NOTE*: This class has some duplication from jinja2.Environment which is
     currently unavoidable as there's no overridable hook just for generating
     template cache keys: https://github.com/pallets/jinja/blob/bbe0a4174c2846487bef4328b309fddd8638da39/jinja2/environment.py#L798
     """
 
+    code_generator_class = CodeGenerator
+
     def __init__(self, **kwargs):
-        self.template_cache_key_cb = kwargs.pop('template_cache_key_cb', None)
+        template_cache_key_cb = kwargs.pop('template_cache_key_cb', None)
+        if isinstance(template_cache_key_cb, six.string_types):
+            template_cache_key_cb = import_string(template_cache_key_cb)
+        self.template_cache_key_cb = template_cache_key_cb
+        bytecode_bundle = kwargs.pop('bytecode_bundle', None)
+        if bytecode_bundle and os.path.exists(bytecode_bundle):
+            kwargs.setdefault('bytecode_cache', BundleBytecodeCache.load(bytecode_bundle))
+        partitioned_cache = kwargs.pop('partitioned_cache', None)
         super(Environment, self).__init__(**kwargs)
+        if partitioned_cache is not None:
+            self.cache = PartitionedTemplateCache(**partitioned_cache)
 
     def get_template_cache_key(self, template_name):
         """
@@ -44,12 +73,9 @@ class Environment(jinja2.Environment):
         This will use `template_cache_key_cb` if it is present on the object
         instance.
         """
-        cache_key = (weakref.ref(self.loader), template_name)
-        if self.template_cache_key_cb:
-            if isinstance(self.template_cache_key_cb, six.string_types):
-                self.template_cache_key_cb = import_string(self.template_cache_key_cb)
-            cache_key = self.template_cache_key_cb(self.loader, template_name)
-        return cache_key
+        if self.template_cache_key_cb is not None:
+            return self.template_cache_key_cb(self.loader, template_name)
+        return (get_loader_ref(self.loader), template_name)
 
     @jinja2.utils.internalcode
     def _load_template(self, name, globals):
@@ -70,11 +96,126 @@ class Environment(jinja2.Environment):
 
 def environment(**options):
     """
-    Base jinja2 environment.
+    Base jinja2 environment.  If the ``profile`` option is set, a
+    ``gn_django.template.profiler.ProfilingEnvironment`` is built instead.
     """
+    if options.pop('profile', False):
+        from .profiler import ProfilingEnvironment
+        return ProfilingEnvironment(**options)
     env = Environment(**options)
     return env
 
+def _iter_in_context(context, iterator):
+    """
+    Iterate over an iterator with each step run in a ``contextvars`` context.
+    """
+    iterator = iter(iterator)
+    while True:
+        try:
+            value = context.run(next, iterator)
+        except StopIteration:
+            return
+        yield value
+
+class Template(DjangoJinjaTemplate):
+    """
+    Template wrapper which can render templates as a stream, as well as to a
+    string.
+    """
+
+    def make_context(self, context=None, request=None):
+        """
+        Build the jinja context for rendering the template, including the
+        request, CSRF input and token and the output of the backend's context
+        processors if there is a request.
+
+        Args:
+          * `context` - mapping - the template context
+          * `request` - HttpRequest - the current request, if available
+        """
+        context = dj_jinja_base.dict_from_context(context or {})
+        if request is not None:
+            context['request'] = request
+            context['csrf_input'] = csrf_input_lazy(request)
+            context['csrf_token'] = csrf_token_lazy(request)
+            for processor in self.backend.context_processors:
+                context.update(processor(request))
+        return context
+
+    def send_rendered_signal(self, context):
+        """
+        Send django's ``template_rendered`` test signal when template debugging
+        is enabled, for the test client and the debug toolbar.
+
+        Args:
+          * `context` - dict - the jinja context the template is rendered with
+        """
+        if not self.backend._tmpl_debug:
+            return
+        from django.test.signals import template_rendered
+
+        # Listeners expect a django context, with a stack of dicts
+        class SignalContext(dict):
+            @property
+            def dicts(self):
+                return [self]
+
+        template_rendered.send(sender=self, template=self, context=SignalContext(context))
+
+    def render(self, context=None, request=None):
+        context = self.make_context(context, request)
+        self.send_rendered_signal(context)
+        return mark_safe(self.template.render(context))
+
+    @property
+    def is_async(self):
+        """
+        Whether the template was compiled for async rendering.
+        """
+        return self.template.environment.is_async
+
+    async def render_async(self, context=None, request=None):
+        """
+        Render the template in an async view, without blocking the event loop
+        or starting a new one.  The backend must have the ``enable_async``
+        option set.
+
+        Args:
+          * `context` - mapping - the template context
+          * `request` - HttpRequest - the current request, if available
+        """
+        context = self.make_context(context, request)
+        self.send_rendered_signal(context)
+        return mark_safe(await self.template.render_async(context))
+
+    def stream(self, context=None, request=None, buffer_size=None):
+        """
+        Render the template as a stream of strings, which are generated as the
+        template is rendered.
+
+        Args:
+          * `context` - mapping - the template context
+          * `request` - HttpRequest - the current request, if available
+          * `buffer_size` - int - the number of template events to buffer in
+            to each string in the stream.  Defaults to the backend's
+            ``stream_buffer_size`` option.  If this is ``0``, no buffering
+            is done.
+
+        Returns a ``jinja2.environment.TemplateStream``
+        """
+        # Templates are rendered as the stream is read - after the view and
+        # middleware have returned - so render in the context of this call,
+        # e.g. with the current site set
+        context = self.make_context(context, request)
+        self.send_rendered_signal(context)
+        events = self.template.generate(context)
+        stream = jinja2.environment.TemplateStream(_iter_in_context(contextvars.copy_context(), events))
+        if buffer_size is None:
+            buffer_size = self.backend.stream_buffer_size
+        if buffer_size:
+            stream.enable_buffering(buffer_size)
+        return stream
+
 class Jinja2(DjangoJinja2):
 
     """
@@ -125,6 +266,15 @@ class Jinja2(DjangoJinja2):
             This defaults to a standard filesystem loader, but can be specified
             as either a dot-notation python path or a fully instantiated loader
             object
+          * ``"stream_buffer_size"`` - the number of template events to buffer
+            in to each chunk when streaming templates with ``Template.stream()``.
+            Defaults to ``5``; set to ``0`` to disable buffering.
+          * ``"enable_async"`` - compile templates for async rendering, so that
+            they can be rendered with ``Template.render_async()`` in async
+            views.  Sync rendering still works, but runs an event loop for
+            each render.
+          * ``"profile"`` - record template load, compile and render times
+            while a profile is active.  See ``gn_django.template.profiler``.
     """
     def __init__(self, params):
         """
@@ -155,9 +305,19 @@ class Jinja2(DjangoJinja2):
         # Default jinja template extension to be .j2
         options['match_extension'] = options.pop('match_extension', '.j2')
 
+        self.stream_buffer_size = options.pop('stream_buffer_size', 5)
+
         params['OPTIONS'] = options
         super(Jinja2, self).__init__(params)
 
+    def from_string(self, template_code):
+        template = super(Jinja2, self).from_string(template_code)
+        return Template(template.template, self)
+
+    def get_template(self, template_name):
+        template = super(Jinja2, self).get_template(template_name)
+        return Template(template.template, self)
+
     def get_base_filters(self):
         """
         Default filters that should be included for all jinja templates
@@ -209,8 +369,12 @@ class Jinja2(DjangoJinja2):
             iterable of extensions
         """
         base_extensions = dj_jinja_builtins.DEFAULT_EXTENSIONS.copy()
+        # django-jinja's `cache` tag is replaced by the site-aware fragment cache,
+        # which keeps its syntax and cache keys
+        base_extensions.remove('django_jinja.builtins.extensions.CacheExtension')
         base_extensions.append(SpacelessExtension)
         base_extensions.append(IncludeWithExtension)
         base_extensions.append(StaticLinkExtension)
         base_extensions.append(IncludeRawExtension)
+        base_extensions.append(FragmentCacheExtension)
         return base_extensions
@@ -0,0 +1,174 @@
+"""
+Jinja bytecode caches for gn django projects.
+"""
+
+from hashlib import sha1
+import marshal
+import os
+
+from django.core.cache import caches
+from django.utils.functional import cached_property
+from jinja2 import BytecodeCache, TemplateSyntaxError
+from jinja2.loaders import TemplateNotFound
+
+from gn_django.site import get_current_site
+from .loaders import HierarchyLoader, MultiHierarchyLoader
+
+BUNDLE_SUFFIX = '.bundle'
+
+class BundleBytecodeCache(BytecodeCache):
+    """
+    An in-memory bytecode cache which can be saved to and loaded from bundle
+    files.  Bundles are built ahead of time with the ``compile_template_bundles``
+    command so that worker processes can load the compiled bytecode for every
+    template at startup, rather than compiling templates on first use.
+
+    Bundle entries are keyed by jinja's bucket keys, which are derived from the
+    template name and filename, so bundles for many hierarchies can be merged
+    in to one cache.  Bytecode which doesn't match the template source or the
+    running python version is ignored and recompiled.
+
+    Args:
+      * `bundle` - mapping - optional mapping of bucket keys to bytecode
+    """
+
+    def __init__(self, bundle=None):
+        self.bundle = bundle if bundle is not None else {}
+
+    def load_bytecode(self, bucket):
+        bytecode = self.bundle.get(bucket.key)
+        if bytecode is not None:
+            bucket.bytecode_from_string(bytecode)
+
+    def dump_bytecode(self, bucket):
+        self.bundle[bucket.key] = bucket.bytecode_to_string()
+
+    def clear(self):
+        self.bundle.clear()
+
+    def save(self, path):
+        """
+        Write the bundle to a file.
+
+        Args:
+          * `path` - string - the path of the bundle file
+        """
+        with open(path, 'wb') as f:
+            marshal.dump(self.bundle, f)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Load a bundle file, or all of the bundle files in a directory.
+
+        Args:
+          * `path` - string - path of a bundle file or a directory of bundle files
+
+        Returns an instantiated ``BundleBytecodeCache`` object
+        """
+        if os.path.isdir(path):
+            paths = [
+                os.path.join(path, filename) for filename in sorted(os.listdir(path))
+                if filename.endswith(BUNDLE_SUFFIX)
+            ]
+        else:
+            paths = [path]
+        bundle = {}
+        for bundle_path in paths:
+            with open(bundle_path, 'rb') as f:
+                bundle.update(marshal.load(f))
+        return cls(bundle)
+
+class DjangoCacheBytecodeCache(BytecodeCache):
+    """
+    A bytecode cache which stores compiled templates in one of django's cache
+    backends, so that a template compiled by one worker process is available
+    to all of the others.  Cache keys vary on the current site, in the same way
+    as ``gn_django.site.template.get_template_cache_key_with_site``.
+
+    It can be enabled with django-jinja's ``bytecode_cache`` option::
+
+        "bytecode_cache": {
+            "name": "jinja_bytecode",
+            "backend": "gn_django.template.bytecode.DjangoCacheBytecodeCache",
+            "enabled": True,
+        },
+
+    where ``"name"`` is the alias of the cache in the ``CACHES`` setting.  A
+    ``FileBasedCache`` or ``LocMemCache`` backend can stand in for a shared
+    cache locally.
+
+    Args:
+      * `cache_name` - string - the alias of the django cache to use
+    """
+
+    key_prefix = 'gn_django_jinja_bytecode'
+    timeout = None
+
+    def __init__(self, cache_name='default'):
+        self.cache_name = cache_name
+
+    @cached_property
+    def backend(self):
+        return caches[self.cache_name]
+
+    def get_cache_key(self, name, filename=None):
+        key = sha1(("%s|%s" % (get_current_site(), name)).encode('utf-8'))
+        if filename is not None:
+            key.update(("|%s" % filename).encode('utf-8'))
+        return "%s:%s" % (self.key_prefix, key.hexdigest())
+
+    def load_bytecode(self, bucket):
+        bytecode = self.backend.get(bucket.key)
+        if bytecode is not None:
+            bucket.bytecode_from_string(bytecode)
+
+    def dump_bytecode(self, bucket):
+        self.backend.set(bucket.key, bucket.bytecode_to_string(), self.timeout)
+
+def get_hierarchy_loaders(loader):
+    """
+    Get the template hierarchies served by a loader.
+
+    Args:
+      * `loader` - the jinja loader object
+
+    Returns a list of pairs of hierarchy name and loader
+    """
+    if isinstance(loader, MultiHierarchyLoader):
+        return sorted(loader.hierarchies.items())
+    return [('default', loader)]
+
+def get_template_identifiers(loader):
+    """
+    Get every template identifier that a loader can resolve.
+
+    Args:
+      * `loader` - the jinja loader object
+
+    Returns a list of template identifiers
+    """
+    if isinstance(loader, HierarchyLoader):
+        return loader.list_template_identifiers()
+    return loader.list_templates()
+
+def compile_bundle(environment, loader):
+    """
+    Compile every template that a loader can resolve in to a bytecode bundle.
+
+    Args:
+      * `environment` - the jinja environment object to compile with
+      * `loader` - the jinja loader object to load template sources from
+
+    Returns a pair of ``BundleBytecodeCache`` and a list of
+    ``(template name, error)`` pairs for templates which failed to compile
+    """
+    cache = BundleBytecodeCache()
+    compile_env = environment.overlay(bytecode_cache=cache)
+    errors = []
+    for template in get_template_identifiers(loader):
+        try:
+            loader.load(compile_env, template)
+        except (TemplateNotFound, TemplateSyntaxError, UnicodeDecodeError) as e:
+            errors.append((template, e))
+    return cache, errors
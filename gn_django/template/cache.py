@@ -0,0 +1,197 @@
+"""
+Template caches for gn django jinja environments.
+"""
+
+from collections import OrderedDict
+from threading import Lock
+import weakref
+
+from gn_django.site import get_current_site
+
+def get_loader_ref(loader):
+    """
+    Get a weak reference to a template loader for use in template cache keys.
+    The reference is created once and stored on the loader, so that building
+    a cache key doesn't allocate a new weak reference each time.
+
+    Args:
+      * `loader` - the jinja loader object
+    """
+    try:
+        return loader._gn_django_ref
+    except AttributeError:
+        ref = weakref.ref(loader)
+        loader._gn_django_ref = ref
+        return ref
+
+class PartitionedTemplateCache(object):
+    """
+    A template cache which keeps a separate LRU partition per site, so that a
+    busy site cannot evict the templates of quieter sites.  The partition used
+    for a cache operation is the site returned by ``get_current_site()``.
+
+    Implements the mapping interface that jinja uses for its template cache, so
+    it can be used as the ``cache`` of a jinja environment.
+
+    Args:
+      * `capacity` - int - the default number of templates to cache per site
+      * `capacities` - mapping - optional mapping of site to number of templates
+        to cache for that site, overriding `capacity`
+      * `max_entries` - int - optional ceiling on the total number of templates
+        cached across all sites.  When it's reached, the least recently used
+        template from the fullest partition is evicted.
+    """
+
+    def __init__(self, capacity=400, capacities=None, max_entries=None):
+        self.capacity = capacity
+        self.capacities = capacities or {}
+        self.max_entries = max_entries
+        self.partitions = {}
+        self.counters = {}
+        self._lock = Lock()
+
+    def get_partition_name(self):
+        """
+        Get the name of the partition to use for the current cache operation.
+        """
+        return get_current_site()
+
+    def get_capacity(self, partition_name):
+        """
+        Get the number of templates that can be cached for a partition.
+
+        Args:
+          * `partition_name` - the partition (site) name
+        """
+        return self.capacities.get(partition_name, self.capacity)
+
+    def _get_partition(self, partition_name):
+        partition = self.partitions.get(partition_name)
+        if partition is None:
+            partition = self.partitions[partition_name] = OrderedDict()
+            self.counters[partition_name] = {'hits': 0, 'misses': 0, 'evictions': 0}
+        return partition
+
+    def _evict(self, partition_name):
+        self.partitions[partition_name].popitem(last=False)
+        self.counters[partition_name]['evictions'] += 1
+
+    def _enforce_ceiling(self):
+        if not self.max_entries:
+            return
+        while len(self) > self.max_entries:
+            # Evict from the partition which is using the most of its capacity
+            fullest = max(
+                (name for name in self.partitions if self.partitions[name]),
+                key=lambda name: len(self.partitions[name]) / float(self.get_capacity(name) or 1)
+            )
+            self._evict(fullest)
+
+    def get(self, key, default=None):
+        partition_name = self.get_partition_name()
+        with self._lock:
+            partition = self._get_partition(partition_name)
+            try:
+                value = partition[key]
+            except KeyError:
+                self.counters[partition_name]['misses'] += 1
+                return default
+            partition.move_to_end(key)
+            self.counters[partition_name]['hits'] += 1
+            return value
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        partition_name = self.get_partition_name()
+        capacity = self.get_capacity(partition_name)
+        with self._lock:
+            partition = self._get_partition(partition_name)
+            if key in partition:
+                partition.move_to_end(key)
+            elif capacity and len(partition) >= capacity:
+                self._evict(partition_name)
+            partition[key] = value
+            self._enforce_ceiling()
+
+    def __delitem__(self, key):
+        with self._lock:
+            del self.partitions.get(self.get_partition_name(), {})[key]
+
+    def __contains__(self, key):
+        return key in self.partitions.get(self.get_partition_name(), {})
+
+    def __len__(self):
+        return sum(len(partition) for partition in self.partitions.values())
+
+    def clear(self):
+        with self._lock:
+            for partition in self.partitions.values():
+                partition.clear()
+
+    def remove_matching(self, predicate):
+        """
+        Remove the cached templates which match a predicate, from every
+        partition.
+
+        Args:
+          * `predicate` - callable which takes a template and returns whether
+            to remove it
+
+        Returns the number of templates removed
+        """
+        removed = 0
+        with self._lock:
+            for partition in self.partitions.values():
+                for key in [key for key, template in partition.items() if predicate(template)]:
+                    del partition[key]
+                    removed += 1
+        return removed
+
+    def stats(self):
+        """
+        Get the hit, miss and eviction counters along with the size and
+        capacity of each partition.
+
+        Returns a mapping of partition name to a mapping of statistics
+        """
+        with self._lock:
+            stats = {}
+            for partition_name, partition in self.partitions.items():
+                partition_stats = dict(self.counters[partition_name])
+                partition_stats['size'] = len(partition)
+                partition_stats['capacity'] = self.get_capacity(partition_name)
+                stats[partition_name] = partition_stats
+            return stats
+
+def remove_cached_templates(cache, predicate):
+    """
+    Remove the templates which match a predicate from a jinja environment's
+    template cache.  Works with ``PartitionedTemplateCache``, jinja's
+    ``LRUCache`` and plain dictionaries.
+
+    Args:
+      * `cache` - the template cache object.  May be None, when the
+        environment doesn't cache templates.
+      * `predicate` - callable which takes a template and returns whether to
+        remove it
+
+    Returns the number of templates removed
+    """
+    if cache is None:
+        return 0
+    if isinstance(cache, PartitionedTemplateCache):
+        return cache.remove_matching(predicate)
+    removed = 0
+    for key, template in list(cache.items()):
+        if predicate(template):
+            try:
+                del cache[key]
+            except KeyError:
+                continue
+            removed += 1
+    return removed
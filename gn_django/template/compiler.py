@@ -0,0 +1,80 @@
+"""
+Jinja code generation for gn django template extensions.
+"""
+
+from jinja2 import nodes
+from jinja2.compiler import CodeGenerator as BaseCodeGenerator
+
+from .extensions import IncludeWithExtension
+
+class CodeGenerator(BaseCodeGenerator):
+    """
+    Jinja code generator which compiles some gn django extension tags to
+    inline code, rather than calls out to the extension at render time.
+    """
+
+    def get_include_with_args(self, node):
+        """
+        Get the template and context nodes of an ``include_with`` call block.
+
+        Args:
+          * `node` - the ``CallBlock`` node
+
+        Returns a pair of template and context nodes, or None if the call block
+        is not for an ``include_with`` tag
+        """
+        call = node.call
+        if not isinstance(call, nodes.Call) or not isinstance(call.node, nodes.ExtensionAttribute):
+            return None
+        if call.node.name != '_render' or len(call.args) != 2:
+            return None
+        extension = self.environment.extensions.get(call.node.identifier)
+        if not isinstance(extension, IncludeWithExtension):
+            return None
+        # Leave extensions which customise rendering to do so
+        if type(extension)._render is not IncludeWithExtension._render:
+            return None
+        return call.args
+
+    def visit_CallBlock(self, node, frame):
+        include_with_args = self.get_include_with_args(node)
+        if include_with_args is None:
+            return super(CodeGenerator, self).visit_CallBlock(node, frame)
+        self.visit_include_with(node, frame, *include_with_args)
+
+    def visit_include_with(self, node, frame, template, context):
+        """
+        Handles ``include_with`` tags - the included template is rendered with
+        a new context of the declared variables, and its output is streamed in
+        to the including template in the same way as ``include``.
+        """
+        self.writeline("template = environment.get_template(", node)
+        self.visit(template, frame)
+        self.write(", %r)" % self.name)
+        loop = self.environment.is_async and "async for" or "for"
+        self.writeline("%s event in " % loop)
+        self.visit_include_with_events(node, frame, context)
+        self.write(":")
+        self.indent()
+        self.simple_write("event", frame)
+        self.outdent()
+
+    def visit_include_with_events(self, node, frame, context):
+        """
+        Writes the expression for the events rendered by an ``include_with``
+        tag's template.
+        """
+        self.write("template.root_render_func(template.new_context(")
+        self.visit(context, frame)
+        self.write("))")
+
+class ProfilingCodeGenerator(CodeGenerator):
+    """
+    Code generator for ``gn_django.template.profiler.ProfilingEnvironment``,
+    which times the rendering of ``include_with`` tags.
+    """
+
+    def visit_include_with_events(self, node, frame, context):
+        self.write("environment.profile_include_with(template, %r, " % self.name)
+        super(ProfilingCodeGenerator, self).visit_include_with_events(node, frame, context)
+        self.write(")")
@@ -2,9 +2,19 @@ from jinja2 import nodes, exceptions, runtime, environment
 from jinja2.ext import Extension
 from django.conf import settings as dj_settings
 from django.core import exceptions
+from django.core.cache import caches
+from django.core.cache.utils import make_template_fragment_key
+from django.core.signals import setting_changed
 from django.utils.safestring import mark_safe
+from markupsafe import escape
 
-import re, time, os
+from collections import OrderedDict
+from threading import Lock
+import asyncio, re, time, os, stat
+
+from gn_django.site import get_current_site
+
+SPACELESS_PATTERN = re.compile(r'>\s+<')
 
 class SpacelessExtension(Extension):
     """
@@ -15,6 +25,14 @@ class SpacelessExtension(Extension):
         https://github.com/coffin/coffin/blob/master/coffin/template/defaulttags.py
     Usage:
         ``{% spaceless %}fooo bar baz{% endspaceless %}``
+
+    Whitespace is stripped from the static markup in the block when the
+    template is parsed.  Blocks containing only static markup are output as a
+    constant; otherwise whitespace around dynamic output is stripped from the
+    rendered block at runtime.
+
+    In async environments the rendered block is awaited before whitespace is
+    stripped.
     """
 
     tags = set(['spaceless'])
@@ -22,19 +40,65 @@ class SpacelessExtension(Extension):
     def parse(self, parser):
         lineno = next(parser.stream).lineno
         body = parser.parse_statements(['name:endspaceless'], drop_needle=True)
+        for node in body:
+            self._strip_static_spaces(node)
+        if self._is_static(body):
+            # Data split by comments or whitespace control is stripped
+            # separately, so strip again across the joins
+            data = ''.join(child.data for node in body for child in node.nodes)
+            data = SPACELESS_PATTERN.sub('><', data.strip())
+            return nodes.Output([nodes.TemplateData(data)]).set_lineno(lineno)
         return nodes.CallBlock(
             self.call_method('_strip_spaces', [], [], None, None),
             [], [], body,
         ).set_lineno(lineno)
 
+    def _strip_static_spaces(self, node):
+        """
+        Strip whitespace between tags in the static template data of a node and
+        its children.  Macros, ``set`` blocks and ``filter`` blocks are left
+        alone, as their output may be used outside of the spaceless block or
+        depend on its whitespace.
+        """
+        if isinstance(node, nodes.TemplateData):
+            node.data = SPACELESS_PATTERN.sub('><', node.data)
+            return
+        if isinstance(node, (nodes.Macro, nodes.AssignBlock, nodes.FilterBlock)):
+            return
+        for child in node.iter_child_nodes():
+            self._strip_static_spaces(child)
+
+    def _is_static(self, body):
+        """
+        Check whether a block body contains only static template data.
+        """
+        for node in body:
+            if not isinstance(node, nodes.Output):
+                return False
+            for child in node.nodes:
+                if not isinstance(child, nodes.TemplateData):
+                    return False
+        return True
+
     def _strip_spaces(self, caller=None):
-        return re.sub(r'>\s+<', '><', caller().strip())
+        if self.environment.is_async:
+            return self._strip_spaces_async(caller)
+        return SPACELESS_PATTERN.sub('><', caller().strip())
+
+    async def _strip_spaces_async(self, caller):
+        return SPACELESS_PATTERN.sub('><', (await caller()).strip())
 
 class IncludeWithExtension(Extension):
     """
     Includes a template with an explicitly declared context.
     Usage:
         ``{% include_with 'sometemplate.j2' foo='bar', hello=['world'] %}``
+
+    Environments using ``gn_django.template.compiler.CodeGenerator`` compile
+    the tag so that the included template's output is streamed in to the
+    including template, like ``include``.  Otherwise the included template is
+    rendered to a string by ``_render()``, or with ``render_async()`` in async
+    environments.
     """
 
     tags = set(['include_with'])
@@ -65,7 +129,10 @@ class IncludeWithExtension(Extension):
         Returns:
             - The parsed template
         """
-        return self.environment.get_template(template).render(context)
+        template = self.environment.get_template(template)
+        if self.environment.is_async:
+            return template.render_async(context)
+        return template.render(context)
 
     def _get_params(self, parser):
         """
@@ -105,6 +172,9 @@ class StaticLinkExtension(Extension):
         - ``{% css '[name]' %}``    - Link to a stylesheet in the assets directory.
         - ``{% js '[name]' %}``     - Link to a script in the assets directory.
         - ``{% load_compilers %}``  - Prepare front end compilation for preprocessors.
+
+    The output of each tag is built once per asset name and then reused, until
+    django settings change.
     """
 
     tags = set(['css', 'js', 'load_compilers'])
@@ -120,6 +190,56 @@ class StaticLinkExtension(Extension):
 
         return nodes.CallBlock(call, [], [], [], lineno=first.lineno)
 
+    def __init__(self, environment):
+        super(StaticLinkExtension, self).__init__(environment)
+        # Rendered tag output, keyed by tag and asset name
+        self._tag_cache = {}
+        setting_changed.connect(self._clear_tag_cache)
+
+    def _clear_tag_cache(self, **kwargs):
+        """
+        Forget rendered tag output when django settings change, as the output
+        depends on the ``DEBUG``, ``STATIC*`` and ``STATICLINK_*`` settings.
+        """
+        self._tag_cache.clear()
+
+    def _get_cached_tag(self, tag, name=None):
+        """
+        Get the rendered output for a tag, building it the first time that the
+        tag is rendered for an asset name.
+
+        Params:
+            - `tag` - The tag name, e.g. `css`
+            - `name` - The name of the asset, if the tag takes one
+        """
+        key = (tag, name)
+        try:
+            return self._tag_cache[key]
+        except KeyError:
+            pass
+        if name is None:
+            output = getattr(self, '_build_%s' % tag)()
+        else:
+            output = getattr(self, '_build_%s' % tag)(name)
+        self._tag_cache[key] = output
+        return output
+
+    def _static(self, path):
+        """
+        Get the (escaped, if autoescaping) URL of a static file, using the
+        environment's `static` global.
+
+        Params:
+            - `path` - The path of the file in the static directory
+        """
+        url = self.environment.globals['static'](path)
+        autoescape = self.environment.autoescape
+        if callable(autoescape):
+            autoescape = autoescape(None)
+        if autoescape:
+            url = escape(url)
+        return url
+
     def _css(self, name, caller):
         """
         Render link tags for stylesheets. If debug mode is enabled this will be
@@ -129,14 +249,16 @@ class StaticLinkExtension(Extension):
             - `name` - The name of the file
             - `caller` - Required by Jinja
         """
+        return self._get_cached_tag('css', name)
+
+    def _build_css(self, name):
         ext = 'css'
         if self._is_debug(ext):
             ext = self._get_preprocessor(ext)
         file_dir = self._get_file_dir(ext)
+        url = self._static("%s/%s.%s" % (file_dir, name, ext))
 
-        template = '<link href="{{ static("%s/%s.%s") }}?v=%s" rel="stylesheet" type="text/%s" />' % (file_dir, name, ext, self._get_version(), ext)
-
-        return self.environment.from_string(template).render()
+        return '<link href="%s?v=%s" rel="stylesheet" type="text/%s" />' % (url, self._get_version(), ext)
 
     def _js(self, name, caller):
         """
@@ -146,12 +268,15 @@ class StaticLinkExtension(Extension):
             - `name` - The name of the file
             - `caller` - Required by Jinja
         """
+        return self._get_cached_tag('js', name)
+
+    def _build_js(self, name):
         ext = 'js'
         file_dir = self._get_file_dir(ext)
         script_type = 'application/javascript'
-        template = '<script src="{{ static("%s/%s.%s") }}?v=%s" type="%s"></script>' % (file_dir, name, ext, self._get_version(), script_type)
+        url = self._static("%s/%s.%s" % (file_dir, name, ext))
 
-        return self.environment.from_string(template).render()
+        return '<script src="%s?v=%s" type="%s"></script>' % (url, self._get_version(), script_type)
 
     def _load_compilers(self, caller):
         """
@@ -160,21 +285,23 @@ class StaticLinkExtension(Extension):
         Params:
             - `caller` - Required by Jinja
         """
+        return self._get_cached_tag('load_compilers')
 
+    def _build_load_compilers(self):
         debug = dj_settings.DEBUG
-        template = ''
+        output = ''
 
         if hasattr(dj_settings, 'STATICLINK_CLIENT_COMPILERS'):
             for ext in dj_settings.STATICLINK_CLIENT_COMPILERS:
                 if self._is_debug(ext):
                     debug = True
                     compiler = dj_settings.STATICLINK_CLIENT_COMPILERS[ext]
-                    template = '%s\n<script src="%s"></script>' % (template, compiler)
+                    output = '%s\n<script src="%s"></script>' % (output, compiler)
 
         if debug:
-            template = "%s\n<script>localStorage.clear();</script>" % template
+            output = "%s\n<script>localStorage.clear();</script>" % output
 
-        return self.environment.from_string(template).render()
+        return output
 
     def _is_debug(self, ext):
         """
@@ -235,17 +362,136 @@ class IncludeRawExtension(Extension):
     Params:
         - `path/to/file.css` - Relative path to the file within a directory
            defined in the `STATICFILES_DIRS` setting.
+
+    Resolved paths and file contents are cached in memory.  Cached contents are
+    revalidated against the file's mtime and size on each render, and the least
+    recently used files are evicted when the `INCLUDE_RAW_CACHE_SIZE` byte
+    budget is exceeded.  If the `INCLUDE_RAW_INLINE` setting is `True`, files
+    included by a literal path are inlined in to the template when it is
+    compiled - changes to those files will then need the template recompiled.
+    Files are never inlined when the environment has a bytecode cache, as
+    cached bytecode is only checked against the template's own source.
+
+    In async environments files which aren't cached are read in the event
+    loop's default executor, so that renders don't block the loop on disk IO.
     """
 
     tags = set(['include_raw'])
 
+    def __init__(self, environment):
+        super(IncludeRawExtension, self).__init__(environment)
+        self._paths = {}
+        self._files = OrderedDict()
+        self._cached_bytes = 0
+        self._lock = Lock()
+        setting_changed.connect(self._clear_cache)
+
     def parse(self, parser):
         first = parser.parse_expression()
         path = parser.parse_expression()
+        if isinstance(path, nodes.Const) and self._can_inline():
+            contents = self._load_file(path.value)
+            return nodes.Output([nodes.TemplateData(contents)], lineno=first.lineno)
         call = self.call_method('_get_file', [path], lineno=first.lineno)
         return nodes.CallBlock(call, [], [], [], lineno=first.lineno)
 
-    def _get_file(self, path, caller):
+    def _can_inline(self):
+        """
+        Whether files can be inlined in to compiled templates.  Bytecode
+        caches would keep serving inlined contents after the files change, so
+        inlining is disabled when there is one.
+        """
+        if self.environment.bytecode_cache is not None:
+            return False
+        return getattr(dj_settings, 'INCLUDE_RAW_INLINE', False)
+
+    def _clear_cache(self, **kwargs):
+        """
+        Forget resolved paths and file contents, e.g. when `STATICFILES_DIRS`
+        changes.
+        """
+        with self._lock:
+            self._paths.clear()
+            self._files.clear()
+            self._cached_bytes = 0
+
+    def _find_file(self, path):
+        """
+        Find a file in the `STATICFILES_DIRS` directories, remembering where it
+        was found.
+
+        Params:
+            - `path` - The path to the file
+
+        Returns a pair of the absolute path and `os.stat` result for the file,
+        or `(None, None)` if it could not be found
+        """
+        if path in self._paths:
+            fp = self._paths[path]
+            if fp is None:
+                return None, None
+            try:
+                return fp, os.stat(fp)
+            except OSError:
+                # The file has gone away; look for it again
+                self._paths.pop(path, None)
+
+        for static_dir in getattr(dj_settings, 'STATICFILES_DIRS', ()):
+            fp = os.path.join(static_dir, path)
+            try:
+                file_stat = os.stat(fp)
+            except OSError:
+                continue
+            if stat.S_ISREG(file_stat.st_mode):
+                self._paths[path] = fp
+                return fp, file_stat
+
+        # Remember misses outside of debug mode, when files aren't expected
+        # to appear
+        if not dj_settings.DEBUG:
+            self._paths[path] = None
+        return None, None
+
+    def _cache_file(self, fp, version, output, size):
+        """
+        Cache the contents of a file, evicting the least recently used files
+        to stay within the `INCLUDE_RAW_CACHE_SIZE` byte budget.
+        """
+        budget = getattr(dj_settings, 'INCLUDE_RAW_CACHE_SIZE', 1024 * 1024)
+        if size > budget:
+            return
+        with self._lock:
+            previous = self._files.pop(fp, None)
+            if previous:
+                self._cached_bytes -= previous[2]
+            while self._files and self._cached_bytes + size > budget:
+                evicted_version, evicted_output, evicted_size = self._files.popitem(last=False)[1]
+                self._cached_bytes -= evicted_size
+            self._files[fp] = (version, output, size)
+            self._cached_bytes += size
+
+    def _get_cached_file(self, fp, version):
+        """
+        Get the cached contents of a file, if they are cached for the current
+        version of the file.
+        """
+        with self._lock:
+            cached = self._files.get(fp)
+            if cached is not None and cached[0] == version:
+                self._files.move_to_end(fp)
+                return cached[1]
+        return None
+
+    def _read_file(self, fp, version, size):
+        """
+        Read the contents of a file and cache them.
+        """
+        with open(fp, 'r') as f:
+            output = f.read()
+        self._cache_file(fp, version, output, size)
+        return output
+
+    def _get_file(self, path, caller=None):
         """
         Check if a file exists an the specified path, and if so then open it and
         render the contents.
@@ -254,15 +500,187 @@ class IncludeRawExtension(Extension):
             - `path` - The path to the file
             - `caller` - Required by Jinja
         """
-        output = ''
+        return self._load_file(path, self.environment.is_async)
+
+    def _load_file(self, path, in_executor=False):
+        """
+        Get the contents of a file, from the cache if possible.
+
+        Params:
+            - `path` - The path to the file
+            - `in_executor` - Whether to read uncached files in the event
+              loop's default executor, returning an awaitable
+        """
+        fp, file_stat = self._find_file(path)
+        if fp is None:
+            return ''
+
+        version = (file_stat.st_mtime, file_stat.st_size)
+        output = self._get_cached_file(fp, version)
+        if output is not None:
+            return output
+
+        if in_executor:
+            loop = asyncio.get_event_loop()
+            return loop.run_in_executor(None, self._read_file, fp, version, file_stat.st_size)
+        return self._read_file(fp, version, file_stat.st_size)
+
+def make_fragment_cache_key(fragment_name, vary_on=None, site=None):
+    """
+    Build the cache key of a fragment cached by the `cache` tag, e.g. to
+    invalidate it.  Without a site, this is the same key as django's
+    `make_template_fragment_key()`.
+
+    Params:
+        - `fragment_name` - The fragment name given to the tag
+        - `vary_on` - The values that the fragment varies on
+        - `site` - The site that the fragment was rendered for
+    """
+    cache_key = make_template_fragment_key(fragment_name, vary_on)
+    if site is None:
+        return cache_key
+    return '%s.%s' % (cache_key, site)
 
-        if hasattr(dj_settings, 'STATICFILES_DIRS'):
-            for static_dir in dj_settings.STATICFILES_DIRS:
-                fp = os.path.join(static_dir, path)
-                if os.path.isfile(fp):
-                    f = open(fp, 'r')
-                    output = f.read()
-                    f.close()
-                    break
+class FragmentCacheExtension(Extension):
+    """
+    Caches the rendered output of a block of template for a number of seconds.
+    This replaces django-jinja's `cache` tag, with the same syntax and cache
+    keys, except that cache keys also vary on the current site.
+
+    Usage:
+        ``{% cache 300 'sidebar' user.pk %}...{% endcache %}``
 
+    Params:
+        - `300` - The number of seconds to cache the output for, or `None` to
+          cache it until it's evicted.
+        - `'sidebar'` - The name of the fragment.  Fragments of the same name
+          in different templates share a cache entry.
+        - `user.pk` - Any number of values that the fragment varies on, which
+          may be separated by commas.
+
+    Cache keys are built with `make_fragment_cache_key()`, which can also be
+    used to invalidate a fragment.
+
+    Fragments are stored in the django cache named by the
+    `FRAGMENT_CACHE_ALIAS` setting, which defaults to `default`.  To protect
+    against stampedes, fragments are stored for longer than their timeout.
+    Once a fragment is stale, one render takes a lock and re-renders it
+    while other renders keep using the stale output.  The lock expires after
+    `FRAGMENT_CACHE_LOCK_TIMEOUT` seconds, which defaults to 30.
+
+    Cache hits, misses, stale hits and recomputes are counted, and can be
+    read with `stats()`.
+    """
+
+    tags = set(['cache'])
+
+    def __init__(self, environment):
+        super(FragmentCacheExtension, self).__init__(environment)
+        self.counters = {'hits': 0, 'misses': 0, 'stale_hits': 0, 'recomputes': 0}
+        self._lock = Lock()
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        timeout = parser.parse_expression()
+        if parser.stream.current.test('block_end'):
+            parser.fail('`cache` tag must have a fragment name', lineno=lineno)
+        fragment_name = parser.parse_expression()
+        vary_on = []
+        while not parser.stream.current.test('block_end'):
+            parser.stream.skip_if('comma')
+            vary_on.append(parser.parse_expression())
+        body = parser.parse_statements(['name:endcache'], drop_needle=True)
+        call = self.call_method(
+            '_cache_fragment', [timeout, fragment_name, nodes.List(vary_on)], lineno=lineno
+        )
+        return nodes.CallBlock(call, [], [], body).set_lineno(lineno)
+
+    def stats(self):
+        """
+        Get the hit, miss, stale hit and recompute counters.
+
+        Returns a mapping of counter name to count
+        """
+        with self._lock:
+            return dict(self.counters)
+
+    def _count(self, counter):
+        with self._lock:
+            self.counters[counter] += 1
+
+    def _get_backend(self):
+        return caches[getattr(dj_settings, 'FRAGMENT_CACHE_ALIAS', 'default')]
+
+    def _get_cache_key(self, fragment_name, vary_on):
+        """
+        Build the cache key for a fragment for the current site.
+
+        Params:
+            - `fragment_name` - The fragment name given to the tag
+            - `vary_on` - The values that the fragment varies on
+        """
+        return make_fragment_cache_key(fragment_name, vary_on, get_current_site())
+
+    def _get_cached(self, backend, cache_key):
+        """
+        Get a cached fragment, if it can be used.
+
+        Returns the fragment output, or None if the fragment needs to be
+        rendered.  Values which aren't ``(expires, output)`` pairs are
+        ignored, and overwritten by the render.  A stale fragment is returned unless this render has taken
+        the lock to recompute it.
+        """
+        cached = backend.get(cache_key)
+        if not isinstance(cached, (tuple, list)) or len(cached) != 2:
+            # Nothing is cached, or the value was left by django-jinja's
+            # `cache` tag, which shares keys but stores plain output
+            self._count('misses')
+            return None
+        expires, output = cached
+        if expires is None or expires > time.time():
+            self._count('hits')
+            return output
+        lock_timeout = getattr(dj_settings, 'FRAGMENT_CACHE_LOCK_TIMEOUT', 30)
+        if backend.add('%s:lock' % cache_key, 1, lock_timeout):
+            self._count('recomputes')
+            return None
+        self._count('stale_hits')
+        return output
+
+    def _set_cached(self, backend, cache_key, timeout, output):
+        """
+        Store a rendered fragment, keeping it past its timeout so that it can
+        be served while it's recomputed.
+        """
+        output = str(output)
+        if timeout is None:
+            backend.set(cache_key, (None, output), None)
+        else:
+            lock_timeout = getattr(dj_settings, 'FRAGMENT_CACHE_LOCK_TIMEOUT', 30)
+            backend.set(cache_key, (time.time() + timeout, output), timeout + lock_timeout)
+        backend.delete('%s:lock' % cache_key)
         return output
+
+    def _cache_fragment(self, timeout, fragment_name, vary_on, caller):
+        """
+        Render a block of template, or get its output from the cache.
+
+        Params:
+            - `timeout` - The number of seconds to cache the output for
+            - `fragment_name` - The fragment name
+            - `vary_on` - The values that the fragment varies on
+            - `caller` - Renders the block
+        """
+        if timeout is not None:
+            timeout = int(timeout)
+        backend = self._get_backend()
+        cache_key = self._get_cache_key(fragment_name, vary_on)
+        output = self._get_cached(backend, cache_key)
+        if output is not None:
+            return output
+        if self.environment.is_async:
+            return self._render_fragment_async(backend, cache_key, timeout, caller)
+        return self._set_cached(backend, cache_key, timeout, caller())
+
+    async def _render_fragment_async(self, backend, cache_key, timeout, caller):
+        return self._set_cached(backend, cache_key, timeout, await caller())
@@ -4,18 +4,65 @@ functionality.
 """
 
 from collections import OrderedDict
+from types import MappingProxyType
 
 from django.utils import six
 from django.utils.module_loading import import_string
 from django.core.exceptions import ImproperlyConfigured
 from jinja2.loaders import BaseLoader, TemplateNotFound, iteritems, FileSystemLoader
+from jinja2.utils import LRUCache
 import re
+import time
+
+from .manifest import ManifestFileSystemLoader, load_template_manifest
 
 """
 Cached store of FileSystemLoader instanced, with template directories as keys
 """
 file_system_loaders = {}
 
+"""
+Cached store of the template names in each template directory, with template
+directories as keys
+"""
+directory_listings = {}
+
+def list_loader_templates(loader):
+    """
+    List the templates that a loader can load.  The listings of filesystem
+    loaders are cached per directory, so that directories shared between
+    hierarchies are only walked once.  Listings are kept until they're cleared
+    with ``clear_directory_listings()``.
+
+    Args:
+      * `loader` - the jinja loader object
+
+    Returns a sorted list of template names
+    """
+    searchpath = getattr(loader, 'searchpath', None)
+    if not isinstance(loader, FileSystemLoader) or len(searchpath) != 1:
+        return loader.list_templates()
+    template_dir = searchpath[0]
+    templates = directory_listings.get(template_dir)
+    if templates is None:
+        templates = tuple(loader.list_templates())
+        directory_listings[template_dir] = templates
+    return list(templates)
+
+def clear_directory_listings(template_dir=None):
+    """
+    Forget cached template directory listings, e.g. after templates have been
+    added or removed on disk.
+
+    Args:
+      * `template_dir` - string - the directory to forget the listing of.  If
+        this is not given, all listings are forgotten.
+    """
+    if template_dir is None:
+        directory_listings.clear()
+    else:
+        directory_listings.pop(template_dir, None)
+
 class DjangoTemplateNotFound(TemplateNotFound):
     """
     Adds a `tried` attribute to our `TemplateNotFound` exception - which allows
@@ -32,6 +79,18 @@ class JinjaOrigin(object):
         self.loader_name = loader.__class__.__name__
         self.name = name
 
+class TemplateMiss(object):
+    """
+    A negative entry in a ``HierarchyLoader`` resolution cache - records the
+    locations that were tried when a template could not be found so that
+    subsequent lookups can fail without probing the loaders again, until the
+    entry expires.
+    """
+
+    def __init__(self, tried, expires):
+        self.tried = tried
+        self.expires = expires
+
 
 class HierarchyLoader(BaseLoader):
     """
@@ -83,9 +142,19 @@ class HierarchyLoader(BaseLoader):
 
     Will find ``bar.html`` by querying the loaders sequentially from ``eurogamer_net``
     to ``core``.
+
+    Template lookups are memoised in a resolution cache which maps each template
+    identifier - which encodes its lookup mode - to the loader in the hierarchy
+    which yielded the template, or records that the template could not be found
+    at all.  A
+    warm lookup therefore only probes the winning loader.  Templates which
+    could not be found are probed again once ``miss_ttl`` seconds have passed,
+    so that templates added on disk are eventually picked up.  The resolution
+    cache is bypassed when the jinja environment has ``auto_reload`` enabled,
+    and can be reset with ``clear_resolution_cache()``.
     """
 
-    def __init__(self, hierarchy, delimiter=':'):
+    def __init__(self, hierarchy, delimiter=':', resolution_cache_size=1000, miss_ttl=60):
         """
         Args:
           * `hierarchy` - OrderedDict - ordered dict with keys as template
@@ -95,6 +164,12 @@ class HierarchyLoader(BaseLoader):
             contain the ``delimiter``
           * `delimiter` - string - the namespace delimiter string to use when
             separating namespace from template identifier
+          * `resolution_cache_size` - int - the maximum number of template
+            resolutions (found and missing) to remember.  Set to ``0`` or
+            ``None`` to disable the resolution cache.
+          * `miss_ttl` - int - the number of seconds to remember that a
+            template could not be found for.  Set to ``None`` to remember
+            misses until the resolution cache is cleared.
         """
         if not isinstance(hierarchy, OrderedDict):
             raise TypeError("HierarchyLoader must be called with a \
@@ -108,6 +183,98 @@ class HierarchyLoader(BaseLoader):
 
         self.hierarchy = hierarchy
         self.delimiter = delimiter
+        self.identifier_pattern = re.compile(
+            r'^(?:(?P<namespace>.*?)(?P<parent>_parent)?%s)?(?P<name>.*)$' % re.escape(delimiter),
+            re.DOTALL
+        )
+        self.loader_index = self.build_loader_index()
+        self.resolution_cache = None
+        if resolution_cache_size:
+            self.resolution_cache = LRUCache(resolution_cache_size)
+        self.miss_ttl = miss_ttl
+
+    def clear_resolution_cache(self):
+        """
+        Forget all memoised template resolutions, e.g. after templates have
+        been added or removed on disk.
+        """
+        if self.resolution_cache is not None:
+            self.resolution_cache.clear()
+
+    def get_template_identifiers(self, template_name, loader_name=None):
+        """
+        Get the template identifiers which can resolve to a template name, in
+        the sequential, namespace and ancestor lookup formats.
+
+        Args:
+          * `template_name` - string - the template name within a loader
+          * `loader_name` - string - optional name of a loader in the
+            hierarchy.  When given, only the identifiers whose resolution
+            can involve that loader are returned.
+        """
+        identifiers = [template_name]
+        for name in self.hierarchy:
+            if loader_name is None or name == loader_name:
+                identifiers.append(name + self.delimiter + template_name)
+            if loader_name is None or loader_name in self.get_ancestor_loader_names(name):
+                identifiers.append(name + "_parent" + self.delimiter + template_name)
+        return identifiers
+
+    def forget_template(self, template_name, loader_name=None):
+        """
+        Forget the memoised resolutions of a template name, e.g. after a
+        template of that name has been added to or removed from a loader's
+        directory on disk.
+
+        Args:
+          * `template_name` - string - the template name within a loader
+          * `loader_name` - string - optional name of the loader whose
+            templates changed.  When given, only the resolutions which can
+            involve that loader are forgotten.
+        """
+        if self.resolution_cache is None:
+            return
+        for identifier in self.get_template_identifiers(template_name, loader_name):
+            self.forget_resolution(identifier)
+
+    def build_loader_index(self):
+        """
+        Build an immutable index of the loader names to try for each lookup
+        mode and namespace, so that template lookups don't need to work out
+        the loader ancestry each time.
+
+        **Note:** The index is built from the hierarchy at instantiation time;
+        the hierarchy should not be modified afterwards.
+
+        Returns a read-only mapping with keys as ``(loading_mode, namespace)``
+        pairs and values as tuples of loader names
+        """
+        loader_names = tuple(self.hierarchy)
+        index = {("sequential", None): loader_names}
+        for i, name in enumerate(loader_names):
+            index[("namespace", name)] = (name,)
+            index[("ancestor", name)] = loader_names[i+1:]
+        return MappingProxyType(index)
+
+    def parse_template_identifier(self, template):
+        """
+        Split a template identifier in to its loading mode, namespace and
+        template name.  e.g. ``eurogamer_parent:base.html`` yields
+        ``("ancestor", "eurogamer", "base.html")``.
+
+        Args:
+          * `template` - string - the template identifier
+
+        Returns a tuple of loading mode, namespace (or None for sequential
+        lookups) and template name
+        """
+        match = self.identifier_pattern.match(template)
+        namespace = match.group('namespace')
+        if namespace is None:
+            return "sequential", None, template
+        if match.group('parent'):
+            return "ancestor", namespace, match.group('name')
+        return "namespace", namespace, match.group('name')
 
     def identify_loading_mode(self, template_name):
         """
@@ -118,61 +285,66 @@ class HierarchyLoader(BaseLoader):
           * `template_name` - string - the template name to identify the loading
             mode for.
         """
-        if self.delimiter in template_name and "_parent:" in template_name:
-            return "ancestor"
-        if self.delimiter in template_name:
-            return "namespace"
-        return "sequential"
+        return self.parse_template_identifier(template_name)[0]
 
     def get_ancestor_loader_names(self, child):
         """
-        Get a list of ancestor loaders to try, in order of closest relative to
+        Get a tuple of ancestor loaders to try, in order of closest relative to
         most distant.
         """
-        # Get a list of loader keys
-        all_loaders = list(self.hierarchy)
         try:
-            child_index = all_loaders.index(child)
-        except ValueError:
-            raise TemplateNotFound()
-        return all_loaders[child_index+1:]
+            return self.loader_index[("ancestor", child)]
+        except KeyError:
+            raise TemplateNotFound(child)
 
-    def get_ancestor_source(self, environment, template, tried):
+    def find_source(self, environment, template, tried):
         """
-        Given a template identifier of format `<loader>_parent:foo.html` find the
-        template by going through the loaders above it sequentially until it is
-        found.
+        Find the template source for a template identifier by trying the
+        loaders for its loading mode in turn.
 
         Args:
           * `environment` - the jinja environment object
-          * `template` - the template name to look up
+          * `template` - the template identifier to look up
           * `tried` - ref to iterable of tried paths
 
         Raises `TemplateNotFound`
-        Returns an instantiated template
+        Returns a tuple of the winning loader name, the template name within
+        that loader and the template source
         """
+        loading_mode, namespace, template_name = self.parse_template_identifier(template)
         try:
-            prefix, template_name = template.split(self.delimiter, 1)
-        except ValueError:
+            loader_names = self.loader_index[(loading_mode, namespace)]
+        except KeyError:
             raise TemplateNotFound(template)
-        try:
-            child = prefix.split("_parent", 1)[0]
-        except ValueError:
-            raise TemplateNotFound(template)
-        # Work out a flat list of the loader's ancestry to iterate through
-        loader_ancestry = self.get_ancestor_loader_names(child)
-        # For each loader in the ancestry, try to get the template and return it
-        for loader_name in loader_ancestry:
+        for loader_name in loader_names:
             loader = self.hierarchy[loader_name]
             try:
-                return loader.get_source(environment, template_name)
+                source = loader.get_source(environment, template_name)
             except TemplateNotFound:
-                loader_path = "%s/%s" % (loader.searchpath[0], template)
-                origin = JinjaOrigin(loader, loader_path)
-                tried.append([origin, "Source does not exist"])
+                if loading_mode != "namespace":
+                    loader_path = "%s/%s" % (loader.searchpath[0], template)
+                    origin = JinjaOrigin(loader, loader_path)
+                    tried.append([origin, "Source does not exist"])
                 continue
+            return loader_name, template_name, source
         raise TemplateNotFound(template)
 
+    def get_ancestor_source(self, environment, template, tried):
+        """
+        Given a template identifier of format `<loader>_parent:foo.html` find the
+        template by going through the loaders above it sequentially until it is
+        found.
+
+        Args:
+          * `environment` - the jinja environment object
+          * `template` - the template name to look up
+          * `tried` - ref to iterable of tried paths
+
+        Raises `TemplateNotFound`
+        Returns an instantiated template
+        """
+        return self.find_source(environment, template, tried)[2]
+
     def get_namespace_source(self, environment, template, tried):
         """
         Given a template identifier of format `<loader>:foo.html` find the
@@ -187,15 +359,7 @@ class HierarchyLoader(BaseLoader):
         Raises `TemplateNotFound`
         Returns an instantiated template
         """
-        try:
-            loader_name, template_name = template.split(self.delimiter, 1)
-        except ValueError:
-            raise TemplateNotFound(template)
-        try:
-            loader = self.hierarchy[loader_name]
-        except (KeyError):
-            raise TemplateNotFound(template)
-        return loader.get_source(environment, template_name)
+        return self.find_source(environment, template, tried)[2]
 
     def get_sequential_source(self, environment, template, tried):
         """
@@ -209,15 +373,54 @@ class HierarchyLoader(BaseLoader):
 
         Returns an instantiated template or None if it could not be found
         """
-        for loader_name, loader in self.hierarchy.items():
-            try:
-                return loader.get_source(environment, template)
-            except TemplateNotFound:
-                loader_path = "%s/%s" % (loader.searchpath[0], template)
-                origin = JinjaOrigin(loader, loader_path)
-                tried.append([origin, "Source does not exist"])
-                continue
-        return None
+        try:
+            return self.find_source(environment, template, tried)[2]
+        except TemplateNotFound:
+            return None
+
+    def get_cached_source(self, environment, cache_key):
+        """
+        Get the template source for a previously resolved template identifier
+        by probing only the loader that yielded it last time.
+
+        Args:
+          * `environment` - the jinja environment object
+          * `cache_key` - the resolution cache key for the template, i.e. the
+            template identifier
+
+        Raises `DjangoTemplateNotFound` if the template is known to be missing
+        Returns the template source, or None if there's no usable resolution
+        """
+        resolution = self.resolution_cache.get(cache_key)
+        if resolution is None:
+            return None
+        if isinstance(resolution, TemplateMiss):
+            if resolution.expires is None or time.monotonic() < resolution.expires:
+                raise DjangoTemplateNotFound(cache_key, tried=list(resolution.tried))
+            # The template may have been added since; resolve it afresh
+            self.forget_resolution(cache_key)
+            return None
+        loader_name, template_name = resolution
+        try:
+            return self.hierarchy[loader_name].get_source(environment, template_name)
+        except TemplateNotFound:
+            # The template has gone away from under us; resolve it afresh
+            self.forget_resolution(cache_key)
+            return None
+
+    def forget_resolution(self, cache_key):
+        """
+        Forget the memoised resolution of a template identifier, if there is
+        one.
+
+        Args:
+          * `cache_key` - the resolution cache key for the template, i.e. the
+            template identifier
+        """
+        try:
+            del self.resolution_cache[cache_key]
+        except KeyError:
+            pass
 
     def get_source(self, environment, template):
         """
@@ -229,32 +432,91 @@ class HierarchyLoader(BaseLoader):
           * `environment` - the jinja environment object
           * `template` - the template name to look up
         """
-        # Identify the loading mode from the template identifier
-        loading_mode = self.identify_loading_mode(template)
-        loading_method = getattr(self, "get_%s_source" % loading_mode)
+        cache_key = template
+        use_cache = self.resolution_cache is not None and not environment.auto_reload
+        if use_cache:
+            template_source = self.get_cached_source(environment, cache_key)
+            if template_source:
+                return template_source
+
         tried = []
-        template_source = None
         # Attempt to use the identified loading mode to get the template source
         try:
-            template_source = loading_method(environment, template, tried)
+            loader_name, template_name, template_source = self.find_source(
+                environment, template, tried)
         except TemplateNotFound:
-            pass
-
-        # Return the template source if we managed to look it up successfully,
-        # or raise a DjangoTemplateNotFound exception
-        if template_source:
-            return template_source
-        else:
+            # Record the miss so that it's not probed again, and raise a
+            # DjangoTemplateNotFound exception
+            if use_cache:
+                expires = None
+                if self.miss_ttl is not None:
+                    expires = time.monotonic() + self.miss_ttl
+                self.resolution_cache[cache_key] = TemplateMiss(tuple(tried), expires)
             raise DjangoTemplateNotFound(template, tried=tried)
 
+        if use_cache:
+            self.resolution_cache[cache_key] = (loader_name, template_name)
+        return template_source
+
     def list_templates(self):
         result = []
         for prefix, loader in iteritems(self.hierarchy):
-            for template in loader.list_templates():
+            for template in list_loader_templates(loader):
                 result.append(prefix + self.delimiter + template)
         return result
 
-def get_hierarchy_loader(directories):
+    def get_effective_templates(self):
+        """
+        Get the templates which sequential lookups resolve to, along with the
+        loader in the hierarchy which each template resolves from - i.e. the
+        hierarchy's templates with each layer overlaid on the ones below it.
+
+        Returns an ordered mapping, sorted by template name, with keys as
+        template names and values as loader names
+        """
+        effective = {}
+        for name in reversed(self.hierarchy):
+            for template in list_loader_templates(self.hierarchy[name]):
+                effective[template] = name
+        return OrderedDict(sorted(effective.items()))
+
+    def list_template_identifiers(self):
+        """
+        List every template identifier that can be resolved by this loader, in
+        all of the sequential, namespace and ancestor lookup formats.
+
+        Returns a sorted list of template identifiers
+        """
+        templates = OrderedDict(
+            (name, list_loader_templates(loader)) for name, loader in iteritems(self.hierarchy)
+        )
+        result = set()
+        for name, names in iteritems(templates):
+            for template in names:
+                result.add(template)
+                result.add(name + self.delimiter + template)
+            for ancestor in self.get_ancestor_loader_names(name):
+                for template in templates[ancestor]:
+                    result.add(name + "_parent" + self.delimiter + template)
+        return sorted(result)
+
+def get_manifest(manifest):
+    """
+    Resolve a template manifest argument to a ``TemplateManifest`` object.
+
+    Args:
+      * `manifest` - ``TemplateManifest``/string - either an instantiated
+        manifest or the path to a manifest file built by the
+        ``build_template_manifest`` command
+
+    Returns an instantiated ``TemplateManifest`` object, or None if there is no
+    manifest to use
+    """
+    if isinstance(manifest, six.string_types):
+        return load_template_manifest(manifest)
+    return manifest
+
+def get_hierarchy_loader(directories, manifest=None):
     """
     Helper to instantiate a `HierarchyLoader` from a hierarchy of named directories.
 
@@ -270,15 +532,23 @@ def get_hierarchy_loader(directories):
                 ("core", '/path/to/core'),
             )
         ```
+      * `manifest` - ``TemplateManifest``/string - optional template manifest
+        (or path to one) to resolve template names from, instead of probing the
+        filesystem.  If the manifest file does not exist, templates are loaded
+        from the filesystem as usual.
 
     Returns an instantiated `HierarchyLoader()` object
     """
+    manifest = get_manifest(manifest)
     template_loaders = OrderedDict()
     for app_name, template_dir in directories:
         # Pull FileSystemLoader from cache if it already exists for this directory,
         # or instanciate it if not
         if template_dir not in file_system_loaders:
-            loader = FileSystemLoader(template_dir)
+            if manifest is not None:
+                loader = ManifestFileSystemLoader(template_dir, manifest)
+            else:
+                loader = FileSystemLoader(template_dir)
             file_system_loaders[template_dir] = loader
         else:
             loader = file_system_loaders[template_dir]
@@ -324,7 +594,20 @@ class MultiHierarchyLoader(BaseLoader):
                 result.append(prefix + self.delimiter + template)
         return result
 
-def get_multi_hierarchy_loader(get_active_hierarchy_cb, hierarchies):
+    def get_effective_templates(self):
+        """
+        Get the templates which sequential lookups resolve to in each
+        hierarchy, along with the loader which each template resolves from.
+        See ``HierarchyLoader.get_effective_templates()``.
+
+        Returns a mapping with keys as hierarchy names and values as ordered
+        mappings of template name to loader name
+        """
+        return dict(
+            (name, loader.get_effective_templates()) for name, loader in iteritems(self.hierarchies)
+        )
+
+def get_multi_hierarchy_loader(get_active_hierarchy_cb, hierarchies, manifest=None):
     """
     Helper to instantiate a ``MultiHierarchyLoader`` from many named template
     directory hierarchies.
@@ -361,10 +644,13 @@ def get_multi_hierarchy_loader(get_active_hierarchy_cb, hierarchies):
                 )),
             )
         ```
+      * `manifest` - ``TemplateManifest``/string - optional template manifest
+        (or path to one) - see ``get_hierarchy_loader``
 
     Returns an instantiated ``MultiHierarchyLoader()`` object
     """
+    manifest = get_manifest(manifest)
     template_loaders = {}
     for hierarchy_name, directories in hierarchies:
-        template_loaders[hierarchy_name] = get_hierarchy_loader(directories)
+        template_loaders[hierarchy_name] = get_hierarchy_loader(directories, manifest)
     return MultiHierarchyLoader(get_active_hierarchy_cb, template_loaders)
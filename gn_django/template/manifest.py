@@ -0,0 +1,145 @@
+"""
+A manifest of the templates that live in each registered template directory,
+which can be built at deploy time so that template loaders can resolve
+template names in memory rather than probing the filesystem.
+"""
+
+import json
+import os
+
+from jinja2.loaders import FileSystemLoader, TemplateNotFound
+
+MANIFEST_VERSION = 2
+
+class TemplateManifest(object):
+    """
+    An index of template directories, mapping each template name within a
+    directory to the path of its source file.
+
+    Args:
+      * `directories` - mapping - mapping with keys as template directories and
+        values as mappings of template name to path
+    """
+
+    def __init__(self, directories):
+        self.directories = directories
+
+    @classmethod
+    def build(cls, directories):
+        """
+        Build a manifest by walking the given template directories.
+
+        Args:
+          * `directories` - iterable of template directory paths
+
+        Returns an instantiated ``TemplateManifest`` object
+        """
+        manifest = {}
+        for template_dir in directories:
+            manifest[template_dir] = dict(
+                (template, os.path.join(template_dir, *template.split('/')))
+                for template in FileSystemLoader(template_dir).list_templates()
+            )
+        return cls(manifest)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Load a manifest previously written with ``save()``.
+
+        Args:
+          * `path` - string - the path of the manifest file
+
+        Returns an instantiated ``TemplateManifest`` object
+        """
+        with open(path, 'r') as f:
+            data = json.load(f)
+        if data.get('version') != MANIFEST_VERSION:
+            raise ValueError("Template manifest '%s' has unsupported version '%s'" % (path, data.get('version')))
+        return cls(data['directories'])
+
+    def save(self, path):
+        """
+        Write the manifest to a file as JSON.
+
+        Args:
+          * `path` - string - the path of the manifest file
+        """
+        data = {
+            'version': MANIFEST_VERSION,
+            'directories': self.directories,
+        }
+        with open(path, 'w') as f:
+            json.dump(data, f, separators=(',', ':'), sort_keys=True)
+
+    def get_entries(self, template_dir):
+        """
+        Get the template entries for a template directory.
+
+        Args:
+          * `template_dir` - string - the template directory
+
+        Returns a mapping of template name to path, or None if the directory is
+        not in the manifest
+        """
+        return self.directories.get(template_dir)
+
+
+class ManifestFileSystemLoader(FileSystemLoader):
+    """
+    A ``FileSystemLoader`` which resolves template names from a
+    ``TemplateManifest``.  Templates which are not listed in the manifest for
+    the loader's directory are treated as missing without touching the
+    filesystem.  If the directory isn't covered by the manifest at all, the
+    loader behaves as a regular ``FileSystemLoader``.
+
+    Args:
+      * `searchpath` - string - the template directory
+      * `manifest` - ``TemplateManifest`` - the manifest to resolve names from
+    """
+
+    def __init__(self, searchpath, manifest, **kwargs):
+        super(ManifestFileSystemLoader, self).__init__(searchpath, **kwargs)
+        self.manifest = manifest
+        self.entries = manifest.get_entries(self.searchpath[0])
+
+    def get_source(self, environment, template):
+        if self.entries is None:
+            return super(ManifestFileSystemLoader, self).get_source(environment, template)
+        try:
+            filename = self.entries[template]
+        except KeyError:
+            raise TemplateNotFound(template)
+        try:
+            mtime = os.path.getmtime(filename)
+            with open(filename, 'rb') as f:
+                contents = f.read().decode(self.encoding)
+        except (IOError, OSError):
+            raise TemplateNotFound(template)
+
+        def uptodate():
+            try:
+                return os.path.getmtime(filename) == mtime
+            except OSError:
+                return False
+
+        return contents, filename, uptodate
+
+    def list_templates(self):
+        if self.entries is None:
+            return super(ManifestFileSystemLoader, self).list_templates()
+        return sorted(self.entries)
+
+def load_template_manifest(path):
+    """
+    Load a template manifest if one has been built at the given path.
+
+    Args:
+      * `path` - string - the path of the manifest file
+
+    Returns an instantiated ``TemplateManifest`` object, or None if there is no
+    manifest file
+    """
+    if not path or not os.path.isfile(path):
+        return None
+    return TemplateManifest.load(path)
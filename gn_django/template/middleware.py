@@ -0,0 +1,37 @@
+from django.conf import settings
+
+from .profiler import start_profile, stop_profile
+
+class TemplateProfilerMiddleware:
+    """
+    Middleware which profiles the templates rendered for each request, for
+    use with the ``profile`` option of the ``gn_django.template.backend.Jinja2``
+    backend.
+
+    A summary of the profile is added to responses in the
+    ``X-Template-Profile`` header.  If the ``TEMPLATE_PROFILE_LOG`` setting is
+    set, the full profile is appended to that file for aggregation with the
+    ``template_profile`` command.
+
+    *NOTE*: Streaming responses are rendered after the middleware has run, so
+    their render times are not included.
+    """
+
+    header = 'X-Template-Profile'
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        profile = start_profile()
+        try:
+            response = self.get_response(request)
+        finally:
+            stop_profile()
+
+        response[self.header] = profile.get_header_value()
+        log_path = getattr(settings, 'TEMPLATE_PROFILE_LOG', None)
+        if log_path and profile.records:
+            profile.save(log_path, request_path=request.path)
+
+        return response
@@ -0,0 +1,349 @@
+"""
+Opt-in profiling of template loading, compilation and rendering.
+
+Profiling is enabled by setting the ``profile`` option of the
+``gn_django.template.backend.Jinja2`` backend, which builds the jinja
+environment as a ``ProfilingEnvironment``.  Timings are only recorded while a
+profile is active - for a request, when ``TemplateProfilerMiddleware`` is
+installed, or within ``profile_templates()``.
+"""
+
+from contextlib import contextmanager
+from contextvars import ContextVar
+from time import perf_counter
+import json
+import os
+
+from jinja2 import Template as JinjaTemplate
+
+from .backend import Environment
+from .compiler import ProfilingCodeGenerator
+from .loaders import HierarchyLoader, MultiHierarchyLoader
+
+EVENTS = ('load', 'compile', 'render', 'include_with')
+
+# The profile recording in the current context - the current thread, or the
+# current asyncio task
+_active_profile = ContextVar('gn_django_template_profile', default=None)
+
+class RenderProfile(object):
+    """
+    The template timings recorded while a profile is active.  Each record is a
+    mapping with the keys:
+
+      * ``event`` - one of ``load``, ``compile``, ``render`` or ``include_with``
+      * ``template`` - the template name
+      * ``duration`` - the time taken, in seconds.  Load times include compile
+        time, and render times include the time taken to render any included
+        or extended templates.
+      * ``hit`` - for ``load`` events, whether the template came from the
+        environment's template cache
+      * ``loader`` - for ``load`` events which missed the template cache, the
+        name of the loader in the hierarchy which yielded the template
+      * ``parent`` - for ``include_with`` events, the including template name
+    """
+
+    def __init__(self):
+        self.records = []
+        self.compile_count = 0
+
+    def record(self, event, template, duration, **extra):
+        """
+        Record a timing.
+
+        Args:
+          * `event` - string - the event name
+          * `template` - string - the template name
+          * `duration` - float - the time taken, in seconds
+          * any other kwargs are added to the record
+        """
+        record = {'event': event, 'template': template, 'duration': duration}
+        record.update(extra)
+        self.records.append(record)
+
+    def totals(self):
+        """
+        Get the total time taken by each event.
+
+        Returns a mapping of event name to time in seconds
+        """
+        totals = dict((event, 0.0) for event in EVENTS)
+        for record in self.records:
+            totals[record['event']] += record['duration']
+        return totals
+
+    def get_header_value(self):
+        """
+        Get a summary of the profile for the ``X-Template-Profile`` response
+        header.
+        """
+        loads = [record for record in self.records if record['event'] == 'load']
+        misses = len([record for record in loads if not record['hit']])
+        totals = self.totals()
+        return "loads=%d; misses=%d; %s" % (len(loads), misses, "; ".join(
+            "%s=%.2fms" % (event, totals[event] * 1000) for event in EVENTS
+        ))
+
+    def save(self, path, **extra):
+        """
+        Append the profile to a log file as a line of JSON, for aggregation by
+        the ``template_profile`` command.
+
+        Args:
+          * `path` - string - the path of the log file
+          * any other kwargs are added to the logged profile, e.g. the request
+            path
+        """
+        data = dict(extra, records=self.records)
+        with open(path, 'a') as f:
+            f.write(json.dumps(data, separators=(',', ':')) + '\n')
+
+def get_active_profile():
+    """
+    Get the profile that is recording in the current context, if any.
+    """
+    return _active_profile.get()
+
+def start_profile():
+    """
+    Start recording template timings in the current context.  Asyncio tasks
+    started afterwards record in to the same profile, but a profile started
+    within a task doesn't affect the code which started it.
+
+    Returns the new ``RenderProfile`` object
+    """
+    profile = RenderProfile()
+    _active_profile.set(profile)
+    return profile
+
+def stop_profile():
+    """
+    Stop recording template timings in the current context.
+
+    Returns the ``RenderProfile`` object which was recording, if any
+    """
+    profile = get_active_profile()
+    _active_profile.set(None)
+    return profile
+
+@contextmanager
+def profile_templates():
+    """
+    Context manager which records template timings within its block, e.g.::
+
+        with profile_templates() as profile:
+            render_to_string('article.j2', context)
+        print(profile.totals())
+    """
+    profile = start_profile()
+    try:
+        yield profile
+    finally:
+        stop_profile()
+
+def aggregate_profile_log(path):
+    """
+    Aggregate the profiles logged to a file by ``RenderProfile.save()``.
+
+    Args:
+      * `path` - string - the path of the log file
+
+    Returns a list of mappings, one per event and template, with the keys
+    ``event``, ``template``, ``count``, ``total``, ``mean`` and ``max``.  Load
+    events also have ``hits`` - the number of template cache hits - and
+    ``loaders`` - a mapping of winning loader name to count.
+    """
+    stats = {}
+    with open(path, 'r') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            for record in json.loads(line)['records']:
+                key = (record['event'], record['template'])
+                stat = stats.get(key)
+                if stat is None:
+                    stat = stats[key] = {
+                        'event': record['event'],
+                        'template': record['template'],
+                        'count': 0,
+                        'total': 0.0,
+                        'max': 0.0,
+                    }
+                    if record['event'] == 'load':
+                        stat.update(hits=0, loaders={})
+                stat['count'] += 1
+                stat['total'] += record['duration']
+                stat['max'] = max(stat['max'], record['duration'])
+                if record['event'] == 'load':
+                    if record['hit']:
+                        stat['hits'] += 1
+                    elif record['loader'] is not None:
+                        stat['loaders'][record['loader']] = stat['loaders'].get(record['loader'], 0) + 1
+    for stat in stats.values():
+        stat['mean'] = stat['total'] / stat['count']
+    return list(stats.values())
+
+def get_winning_loader_name(loader, filename):
+    """
+    Get the name of the loader in a template hierarchy which holds a template
+    file.
+
+    Args:
+      * `loader` - the jinja loader object
+      * `filename` - string - the path of the template file
+
+    Returns the loader name, or None if it can't be determined
+    """
+    if isinstance(loader, MultiHierarchyLoader):
+        loader = loader.get_loader()
+    if not isinstance(loader, HierarchyLoader) or filename is None:
+        return None
+    for name, hierarchy_loader in loader.hierarchy.items():
+        for searchpath in getattr(hierarchy_loader, 'searchpath', ()):
+            if filename.startswith(os.path.join(searchpath, '')):
+                return name
+    return None
+
+def _time_events(profile, event, template, events, **extra):
+    """
+    Time a generator of template events, counting only the time spent
+    producing events so that time spent by a consumer of a stream isn't
+    included.
+    """
+    duration = 0.0
+    iterator = iter(events)
+    try:
+        while True:
+            start = perf_counter()
+            try:
+                value = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                duration += perf_counter() - start
+            yield value
+    finally:
+        profile.record(event, template, duration, **extra)
+
+async def _time_events_async(profile, event, template, events, **extra):
+    duration = 0.0
+    iterator = events.__aiter__()
+    try:
+        while True:
+            start = perf_counter()
+            try:
+                value = await iterator.__anext__()
+            except StopAsyncIteration:
+                return
+            finally:
+                duration += perf_counter() - start
+            yield value
+    finally:
+        profile.record(event, template, duration, **extra)
+
+class ProfilingTemplate(JinjaTemplate):
+    """
+    Jinja template class which records render times while a profile is
+    active.
+    """
+
+    def render(self, *args, **kwargs):
+        profile = get_active_profile()
+        # Async templates are timed by `render_async()`
+        if profile is None or self.environment.is_async:
+            return super(ProfilingTemplate, self).render(*args, **kwargs)
+        start = perf_counter()
+        try:
+            return super(ProfilingTemplate, self).render(*args, **kwargs)
+        finally:
+            profile.record('render', self.name, perf_counter() - start)
+
+    async def render_async(self, *args, **kwargs):
+        profile = get_active_profile()
+        if profile is None:
+            return await super(ProfilingTemplate, self).render_async(*args, **kwargs)
+        start = perf_counter()
+        try:
+            return await super(ProfilingTemplate, self).render_async(*args, **kwargs)
+        finally:
+            profile.record('render', self.name, perf_counter() - start)
+
+    def generate(self, *args, **kwargs):
+        events = super(ProfilingTemplate, self).generate(*args, **kwargs)
+        profile = get_active_profile()
+        if profile is None or self.environment.is_async:
+            return events
+        return _time_events(profile, 'render', self.name, events)
+
+class ProfilingEnvironment(Environment):
+    """
+    Jinja environment which records template load, compile and render times
+    while a profile is active.  Without an active profile, the only overhead
+    is a context variable lookup per template load, compile and render.
+
+    Compiled templates time the rendering of ``include_with`` tags, so
+    bytecode caches are never used - bytecode compiled by a profiling
+    environment can't be used by a regular one, or vice versa.  Bytecode
+    caches set on the environment after it's built, as django-jinja's
+    ``bytecode_cache`` option does, are ignored too.
+    """
+
+    code_generator_class = ProfilingCodeGenerator
+    template_class = ProfilingTemplate
+
+    def __init__(self, **kwargs):
+        kwargs.pop('bytecode_bundle', None)
+        super(ProfilingEnvironment, self).__init__(**kwargs)
+
+    @property
+    def bytecode_cache(self):
+        return None
+
+    @bytecode_cache.setter
+    def bytecode_cache(self, bytecode_cache):
+        pass
+
+    def _load_template(self, name, globals):
+        profile = get_active_profile()
+        if profile is None:
+            return super(ProfilingEnvironment, self)._load_template(name, globals)
+        cached = self.cache is not None and self.get_template_cache_key(name) in self.cache
+        compile_count = profile.compile_count
+        start = perf_counter()
+        template = super(ProfilingEnvironment, self)._load_template(name, globals)
+        duration = perf_counter() - start
+        # A cached template which had to be recompiled was out of date
+        hit = cached and profile.compile_count == compile_count
+        loader = None
+        if not hit:
+            loader = get_winning_loader_name(self.loader, template.filename)
+        profile.record('load', name, duration, hit=hit, loader=loader)
+        return template
+
+    def compile(self, source, name=None, filename=None, raw=False, defer_init=False):
+        profile = get_active_profile()
+        if profile is None:
+            return super(ProfilingEnvironment, self).compile(source, name, filename, raw, defer_init)
+        profile.compile_count += 1
+        start = perf_counter()
+        try:
+            return super(ProfilingEnvironment, self).compile(source, name, filename, raw, defer_init)
+        finally:
+            profile.record('compile', name, perf_counter() - start)
+
+    def profile_include_with(self, template, parent, events):
+        """
+        Time the rendering of an ``include_with`` tag.  Called by templates
+        compiled with ``ProfilingCodeGenerator``.
+
+        Args:
+          * `template` - the included template
+          * `parent` - string - the name of the including template
+          * `events` - the events rendered by the included template
+        """
+        profile = get_active_profile()
+        if profile is None:
+            return events
+        if self.is_async:
+            return _time_events_async(profile, 'include_with', template.name, events, parent=parent)
+        return _time_events(profile, 'include_with', template.name, events, parent=parent)
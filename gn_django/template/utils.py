@@ -1,7 +1,16 @@
+from hashlib import sha1
 import os
 
+from django.http import StreamingHttpResponse
 from django.template import loader
 from jinja2.environment import Environment
+from jinja2.utils import LRUCache
+
+STRING_TEMPLATE_CACHE_SIZE = 200
+
+# Environment and compiled template cache for `render_from_string()`
+_string_environment = Environment()
+_string_templates = LRUCache(STRING_TEMPLATE_CACHE_SIZE)
 
 def render_to_string(template, context, request=None, using=None):
     """
@@ -20,6 +29,92 @@ def render_to_string(template, context, request=None, using=None):
     """
     return loader.render_to_string(template, context=context, request=request, using=using)
 
+async def render_to_string_async(template, context, request=None, using=None):
+    """
+    Shortcut for rendering templates in async views using the current django
+    project's collection of loaders.  Templates from backends with the
+    ``enable_async`` option are rendered without blocking the event loop;
+    other templates are rendered synchronously.
+
+    Args:
+      * `template` - string - the template to render
+      * `context` - mapping - the template context
+    Kwargs:
+      * `request` - HttpRequest - the current request, if available
+      * `using` - string - the name of the template engine to use
+
+    Returns:
+      The rendered template string.
+    """
+    template = loader.get_template(template, using=using)
+    if getattr(template, 'is_async', False):
+        return await template.render_async(context, request)
+    return template.render(context, request)
+
+def render_to_stream(template, context, request=None, using=None, buffer_size=None):
+    """
+    Shortcut for rendering templates as a stream of strings using the current
+    django project's collection of loaders.  Templates from backends which
+    can't stream are rendered in one chunk.
+
+    Args:
+      * `template` - string - the template to render
+      * `context` - mapping - the template context
+    Kwargs:
+      * `request` - HttpRequest - the current request, if available
+      * `using` - string - the name of the template engine to use
+      * `buffer_size` - int - the number of template events to buffer in to
+        each chunk.  Defaults to the backend's ``stream_buffer_size`` option.
+
+    Returns:
+      An iterable of rendered template strings.
+    """
+    template = loader.get_template(template, using=using)
+    if not hasattr(template, 'stream'):
+        return iter([template.render(context, request)])
+    return template.stream(context, request, buffer_size=buffer_size)
+
+def render_to_streaming_response(template, context, request=None, using=None, buffer_size=None, **kwargs):
+    """
+    Shortcut for rendering templates in to a ``StreamingHttpResponse``, so
+    that the response is sent to the client as the template is rendered.
+
+    Args:
+      * `template` - string - the template to render
+      * `context` - mapping - the template context
+    Kwargs:
+      * `request` - HttpRequest - the current request, if available
+      * `using` - string - the name of the template engine to use
+      * `buffer_size` - int - the number of template events to buffer in to
+        each chunk of the response
+      * any other kwargs are passed to ``StreamingHttpResponse``, e.g.
+        `content_type` or `status`
+
+    Returns:
+      A ``StreamingHttpResponse`` object.
+    """
+    stream = render_to_stream(template, context, request=request, using=using, buffer_size=buffer_size)
+    return StreamingHttpResponse(stream, **kwargs)
+
+def get_string_template(template_string):
+    """
+    Get a compiled template for a template string.  Compiled templates are
+    kept in a bounded LRU cache keyed by a hash of the string, so a string is
+    only compiled once however many times it's rendered.
+
+    Args:
+      * `template_string` - string - the string to use as a template
+
+    Return:
+      A ``jinja2.Template`` object
+    """
+    key = sha1(template_string.encode('utf-8')).hexdigest()
+    template = _string_templates.get(key)
+    if template is None:
+        template = _string_environment.from_string(template_string)
+        _string_templates[key] = template
+    return template
+
 def render_from_string(template_string, context):
     """
     Shortcut for using simple strings as templates, e.g. '<p>{{ foo }}</p>'
@@ -31,7 +126,22 @@ def render_from_string(template_string, context):
     Return:
       The rendered template string
     """
-    return Environment().from_string(template_string).render(context)
+    return get_string_template(template_string).render(context)
+
+def render_many(template_string, contexts):
+    """
+    Render a template string with each of a sequence of contexts, e.g. for
+    per-item snippets in a batch job.
+
+    Args:
+      * `template_string` - string - the string to use as a template
+      * `contexts` - iterable of mappings - the template contexts
+
+    Return:
+      A list of rendered template strings, in the same order as the contexts
+    """
+    template = get_string_template(template_string)
+    return [template.render(context) for context in contexts]
 
 def get_template_dir_for_app(app_name):
     """
@@ -0,0 +1,226 @@
+"""
+Preloading templates in to jinja template caches, so that the first requests
+to each site after a deploy don't have to load and compile templates.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from time import perf_counter
+import logging
+
+from django.conf import settings
+from django.template import engines
+from jinja2 import TemplateSyntaxError
+from jinja2.loaders import TemplateNotFound
+
+from gn_django.site import get_current_site, set_current_site, clear_current_site
+from .bytecode import get_template_identifiers
+from .cache import PartitionedTemplateCache
+from .loaders import HierarchyLoader, MultiHierarchyLoader
+
+logger = logging.getLogger(__name__)
+
+class WarmupReport(object):
+    """
+    The outcome of warming template caches.
+
+    Attributes:
+      * `loaded` - list of ``(site, template name, seconds)`` for each template
+        loaded.  The time includes compiling the template.
+      * `failures` - list of ``(site, template name, error)`` for each template
+        which could not be loaded
+      * `skipped` - the number of templates not loaded because the time budget
+        ran out
+      * `over_capacity` - the number of templates not loaded because the
+        template cache had no room left for them
+      * `elapsed` - the total time taken, in seconds
+    """
+
+    def __init__(self):
+        self.loaded = []
+        self.failures = []
+        self.skipped = 0
+        self.over_capacity = 0
+        self.elapsed = 0.0
+
+    def get_slowest(self, count=10):
+        """
+        Get the templates which took longest to load.
+
+        Args:
+          * `count` - int - the number of templates to get
+
+        Returns a list of ``(site, template name, seconds)``
+        """
+        return sorted(self.loaded, key=lambda loaded: loaded[2], reverse=True)[:count]
+
+def get_warmup_targets(environment):
+    """
+    Get the sites to warm templates for, along with the loader which serves
+    each site's templates.  For a ``MultiHierarchyLoader``, the sites for each
+    hierarchy are found from the ``SITE_NAMESPACES`` setting.
+
+    Args:
+      * `environment` - the jinja environment object
+
+    Returns a list of ``(site, loader)`` pairs
+    """
+    loader = environment.loader
+    if not isinstance(loader, MultiHierarchyLoader):
+        return [(get_current_site(), loader)]
+    site_namespaces = getattr(settings, 'SITE_NAMESPACES', {})
+    targets = []
+    for hierarchy_name, hierarchy_loader in sorted(loader.hierarchies.items()):
+        for site in sorted(site for site, namespace in site_namespaces.items() if namespace == hierarchy_name):
+            targets.append((site, hierarchy_loader))
+    return targets
+
+def get_warmup_identifiers(loader):
+    """
+    Get the template identifiers to warm for a loader, with the sequential
+    identifiers that templates are normally loaded by first, followed by the
+    namespace and ancestor identifiers.
+
+    Args:
+      * `loader` - the jinja loader object
+
+    Returns a list of template identifiers
+    """
+    identifiers = get_template_identifiers(loader)
+    if not isinstance(loader, HierarchyLoader):
+        return identifiers
+    return sorted(identifiers, key=lambda identifier: loader.delimiter in identifier)
+
+def get_cache_room(cache, site=None):
+    """
+    Get the number of templates that can be added to a template cache without
+    evicting any.
+
+    Args:
+      * `cache` - the template cache object.  May be None, when the
+        environment doesn't cache templates.
+      * `site` - optional site to get the room in the site's partition of a
+        ``PartitionedTemplateCache``.  When not given, the room across all
+        sites is returned.
+
+    Returns the number of templates, or None if the cache isn't bounded
+    """
+    if isinstance(cache, PartitionedTemplateCache):
+        if site is None:
+            capacity, size = cache.max_entries, len(cache)
+        else:
+            capacity, size = cache.get_capacity(site), len(cache.partitions.get(site, ()))
+    elif cache is not None and site is None:
+        capacity, size = getattr(cache, 'capacity', None), len(cache)
+    else:
+        return None
+    if not capacity:
+        return None
+    return max(capacity - size, 0)
+
+def get_warmup_templates(environment, report):
+    """
+    Get the templates to warm for each site, stopping once the environment's
+    template cache would be full so that warming doesn't evict templates that
+    it, or the process, has already cached.  Templates which don't fit are
+    counted in the report.
+
+    Args:
+      * `environment` - the jinja environment object
+      * `report` - ``WarmupReport`` - the report to count templates in
+
+    Returns a list of ``(site, template name)`` pairs
+    """
+    total_room = get_cache_room(environment.cache)
+    templates = []
+    for site, loader in get_warmup_targets(environment):
+        site_room = get_cache_room(environment.cache, site)
+        for template in get_warmup_identifiers(loader):
+            if total_room == 0 or site_room == 0:
+                report.over_capacity += 1
+                continue
+            templates.append((site, template))
+            if total_room is not None:
+                total_room -= 1
+            if site_room is not None:
+                site_room -= 1
+    return templates
+
+def warm_templates(environment, workers=4, budget=None, report=None):
+    """
+    Load every template that an environment's loader can resolve, for every
+    site, in to the environment's template cache.  Templates are loaded in
+    parallel across a thread pool, with the current site set for each load so
+    that site-specific hierarchies and cache keys are used.  No more templates
+    are loaded than the template cache has room for; sequential identifiers
+    are loaded before namespace and ancestor identifiers.
+
+    Args:
+      * `environment` - the jinja environment object
+      * `workers` - int - the number of threads to load templates with
+      * `budget` - float - optional number of seconds to spend loading
+        templates.  Templates which haven't been loaded by then are skipped.
+      * `report` - ``WarmupReport`` - optional report to add to, e.g. when
+        warming several environments
+
+    Returns a ``WarmupReport`` object
+    """
+    if report is None:
+        report = WarmupReport()
+    start = perf_counter()
+    over_capacity = report.over_capacity
+    templates = get_warmup_templates(environment, report)
+    if report.over_capacity > over_capacity:
+        logger.warning(
+            "The template cache only has room to warm %d of %d templates",
+            len(templates), len(templates) + report.over_capacity - over_capacity
+        )
+    deadline = start + budget if budget is not None else None
+    lock = Lock()
+
+    def load(site, template):
+        if deadline is not None and perf_counter() > deadline:
+            with lock:
+                report.skipped += 1
+            return
+        set_current_site(site)
+        load_start = perf_counter()
+        try:
+            environment.get_template(template)
+        except (TemplateNotFound, TemplateSyntaxError, UnicodeDecodeError) as e:
+            report.failures.append((site, template, e))
+        else:
+            report.loaded.append((site, template, perf_counter() - load_start))
+        finally:
+            clear_current_site()
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(load, site, template) for site, template in templates]
+    # Raise any unexpected errors
+    for future in futures:
+        future.result()
+
+    report.elapsed += perf_counter() - start
+    return report
+
+def warm_all_templates(workers=4, budget=None):
+    """
+    Warm the template caches of every jinja template engine in the project.
+
+    Args:
+      * `workers` - int - the number of threads to load templates with
+      * `budget` - float - optional number of seconds to spend across all
+        engines
+
+    Returns a ``WarmupReport`` object
+    """
+    report = WarmupReport()
+    for engine in engines.all():
+        environment = getattr(engine, 'env', None)
+        if environment is None or environment.loader is None:
+            continue
+        remaining = None
+        if budget is not None:
+            remaining = max(budget - report.elapsed, 0)
+        warm_templates(environment, workers=workers, budget=remaining, report=report)
+    return report
@@ -0,0 +1,315 @@
+"""
+Watching template directories for changes, so that jinja environments can run
+with ``auto_reload`` disabled while still picking up edited, added and removed
+templates.
+
+Changes are detected with the linux inotify API, through ``ctypes``, and only
+the template cache and loader resolution cache entries affected by a change
+are invalidated.
+"""
+
+from threading import Thread
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import select
+import struct
+import sys
+
+from django.core.exceptions import ImproperlyConfigured
+from django.template import engines
+
+from .cache import remove_cached_templates
+from .loaders import (
+    HierarchyLoader,
+    MultiHierarchyLoader,
+    clear_directory_listings,
+    file_system_loaders,
+)
+
+logger = logging.getLogger(__name__)
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = (
+    IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE |
+    IN_DELETE_SELF | IN_MOVE_SELF
+)
+ADDED_OR_REMOVED = IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO
+
+EVENT_HEADER = struct.Struct('iIII')
+
+class Inotify(object):
+    """
+    A minimal binding of the linux inotify API.
+    """
+
+    def __init__(self):
+        if not sys.platform.startswith('linux'):
+            raise ImproperlyConfigured("Watching template directories requires linux inotify")
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_CLOEXEC)
+        if self.fd < 0:
+            self._raise_error()
+
+    def _raise_error(self, path=None):
+        error = ctypes.get_errno()
+        raise OSError(error, os.strerror(error), path)
+
+    def add_watch(self, path, mask=WATCH_MASK):
+        """
+        Watch a directory.
+
+        Args:
+          * `path` - string - the path of the directory
+          * `mask` - int - the events to watch for
+
+        Returns the watch descriptor
+        """
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), ctypes.c_uint32(mask))
+        if wd < 0:
+            self._raise_error(path)
+        return wd
+
+    def read_events(self):
+        """
+        Read the events which are waiting to be read.  Blocks until there is
+        at least one event.
+
+        Returns a list of ``(watch descriptor, mask, cookie, name)``
+        """
+        data = os.read(self.fd, 64 * 1024)
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+            offset += length
+            events.append((wd, mask, cookie, name))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+def get_hierarchy_loaders(environment):
+    """
+    Get the ``HierarchyLoader`` objects used by a jinja environment.
+
+    Args:
+      * `environment` - the jinja environment object
+
+    Returns a list of ``HierarchyLoader`` objects
+    """
+    loader = environment.loader
+    if isinstance(loader, MultiHierarchyLoader):
+        return list(loader.hierarchies.values())
+    if isinstance(loader, HierarchyLoader):
+        return [loader]
+    return []
+
+class TemplateWatcher(object):
+    """
+    Watches template directories in a background thread, and invalidates the
+    cached templates and template resolutions affected by each change:
+
+      * when a template is edited, cached templates compiled from its file are
+        removed
+      * when a template is added or removed, the loader resolutions of its
+        name which can involve its directory are forgotten, along with cached
+        templates of those identifiers and the directory's cached listing
+      * when a directory is added or removed, the resolutions, listings and
+        cached templates of its template directory are cleared
+
+    Args:
+      * `environments` - list - optional jinja environments whose caches
+        should be invalidated.  Defaults to the environments of every jinja
+        template engine in the project.
+      * `directories` - list - optional template directories to watch.
+        Defaults to the directories of every loader created by
+        ``get_hierarchy_loader()``.
+    """
+
+    def __init__(self, environments=None, directories=None):
+        self._environments = environments
+        self.directories = list(directories) if directories is not None else sorted(file_system_loaders)
+        self.inotify = None
+        self.watches = {}
+        self._thread = None
+        self._stop_pipe = None
+
+    @property
+    def environments(self):
+        if self._environments is None:
+            self._environments = [
+                engine.env for engine in engines.all() if getattr(engine, 'env', None) is not None
+            ]
+        return self._environments
+
+    def get_hierarchies(self, template_dir):
+        """
+        Get the hierarchy loaders which load templates from a directory.
+
+        Args:
+          * `template_dir` - string - the template directory
+
+        Returns a list of ``(hierarchy loader, loader name)`` pairs
+        """
+        hierarchies = []
+        for environment in self.environments:
+            for hierarchy in get_hierarchy_loaders(environment):
+                for name, loader in hierarchy.hierarchy.items():
+                    if template_dir in getattr(loader, 'searchpath', ()):
+                        hierarchies.append((hierarchy, name))
+        return hierarchies
+
+    def watch_tree(self, template_dir, path):
+        """
+        Watch a directory within a template directory, and all of the
+        directories below it.
+
+        Args:
+          * `template_dir` - string - the template directory
+          * `path` - string - the path of the directory to watch
+        """
+        for dirpath, dirnames, filenames in os.walk(path, followlinks=True):
+            try:
+                wd = self.inotify.add_watch(dirpath)
+            except OSError as e:
+                # The directory may have been removed since it was listed
+                if e.errno not in (errno.ENOENT, errno.ENOTDIR):
+                    raise
+                continue
+            prefix = os.path.relpath(dirpath, template_dir).replace(os.sep, '/')
+            watch = (template_dir, '' if prefix == '.' else prefix + '/')
+            watches = self.watches.setdefault(wd, [])
+            if watch not in watches:
+                watches.append(watch)
+
+    def start(self):
+        """
+        Start watching the template directories.
+        """
+        if self._thread is not None:
+            return
+        self.inotify = Inotify()
+        for template_dir in self.directories:
+            self.watch_tree(template_dir, template_dir)
+        self._stop_pipe = os.pipe()
+        self._thread = Thread(target=self.run, name='gn-django-template-watcher', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stop watching the template directories.
+        """
+        if self._thread is None:
+            return
+        os.write(self._stop_pipe[1], b'\0')
+        self._thread.join()
+        self._thread = None
+        for fd in self._stop_pipe:
+            os.close(fd)
+        self.inotify.close()
+        self.inotify = None
+        self.watches = {}
+
+    def run(self):
+        while True:
+            readable, _, _ = select.select([self.inotify.fd, self._stop_pipe[0]], [], [])
+            if self._stop_pipe[0] in readable:
+                return
+            for wd, mask, cookie, name in self.inotify.read_events():
+                try:
+                    self.handle_event(wd, mask, name)
+                except Exception:
+                    logger.exception("Could not invalidate templates for a change to '%s'", name)
+
+    def handle_event(self, wd, mask, name):
+        """
+        Invalidate caches for an inotify event.
+
+        Args:
+          * `wd` - int - the watch descriptor of the watched directory
+          * `mask` - int - the event mask
+          * `name` - string - the name of the file or directory changed within
+            the watched directory
+        """
+        if mask & IN_Q_OVERFLOW:
+            # Events were dropped, so anything may have changed
+            self.invalidate_all()
+            return
+        if mask & IN_IGNORED:
+            self.watches.pop(wd, None)
+            return
+        for template_dir, prefix in self.watches.get(wd, ()):
+            if mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                self.invalidate_directory(template_dir)
+            elif mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    self.watch_tree(template_dir, os.path.join(template_dir, *(prefix + name).split('/')))
+                self.invalidate_directory(template_dir)
+            else:
+                self.invalidate_template(template_dir, prefix + name, bool(mask & ADDED_OR_REMOVED))
+
+    def invalidate_template(self, template_dir, template, added_or_removed=False):
+        """
+        Invalidate the caches affected by a change to a template file.
+
+        Args:
+          * `template_dir` - string - the template directory
+          * `template` - string - the template name within the directory
+          * `added_or_removed` - bool - whether the template was added or
+            removed, rather than edited
+        """
+        filename = os.path.normpath(os.path.join(template_dir, *template.split('/')))
+        names = set()
+        if added_or_removed:
+            clear_directory_listings(template_dir)
+            for hierarchy, loader_name in self.get_hierarchies(template_dir):
+                hierarchy.forget_template(template, loader_name)
+                names.update(hierarchy.get_template_identifiers(template, loader_name))
+
+        def is_affected(cached):
+            if cached.name in names:
+                return True
+            return cached.filename is not None and os.path.normpath(cached.filename) == filename
+
+        for environment in self.environments:
+            remove_cached_templates(environment.cache, is_affected)
+
+    def invalidate_directory(self, template_dir):
+        """
+        Invalidate the caches affected by directories being added or removed
+        within a template directory.  Resolutions can change for any template
+        name, so the resolution caches of the hierarchies which contain the
+        directory and the template caches are cleared.
+
+        Args:
+          * `template_dir` - string - the template directory
+        """
+        clear_directory_listings(template_dir)
+        for hierarchy, loader_name in self.get_hierarchies(template_dir):
+            hierarchy.clear_resolution_cache()
+        for environment in self.environments:
+            if environment.cache is not None:
+                environment.cache.clear()
+
+    def invalidate_all(self):
+        """
+        Invalidate the caches of every watched template directory.
+        """
+        for template_dir in self.directories:
+            self.invalidate_directory(template_dir)
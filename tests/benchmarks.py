@@ -0,0 +1,234 @@
+#!/usr/bin/env python
+"""
+Benchmarks for gn-django's template loading and rendering.
+
+Runs against the ``tests/gn_django_tests`` project settings and the template
+layout of the ``examples/sparse_templates_multi_site`` project, and writes the
+results as JSON so that they can be compared across releases, e.g.::
+
+    ./do benchmarks --output benchmarks-2.21.1.json
+"""
+
+from collections import OrderedDict
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import timeit
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TEST_PROJECT_DIR = os.path.join(BASE_DIR, 'tests', 'gn_django_tests')
+TEMPLATE_BASE = os.path.join(BASE_DIR, 'examples', 'sparse_templates_multi_site', 'templates')
+TEST_FILES_DIR = os.path.join(TEST_PROJECT_DIR, 'test_files')
+
+HIERARCHIES = (
+    ('eurogamer_net', ('eurogamer_net', 'eurogamer', 'core')),
+    ('eurogamer_de', ('eurogamer_de', 'eurogamer', 'core')),
+    ('vg247_com', ('vg247_com', 'vg247', 'core')),
+    ('vg247_pl', ('vg247_pl', 'vg247', 'core')),
+)
+DEPTHS = (1, 3, 6, 12)
+
+sys.path[0:0] = [BASE_DIR, TEST_PROJECT_DIR]
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'project.settings.test')
+
+import django
+django.setup()
+
+import jinja2
+from django.test.utils import override_settings
+from jinja2 import FileSystemLoader
+
+import gn_django
+from gn_django.site import set_current_site
+from gn_django.site.resolver import SiteResolver
+from gn_django.template.backend import Environment, Jinja2
+from gn_django.template.loaders import HierarchyLoader, MultiHierarchyLoader
+
+class Benchmarks(object):
+    """
+    A collection of benchmarks.  Each ``bench_*`` method returns a list of
+    ``(name, callable)`` pairs to time.
+    """
+
+    def __init__(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def close(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def get_hierarchy_loader(self, names, resolution_cache_size=1000):
+        return HierarchyLoader(OrderedDict(
+            (name, FileSystemLoader(os.path.join(TEMPLATE_BASE, name))) for name in names
+        ), resolution_cache_size=resolution_cache_size)
+
+    def get_deep_hierarchy_loader(self, depth):
+        # Pad the hierarchy with empty template directories above core, so
+        # that sequential lookups probe `depth` loaders
+        names = []
+        for i in range(depth - 1):
+            name = 'empty_%d' % i
+            path = os.path.join(self.tmp_dir, name)
+            if not os.path.isdir(path):
+                os.makedirs(path)
+            names.append((name, path))
+        names.append(('core', os.path.join(TEMPLATE_BASE, 'core')))
+        return HierarchyLoader(OrderedDict(
+            (name, FileSystemLoader(path)) for name, path in names
+        ))
+
+    def get_jinja(self, **options):
+        options.setdefault('match_extension', None)
+        return Jinja2({
+            'NAME': 'benchmarks',
+            'APP_DIRS': False,
+            'DIRS': [os.path.join(TEST_FILES_DIR, 'include_with_templates')],
+            'OPTIONS': options,
+        })
+
+    def bench_hierarchy_loader(self):
+        environment = Environment(auto_reload=False)
+        lookups = (
+            ('sequential', 'base.j2'),
+            ('namespace', 'core:base.j2'),
+            ('ancestor', 'eurogamer_parent:article.j2'),
+        )
+        benchmarks = []
+        for cached, cache_size in (('uncached', 0), ('cached', 1000)):
+            loader = self.get_hierarchy_loader(HIERARCHIES[0][1], resolution_cache_size=cache_size)
+            for mode, template in lookups:
+                benchmarks.append((
+                    'hierarchy_loader.%s.%s' % (mode, cached),
+                    lambda loader=loader, template=template: loader.get_source(environment, template),
+                ))
+        return benchmarks
+
+    def bench_multi_hierarchy_loader(self):
+        environment = Environment(auto_reload=True)
+        benchmarks = []
+        for depth in DEPTHS:
+            loader = MultiHierarchyLoader(lambda: 'deep', {'deep': self.get_deep_hierarchy_loader(depth)})
+            benchmarks.append((
+                'multi_hierarchy_loader.get_source.depth_%d' % depth,
+                lambda loader=loader: loader.get_source(environment, 'widgets/comments.j2'),
+            ))
+        return benchmarks
+
+    def bench_environment_load(self):
+        hierarchies = dict(
+            (name, self.get_hierarchy_loader(names)) for name, names in HIERARCHIES
+        )
+        loader = MultiHierarchyLoader(lambda: 'eurogamer_net', hierarchies)
+
+        def cold():
+            Environment(loader=loader).get_template('article.j2')
+
+        warm_environment = Environment(loader=loader, auto_reload=False)
+        warm_environment.get_template('article.j2')
+        return [
+            ('environment.load.cold', cold),
+            ('environment.load.warm', lambda: warm_environment.get_template('article.j2')),
+        ]
+
+    def bench_extensions(self):
+        jinja = self.get_jinja()
+        context = {'foo': 'bar', 'items': list(range(10))}
+        sources = (
+            ('spaceless.static', "{% spaceless %}<ul> <li>a</li> <li>b</li> </ul>{% endspaceless %}"),
+            ('spaceless.dynamic', "{% spaceless %}<ul>{% for i in items %} <li>{{ i }}</li> {% endfor %}</ul>{% endspaceless %}"),
+            ('include_with', "{% include_with 'i3.j2' foo=foo %}"),
+            ('static_link.css', "{% css 'main' %}"),
+            ('static_link.js', "{% js 'app' %}"),
+            ('include_raw', "{% include_raw 'include_expected.html' %}"),
+            ('fragment_cache', "{% cache 300 'benchmark' %}{% for i in items %}<li>{{ i }}</li>{% endfor %}{% endcache %}"),
+        )
+        benchmarks = []
+        for name, source in sources:
+            template = jinja.from_string(source)
+            benchmarks.append((
+                'extension.%s' % name,
+                lambda template=template: template.render(context),
+            ))
+        return benchmarks
+
+    def bench_site_resolver(self):
+        domains = dict(('www.%s.local' % name.replace('_', '.'), name) for name, names in HIERARCHIES)
+        domains['.vg247.com'] = 'vg247_com'
+        resolvers = (
+            ('uncached', SiteResolver(domains, cache_size=0)),
+            ('cached', SiteResolver(domains)),
+        )
+        return [
+            ('site_resolver.%s.%s' % (mode, cached), lambda resolver=resolver, host=host: resolver.resolve(host))
+            for cached, resolver in resolvers
+            for mode, host in (('exact', 'www.eurogamer.net.local:8000'), ('suffix', 'a.b.vg247.com'))
+        ]
+
+    def get_benchmarks(self):
+        benchmarks = []
+        for attr in sorted(dir(self)):
+            if attr.startswith('bench_'):
+                benchmarks.extend(getattr(self, attr)())
+        return benchmarks
+
+def run(number, repeat, name_filter=None):
+    """
+    Run the benchmarks.
+
+    Args:
+      * `number` - int - the number of calls to time in each repeat
+      * `repeat` - int - the number of times to repeat each timing
+      * `name_filter` - string - only run benchmarks whose name contains this
+
+    Returns a mapping of environment details and results
+    """
+    benchmarks = Benchmarks()
+    set_current_site('eurogamer.net')
+    results = []
+    try:
+        with override_settings(
+                STATICFILES_DIRS=[os.path.join(TEST_FILES_DIR, 'include_raw_templates')],
+                STATICLINK_VERSION='1'):
+            for name, func in benchmarks.get_benchmarks():
+                if name_filter and name_filter not in name:
+                    continue
+                # Warm up once, so that one-off setup isn't timed
+                func()
+                timings = timeit.repeat(func, number=number, repeat=repeat)
+                results.append(OrderedDict((
+                    ('name', name),
+                    ('number', number),
+                    ('repeat', repeat),
+                    ('best_us', min(timings) / number * 1e6),
+                    ('mean_us', sum(timings) / len(timings) / number * 1e6),
+                )))
+    finally:
+        benchmarks.close()
+    return OrderedDict((
+        ('gn_django', gn_django.__version__),
+        ('python', platform.python_version()),
+        ('django', django.get_version()),
+        ('jinja2', jinja2.__version__),
+        ('results', results),
+    ))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('-n', '--number', type=int, default=1000, help='Calls to time in each repeat.')
+    parser.add_argument('-r', '--repeat', type=int, default=5, help='Times to repeat each timing.')
+    parser.add_argument('-k', '--filter', default=None, help='Only run benchmarks whose name contains this.')
+    parser.add_argument('-o', '--output', default=None, help='Path to write the JSON results to. Defaults to stdout.')
+    args = parser.parse_args(argv)
+
+    output = json.dumps(run(args.number, args.repeat, args.filter), indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,287 @@
+from threading import Event
+from unittest import mock
+import time
+
+from django.core.signals import request_started
+from django.test import TestCase
+
+from gn_django.db.db_routers import AppsRouter, SiteShardedRouter, ReplicaAwareRouter
+from gn_django.db.db_routers import get_sticky_databases, clear_sticky_databases
+from gn_django.db.db_routers import get_replication_lag, get_router_counters
+from gn_django.exceptions import ImproperlyConfigured
+from gn_django.site import site_context
+
+def get_model(app_label):
+    model = mock.Mock()
+    model._meta.app_label = app_label
+    return model
+
+class ArticlesRouter(SiteShardedRouter):
+    APPS = ['articles', 'comments']
+    DB_NAME = 'default'
+    REPLICAS = ['default_replica']
+    SITE_DATABASES = {
+        'eurogamer.net': {
+            'primary': 'eurogamer',
+            'replicas': ['eurogamer_replica1', 'eurogamer_replica2'],
+        },
+        ('eurogamer.net', 'comments'): {
+            'primary': 'comments',
+        },
+        'vg247.com': {
+            'primary': 'vg247',
+            'replicas': {'vg247_replica1': 3, 'vg247_replica2': 1},
+        },
+    }
+
+class TestAppsRouter(TestCase):
+
+    def test_improperly_configured(self):
+        """
+        Test that routers must specify apps and a database.
+        """
+        self.assertRaises(ImproperlyConfigured, AppsRouter)
+
+        class NoDatabaseRouter(AppsRouter):
+            APPS = ['articles']
+
+        self.assertRaises(ImproperlyConfigured, NoDatabaseRouter)
+
+class TestSiteShardedRouter(TestCase):
+
+    def setUp(self):
+        clear_sticky_databases()
+        self.router = ArticlesRouter()
+
+    def tearDown(self):
+        clear_sticky_databases()
+
+    def test_round_robin_reads(self):
+        """
+        Test that reads are spread across the current site's replicas.
+        """
+        with site_context('eurogamer.net'):
+            reads = [self.router.db_for_read(get_model('articles')) for i in range(4)]
+        self.assertEquals(reads, [
+            'eurogamer_replica1', 'eurogamer_replica2', 'eurogamer_replica1', 'eurogamer_replica2',
+        ])
+
+    def test_weighted_reads(self):
+        """
+        Test that weighted reads choose replicas in proportion to their weights.
+        """
+        router = ArticlesRouter()
+        router.READ_STRATEGY = 'weighted'
+        with site_context('vg247.com'), mock.patch('gn_django.db.db_routers.random.choices') as choices:
+            choices.return_value = ['vg247_replica2']
+            self.assertEquals(router.db_for_read(get_model('articles')), 'vg247_replica2')
+        choices.assert_called_once_with(('vg247_replica1', 'vg247_replica2'), (3, 1))
+
+    def test_shard_selection(self):
+        """
+        Test that shards are chosen by site and app label.
+        """
+        with site_context('eurogamer.net'):
+            self.assertEquals(self.router.db_for_read(get_model('comments')), 'comments')
+            self.assertEquals(self.router.db_for_write(get_model('comments')), 'comments')
+        with site_context('vg247.pl'):
+            self.assertEquals(self.router.db_for_read(get_model('articles')), 'default_replica')
+            self.assertEquals(self.router.db_for_write(get_model('articles')), 'default')
+        self.assertEquals(self.router.db_for_read(get_model('auth')), None)
+        self.assertEquals(self.router.db_for_write(get_model('auth')), None)
+
+    def test_sticky_after_write(self):
+        """
+        Test that reads go to the primary after a write, until the next request.
+        """
+        with site_context('eurogamer.net'):
+            self.assertEquals(self.router.db_for_write(get_model('articles')), 'eurogamer')
+            self.assertEquals(self.router.db_for_read(get_model('articles')), 'eurogamer')
+            self.assertEquals(self.router.db_for_read(get_model('comments')), 'comments')
+        with site_context('vg247.com'):
+            self.assertNotEqual(self.router.db_for_read(get_model('articles')), 'vg247')
+        self.assertEquals(get_sticky_databases(), frozenset(['eurogamer']))
+        request_started.send(sender=None)
+        self.assertEquals(get_sticky_databases(), frozenset())
+
+    def test_allow_migrate(self):
+        """
+        Test that the apps' tables are only created in primary databases.
+        """
+        self.assertTrue(self.router.allow_migrate('eurogamer', 'articles'))
+        self.assertTrue(self.router.allow_migrate('default', 'articles'))
+        self.assertFalse(self.router.allow_migrate('eurogamer_replica1', 'articles'))
+        self.assertEquals(self.router.allow_migrate('eurogamer', 'auth'), None)
+
+    def test_improperly_configured(self):
+        """
+        Test that shards need a primary and the read strategy must be known.
+        """
+        class NoPrimaryRouter(ArticlesRouter):
+            SITE_DATABASES = {'eurogamer.net': {'replicas': ['eurogamer_replica1']}}
+
+        class UnknownStrategyRouter(ArticlesRouter):
+            READ_STRATEGY = 'fastest'
+
+        self.assertRaises(ImproperlyConfigured, NoPrimaryRouter)
+        self.assertRaises(ImproperlyConfigured, UnknownStrategyRouter)
+
+replication_lag = {}
+
+def probe(db):
+    lag = replication_lag.get(db, 0)
+    if isinstance(lag, Exception):
+        raise lag
+    return lag
+
+class ReplicatedArticlesRouter(ReplicaAwareRouter):
+    APPS = ['articles']
+    DB_NAME = 'default'
+    REPLICAS = ['replica1', 'replica2']
+    PROBE = probe
+    PROBE_INTERVAL = 60
+
+class TestReplicaAwareRouter(TestCase):
+
+    def setUp(self):
+        clear_sticky_databases()
+        replication_lag.clear()
+        self.router = ReplicatedArticlesRouter()
+
+    def tearDown(self):
+        clear_sticky_databases()
+        replication_lag.clear()
+
+    def read(self, count=1):
+        return [self.router.db_for_read(get_model('articles')) for i in range(count)]
+
+    def test_reads_from_replicas(self):
+        """
+        Test that reads are spread across healthy replicas.
+        """
+        self.assertEquals(self.read(3), ['replica1', 'replica2', 'replica1'])
+        self.assertEquals(self.router.db_for_read(get_model('auth')), None)
+        self.assertEquals(self.router.get_counters(), {
+            'reads.replica.replica1': 2, 'reads.replica.replica2': 1,
+        })
+
+    def test_lagging_replica_dropped(self):
+        """
+        Test that lagging and unreachable replicas are dropped until they
+        recover.
+        """
+        with self.assertLogs('gn_django.db.db_routers', 'WARNING'):
+            replication_lag['replica1'] = 30
+            self.assertEquals(self.read(2), ['replica2', 'replica2'])
+            replication_lag['replica2'] = Exception("Connection refused")
+            self.assertFalse(self.router.probe_replica('replica2'))
+            self.assertEquals(self.read(), ['default'])
+
+        replication_lag.clear()
+        self.assertEquals(self.read(), ['default'])
+        self.router.replica_states.clear()
+        self.assertIn(self.read()[0], ('replica1', 'replica2'))
+
+        counters = self.router.get_counters()
+        self.assertEquals(counters['replicas.dropped.replica1'], 1)
+        self.assertEquals(counters['replicas.dropped.replica2'], 1)
+        self.assertEquals(counters['reads.primary_fallback'], 2)
+
+    def test_probe_interval(self):
+        """
+        Test that replicas are only probed once per interval.
+        """
+        with mock.patch.object(self.router, 'probe', return_value=0) as mock_probe:
+            self.read(4)
+        self.assertEquals(mock_probe.call_count, 2)
+
+    def test_probes_off_request_path(self):
+        """
+        Test that reads don't wait for slow probes, beyond the timeout for a
+        replica's first probe.
+        """
+        probed = Event()
+        self.router.PROBE_TIMEOUT = 0.01
+
+        def wait_for_probes():
+            probes = list(self.router._probes.values())
+            probed.set()
+            for thread in probes:
+                thread.join()
+            probed.clear()
+
+        with mock.patch.object(self.router, 'probe', side_effect=lambda db: probed.wait(5) and 0):
+            # Replicas aren't read from until their first probe passes
+            self.assertEquals(self.read(), ['default'])
+            self.assertEquals(sorted(self.router._probes), ['replica1', 'replica2'])
+            wait_for_probes()
+            self.assertEquals(self.read(), ['replica1'])
+
+            # Stale replicas are read from while they're probed again
+            for db in ('replica1', 'replica2'):
+                self.router.replica_states[db] = (True, float('-inf'))
+            self.assertEquals(self.read(), ['replica2'])
+            self.assertEquals(sorted(self.router._probes), ['replica1', 'replica2'])
+            wait_for_probes()
+        self.assertEquals(self.router._probes, {})
+
+    def test_first_probes_waited_for_once(self):
+        """
+        Test that reads only wait for slow first probes once, and for all of a
+        shard's replicas together.
+        """
+        probed = Event()
+        self.router.PROBE_TIMEOUT = 0.2
+
+        def timed_read():
+            start = time.monotonic()
+            db = self.router.db_for_read(get_model('articles'))
+            return db, time.monotonic() - start
+
+        with mock.patch.object(self.router, 'probe', side_effect=lambda db: probed.wait(5) and 0):
+            db, elapsed = timed_read()
+            self.assertEquals(db, 'default')
+            self.assertGreaterEqual(elapsed, 0.15)
+            self.assertLess(elapsed, 0.35)
+            for i in range(3):
+                db, elapsed = timed_read()
+                self.assertEquals(db, 'default')
+                self.assertLess(elapsed, 0.1)
+            probes = list(self.router._probes.values())
+            self.assertEquals(len(probes), 2)
+            probed.set()
+            for thread in probes:
+                thread.join()
+        self.assertEquals(self.router._first_probe_deadlines, {})
+        self.assertEquals(self.read(), ['replica1'])
+
+    def test_sticky_and_writes(self):
+        """
+        Test that reads after a write go to the primary and are counted.
+        """
+        self.assertEquals(self.router.db_for_write(get_model('articles')), 'default')
+        self.assertEquals(self.read(), ['default'])
+        self.assertEquals(self.router.db_for_write(get_model('auth')), None)
+        self.assertEquals(self.router.get_counters(), {
+            'writes.default': 1, 'reads.sticky_primary': 1,
+        })
+
+    def test_default_probe(self):
+        """
+        Test the default replication lag probe for databases without
+        replication.
+        """
+        self.assertEquals(ReplicaAwareRouter.PROBE, 'gn_django.db.db_routers.get_replication_lag')
+        self.assertEquals(get_replication_lag('default'), 0.0)
+
+    def test_get_router_counters(self):
+        """
+        Test getting the counters of the project's routers.
+        """
+        from django.db import router
+
+        with mock.patch.object(router, 'routers', [self.router, ArticlesRouter()]):
+            self.read()
+            self.assertEquals(get_router_counters(), {
+                'ReplicatedArticlesRouter': {'reads.replica.replica1': 1},
+            })
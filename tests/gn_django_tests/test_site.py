@@ -1,7 +1,16 @@
-from django.test import TestCase, override_settings
+import asyncio
+from threading import Thread
+
+from django.test import TestCase, RequestFactory, override_settings
 from django.conf import settings
+from django.http import HttpResponse
 
 from gn_django.site import get_current_site, get_namespace_for_site, set_current_site, clear_current_site
+from gn_django.site import reset_current_site, site_context, get_current_site_settings
+from gn_django.site.site_settings import SiteSettings
+from gn_django.site.middleware import SiteFromDomainMiddleware
+from gn_django.site import middleware as site_middleware
+from gn_django.site.resolver import SiteResolver, get_site_resolver, reset_site_resolver
 
 site_settings = {
     'ALLOWED_HOSTS': ['*'], 
@@ -63,6 +72,47 @@ class TestSiteFromDomainMiddleware(TestCase):
             response = self.client.get('/site', SERVER_NAME=host)
             self.assertTrue(("Namespace: %s" % expected_namespace) in response.content.decode('utf-8'))
 
+    def test_middleware_restores_site(self):
+        """
+        Test that the middleware restores the previous site after a request.
+        """
+        middleware = SiteFromDomainMiddleware(lambda request: HttpResponse(get_current_site()))
+        set_current_site('vg247.com')
+        try:
+            request = RequestFactory().get('/', SERVER_NAME='eurogamer.de.local')
+            response = middleware(request)
+            self.assertEquals(response.content, b'eurogamer.de')
+            self.assertEquals(request.site_settings.namespace, 'eurogamer_de')
+            self.assertEquals(get_current_site(), 'vg247.com')
+        finally:
+            clear_current_site()
+
+    def test_async_middleware(self):
+        """
+        Test that the middleware sets the site for interleaved async requests.
+        """
+        async def get_response(request):
+            site = get_current_site()
+            await asyncio.sleep(0)
+            return HttpResponse("%s %s" % (site, get_current_site()))
+
+        middleware = SiteFromDomainMiddleware(get_response)
+        if SiteFromDomainMiddleware.async_capable:
+            self.assertTrue(site_middleware.iscoroutinefunction(middleware))
+        factory = RequestFactory()
+
+        async def serve():
+            return await asyncio.gather(*[
+                middleware(factory.get('/', SERVER_NAME=host))
+                for host in ('eurogamer.net.local', 'vg247.pl.local', 'eurogamer.de.local')
+            ])
+
+        responses = asyncio.run(serve())
+        self.assertEquals([response.content for response in responses], [
+            b'eurogamer.net eurogamer.net', b'vg247.pl vg247.pl', b'eurogamer.de eurogamer.de',
+        ])
+        self.assertEquals(get_current_site(), None)
+
 
 @override_settings(**site_settings)
 class TestSiteFunctions(TestCase):
@@ -98,6 +148,49 @@ class TestSiteFunctions(TestCase):
         clear_current_site()
         self.assertEquals(get_current_site(), None)
 
+    def test_reset_current_site(self):
+        """
+        Test reset_current_site function.
+        """
+        set_current_site('eurogamer.net')
+        token = set_current_site('eurogamer.de')
+        reset_current_site(token)
+        self.assertEquals(get_current_site(), 'eurogamer.net')
+
+    def test_site_context(self):
+        """
+        Test site_context context manager.
+        """
+        set_current_site('eurogamer.net')
+        with site_context('vg247.com') as site:
+            self.assertEquals(site, 'vg247.com')
+            self.assertEquals(get_current_site(), 'vg247.com')
+        self.assertEquals(get_current_site(), 'eurogamer.net')
+
+    def test_site_is_not_shared(self):
+        """
+        Test that the site set in one thread or asyncio task is not seen by
+        others.
+        """
+        set_current_site('eurogamer.net')
+        sites = []
+
+        def in_thread():
+            sites.append(get_current_site())
+            set_current_site('vg247.com')
+
+        thread = Thread(target=in_thread)
+        thread.start()
+        thread.join()
+
+        async def in_task():
+            sites.append(get_current_site())
+            set_current_site('vg247.pl')
+
+        asyncio.run(in_task())
+        self.assertEquals(sites, [None, 'eurogamer.net'])
+        self.assertEquals(get_current_site(), 'eurogamer.net')
+
     def test_get_namespace_for_site(self):
         """
         Test get_namespace_for_site function.
@@ -112,8 +205,10 @@ class TestSiteFunctions(TestCase):
         """
         deleted_setting = settings.SITE_NAMESPACES
         del settings.SITE_NAMESPACES
+        reset_site_resolver()
         self.assertRaises(Exception, get_namespace_for_site)
         settings.SITE_NAMESPACES = deleted_setting
+        reset_site_resolver()
 
     def test_get_namespace_for_site_unknown_site(self):
         """
@@ -122,3 +217,134 @@ class TestSiteFunctions(TestCase):
         """
         set_current_site('foobar.net')
         self.assertRaises(KeyError, get_namespace_for_site)
+
+
+class TestSiteResolver(TestCase):
+
+    def get_resolver(self, **kwargs):
+        return SiteResolver({
+            'www.eurogamer.net': 'eurogamer.net',
+            '*.eurogamer.net': 'eurogamer.net.wildcard',
+            '.eurogamer.net': 'eurogamer.net.suffix',
+            '.de.eurogamer.net': 'eurogamer.de',
+            'VG247.com': 'vg247.com',
+        }, {
+            'eurogamer.net': 'eurogamer_net',
+            'eurogamer.de': 'eurogamer_de',
+        }, **kwargs)
+
+    def test_resolve(self):
+        """
+        Test resolving hosts with exact, wildcard and suffix patterns.
+        """
+        resolver = self.get_resolver()
+        test_cases = [
+            ("www.eurogamer.net", ("eurogamer.net", "eurogamer_net")),
+            ("WWW.eurogamer.net:8000", ("eurogamer.net", "eurogamer_net")),
+            ("www.eurogamer.net.", ("eurogamer.net", "eurogamer_net")),
+            ("m.eurogamer.net", ("eurogamer.net.wildcard", None)),
+            ("eurogamer.net", ("eurogamer.net.suffix", None)),
+            ("a.b.eurogamer.net", ("eurogamer.net.suffix", None)),
+            ("de.eurogamer.net", ("eurogamer.de", "eurogamer_de")),
+            ("www.de.eurogamer.net", ("eurogamer.de", "eurogamer_de")),
+            ("vg247.com", ("vg247.com", None)),
+        ]
+        for host, expected in test_cases:
+            self.assertEquals(resolver.resolve(host), expected, host)
+        for host in ("www.vg247.com", "eurogamer.net.evil.com", "net", ""):
+            self.assertRaises(KeyError, resolver.resolve, host)
+
+    def test_cache(self):
+        """
+        Test that resolved hosts are cached.
+        """
+        resolver = self.get_resolver(cache_size=2)
+        resolver.resolve('www.eurogamer.net:8000')
+        self.assertEquals(resolver.cache['www.eurogamer.net:8000'], ('eurogamer.net', 'eurogamer_net'))
+        resolver.resolve('m.eurogamer.net')
+        resolver.resolve('vg247.com')
+        self.assertNotIn('www.eurogamer.net:8000', resolver.cache)
+        resolver.add('m.eurogamer.net', 'mobile.eurogamer.net')
+        self.assertEquals(resolver.resolve('m.eurogamer.net'), ('mobile.eurogamer.net', None))
+
+    @override_settings(SITE_DOMAINS={'.vg247.pl': 'vg247.pl'}, SITE_NAMESPACES={'vg247.pl': 'vg247_pl'})
+    def test_get_site_resolver(self):
+        """
+        Test that the resolver is built from settings and rebuilt when they
+        change.
+        """
+        resolver = get_site_resolver()
+        self.assertIs(get_site_resolver(), resolver)
+        self.assertEquals(resolver.resolve('www.vg247.pl'), ('vg247.pl', 'vg247_pl'))
+        with self.settings(SITE_DOMAINS={'vg247.com': 'vg247.com'}):
+            self.assertIsNot(get_site_resolver(), resolver)
+            self.assertRaises(KeyError, get_site_resolver().resolve, 'www.vg247.pl')
+
+
+@override_settings(
+    SITE_SETTINGS=['SITE_ANALYTICS_IDS', 'SITE_SECTIONS'],
+    SITE_ANALYTICS_IDS={'eurogamer.net': 'UA-1', 'vg247.com': 'UA-2'},
+    SITE_SECTIONS={'eurogamer.net': ['news', 'reviews']},
+    **site_settings
+)
+class TestSiteSettings(TestCase):
+
+    def tearDown(self):
+        clear_current_site()
+
+    def test_build(self):
+        """
+        Test building a site settings snapshot.
+        """
+        site_settings = get_site_resolver().get_site_settings('eurogamer.net')
+        self.assertEquals(site_settings.site, 'eurogamer.net')
+        self.assertEquals(site_settings.namespace, 'eurogamer_net')
+        self.assertEquals(site_settings.domains, ('127.0.0.1', 'eurogamer.net.local'))
+        self.assertEquals(site_settings.SITE_ANALYTICS_IDS, 'UA-1')
+        self.assertEquals(site_settings.SITE_SECTIONS, ('news', 'reviews'))
+        self.assertIs(get_site_resolver().get_site_settings('eurogamer.net'), site_settings)
+
+        site_settings = get_site_resolver().get_site_settings('vg247.pl')
+        self.assertEquals(site_settings.SITE_ANALYTICS_IDS, None)
+
+    def test_immutable(self):
+        """
+        Test that site settings snapshots can't be changed.
+        """
+        site_settings = SiteSettings('eurogamer.net', FEATURES={'comments': True})
+        with self.assertRaises(AttributeError):
+            site_settings.namespace = 'vg247_com'
+        with self.assertRaises(AttributeError):
+            del site_settings.site
+        with self.assertRaises(TypeError):
+            site_settings.FEATURES['comments'] = False
+
+    def test_get_current_site_settings(self):
+        """
+        Test getting the snapshot for the current site.
+        """
+        self.assertEquals(get_current_site_settings(), None)
+        with site_context('vg247.com'):
+            self.assertEquals(get_current_site_settings().SITE_ANALYTICS_IDS, 'UA-2')
+        snapshot = SiteSettings('eurogamer.net')
+        set_current_site('eurogamer.net', snapshot)
+        self.assertIs(get_current_site_settings(), snapshot)
+
+    def test_middleware_sets_site_settings(self):
+        """
+        Test that the middleware sets the snapshot for the request's site.
+        """
+        middleware = SiteFromDomainMiddleware(
+            lambda request: HttpResponse(get_current_site_settings().SITE_ANALYTICS_IDS)
+        )
+        request = RequestFactory().get('/', SERVER_NAME='eurogamer.net.local')
+        self.assertEquals(middleware(request).content, b'UA-1')
+        self.assertEquals(request.site_settings.site, 'eurogamer.net')
+
+    def test_settings_change(self):
+        """
+        Test that snapshots are rebuilt when a per-site setting changes.
+        """
+        with self.settings(SITE_ANALYTICS_IDS={'eurogamer.net': 'UA-3'}):
+            self.assertEquals(get_site_resolver().get_site_settings('eurogamer.net').SITE_ANALYTICS_IDS, 'UA-3')
+        self.assertEquals(get_site_resolver().get_site_settings('eurogamer.net').SITE_ANALYTICS_IDS, 'UA-1')
@@ -1,18 +1,42 @@
-import tempfile, os
+import asyncio, json, tempfile, os, shutil, sys, time
 from collections import OrderedDict
-from unittest import mock
+from unittest import mock, skipUnless
 
 from jinja2.ext import Extension
 from jinja2 import nodes
-from jinja2.loaders import FileSystemLoader
-from django.test import TestCase
+from jinja2.utils import LRUCache
+from markupsafe import Markup
+from jinja2.loaders import FileSystemLoader, TemplateNotFound
+from django.core.management import call_command
+from django.core.cache import caches
+from django.core.cache.utils import make_template_fragment_key
+from django.test import TestCase, override_settings
+from django.http import HttpResponse, StreamingHttpResponse
+from django.test import RequestFactory
+from django.test.signals import template_rendered
+from io import StringIO
 from django.template.exceptions import TemplateDoesNotExist
 
-from gn_django.template.backend import Jinja2
+from gn_django.template.backend import Jinja2, Environment, environment
+from gn_django.template.middleware import TemplateProfilerMiddleware
+from gn_django.template.extensions import make_fragment_cache_key
+from gn_django.template.profiler import ProfilingEnvironment, get_active_profile, profile_templates
 from gn_django.template import utils
 from gn_django.template.loaders import HierarchyLoader, get_hierarchy_loader
 from gn_django.template.loaders import MultiHierarchyLoader, get_multi_hierarchy_loader
-from gn_django.template.loaders import file_system_loaders
+from gn_django.template.loaders import file_system_loaders, directory_listings, clear_directory_listings
+from gn_django.template.manifest import TemplateManifest, ManifestFileSystemLoader
+from gn_django.template.cache import PartitionedTemplateCache, get_loader_ref, remove_cached_templates
+from gn_django.site.template import get_template_cache_key_with_site
+from gn_django.template.bytecode import BundleBytecodeCache, DjangoCacheBytecodeCache, compile_bundle
+from gn_django.site import get_current_site, set_current_site, clear_current_site
+from gn_django.site.middleware import SiteFromDomainMiddleware
+from gn_django.management.commands import build_template_manifest, compile_template_bundles, template_profile
+from gn_django.management.commands import warm_templates as warm_templates_command
+from gn_django.template.warmup import WarmupReport, warm_templates
+from gn_django.template.watcher import TemplateWatcher, IN_CLOSE_WRITE, IN_CREATE, IN_ISDIR
+from gn_django.apps import GNDjangoConfig
+import gn_django
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 
@@ -126,6 +150,29 @@ class TestJinja2(TestCase):
             rendered = template.render()
             self.assertEqual(rendered, expected_result)
 
+    def test_spaceless_extension(self):
+        jinja = Jinja2(self.get_jinja_config())
+        test_cases = [
+            ['{% spaceless %} <ul>\n  <li>a</li>\n  <li>b</li>\n</ul> {% endspaceless %}', "<ul><li>a</li><li>b</li></ul>"],
+            ['{% spaceless %}<p> {{ a }} </p>\n<p>{{ b }}</p>{% endspaceless %}', "<p><b>A</b></p><p>B</p>"],
+            ['{% spaceless %}<b>Name:</b> {{ b }} <i>x</i>{% endspaceless %}', "<b>Name:</b> B <i>x</i>"],
+            ['{% spaceless %}<ul>{% for i in [1, 2] %}\n  <li>{{ i }}</li>\n{% endfor %}</ul>{% endspaceless %}', "<ul><li>1</li><li>2</li></ul>"],
+            ['{% spaceless %}{% set x %}<i> </i>  <i></i>{% endset %}{{ x|replace("  ", "_") }}{% endspaceless %}', "<i></i>_<i></i>"],
+        ]
+        for template_str, expected_result in test_cases:
+            template = jinja.from_string(template_str)
+            self.assertEqual(template.render({'a': Markup('<b>A</b>'), 'b': 'B'}), expected_result)
+
+    def test_spaceless_extension_static_body(self):
+        jinja = Jinja2(self.get_jinja_config())
+        source = jinja.env.compile('{% spaceless %} <div>  </div>\n <div></div>{% endspaceless %}', raw=True)
+        self.assertNotIn('_strip_spaces', source)
+        self.assertIn("'<div></div><div></div>'", source)
+        source = jinja.env.compile('{% spaceless %} <div>{{ a }}</div>\n <div></div>{% endspaceless %}', raw=True)
+        self.assertIn('_strip_spaces', source)
+        template = jinja.from_string('{% spaceless %}<a> {# c #} <b>{% endspaceless %}')
+        self.assertEqual(template.render(), '<a><b>')
+
     def test_context_processors_work(self):
         """
         Test that context processors work.
@@ -142,6 +189,200 @@ class TestJinja2(TestCase):
             rendered = template.render(request=True)
             self.assertEqual(rendered, expected_result)
 
+    def test_template_rendered_signal(self):
+        """
+        Test that the test signal is sent once for each render in debug mode,
+        and that the context has the request and CSRF values.
+        """
+        jinja_config = self.get_jinja_config()
+        jinja_config['OPTIONS']['debug'] = True
+        jinja = Jinja2(jinja_config)
+        template = jinja.from_string('{{ csrf_input }}')
+        request = RequestFactory().get('/')
+        rendered = []
+        template_rendered.connect(lambda sender, **kwargs: rendered.append(kwargs), weak=False, dispatch_uid='test')
+        try:
+            context = template.make_context({'foo': 'bar'}, request)
+            self.assertFalse(rendered)
+            self.assertEqual(context['request'], request)
+            self.assertEqual(context['foo'], 'bar')
+            self.assertIn('csrfmiddlewaretoken', template.render({'foo': 'bar'}, request))
+            ''.join(template.stream(request=request))
+        finally:
+            template_rendered.disconnect(dispatch_uid='test')
+        self.assertEqual(len(rendered), 2)
+        self.assertIs(rendered[0]['template'], template)
+        self.assertEqual(rendered[0]['context'].dicts[0]['foo'], 'bar')
+
+    def test_template_stream(self):
+        """
+        Test that templates can be streamed with context processors applied and
+        buffering configured by the backend.
+        """
+        jinja_config = self.get_jinja_config()
+        jinja_config['OPTIONS']['stream_buffer_size'] = 0
+        jinja = Jinja2(jinja_config)
+        template = jinja.from_string("{% for i in range(3) %}{{ i }}{% endfor %} {{ settings.TIME_ZONE }}")
+        self.assertEqual(list(template.stream(request=True)), ['0', '1', '2', ' ', 'UTC'])
+        self.assertEqual(list(template.stream(request=True, buffer_size=5)), ['012 UTC'])
+
+        template = jinja.from_string("{% spaceless %}<p> {{ foo }} </p> <p>a</p>{% endspaceless %}")
+        self.assertEqual(''.join(template.stream({'foo': 'bar'})), "<p> bar </p><p>a</p>")
+
+    def test_template_stream_after_middleware(self):
+        """
+        Test that streamed templates render with the current site of the
+        request, when the stream is read after the middleware has returned.
+        """
+        template_base = os.path.join(BASE_DIR, "test_files", "multi_hierarchy_sparse_templates")
+        hierarchies = {}
+        for name, parent in (('eurogamer_net', 'eurogamer'), ('vg247_com', 'vg247')):
+            hierarchies[name] = HierarchyLoader(OrderedDict(
+                (dirname, FileSystemLoader(os.path.join(template_base, dirname))) for dirname in (name, parent, 'core')
+            ))
+        jinja_config = self.get_jinja_config()
+        jinja_config['OPTIONS']['loader'] = MultiHierarchyLoader('gn_django.site.get_namespace_for_site', hierarchies)
+        jinja = Jinja2(jinja_config)
+
+        def view(request):
+            return StreamingHttpResponse(jinja.get_template('article.j2').stream(request=request))
+
+        middleware = SiteFromDomainMiddleware(view)
+        with self.settings(
+                ALLOWED_HOSTS=['*'],
+                SITE_DOMAINS={'eurogamer.net.local': 'eurogamer.net'},
+                SITE_NAMESPACES={'eurogamer.net': 'eurogamer_net', 'vg247.com': 'vg247_com'}):
+            response = middleware(RequestFactory().get('/', SERVER_NAME='eurogamer.net.local'))
+            self.assertIsNone(get_current_site())
+            content = b''.join(response.streaming_content).decode('utf-8')
+        self.assertIn("Welcome to the Eurogamer family article page", content)
+        self.assertIn("Welcome to EG.net's comments!", content)
+
+    def test_async_rendering(self):
+        """
+        Test that templates using gn django extensions render in async
+        environments.
+        """
+        static_dir = os.path.join(BASE_DIR, "test_files", "include_raw_templates")
+        template_dir = os.path.join(BASE_DIR, "test_files", "include_with_templates")
+        jinja_config = self.get_jinja_config()
+        jinja_config['OPTIONS']['enable_async'] = True
+        jinja_config['DIRS'].append(template_dir)
+
+        with self.settings(STATICFILES_DIRS=[static_dir], STATICLINK_VERSION='1'):
+            jinja = Jinja2(jinja_config)
+            template = jinja.from_string(
+                "{% spaceless %}<p> {{ foo }} </p> <p>{% include_with 'i3.j2' foo=foo %}</p>{% endspaceless %}"
+                "{% css 'main' %}{% include_raw 'include_expected.html' %}"
+            )
+            self.assertTrue(template.is_async)
+            rendered = asyncio.run(template.render_async({'foo': 'bar'}))
+            self.assertIn('<p> bar </p><p><h2>Nested include</h2><p>A variable: bar</p></p>', rendered)
+            self.assertIn('<link href="/static/css/main.css?v=1"', rendered)
+            with open(os.path.join(static_dir, 'include_expected.html')) as f:
+                self.assertIn(f.read(), rendered)
+            # Cached include_raw contents are returned without the executor
+            self.assertEqual(asyncio.run(template.render_async({'foo': 'bar'})), rendered)
+
+    def test_include_with_extension_async_without_code_generator(self):
+        from jinja2 import Environment as JinjaEnvironment
+        from gn_django.template.extensions import IncludeWithExtension
+        template_dir = os.path.join(BASE_DIR, "test_files", "include_with_templates")
+        env = JinjaEnvironment(loader=FileSystemLoader(template_dir), extensions=[IncludeWithExtension], enable_async=True)
+        template = env.from_string("{% include_with 'i3.j2' foo=bar %}")
+        rendered = asyncio.run(template.render_async({'bar': 'baz'}))
+        self.assertIn('<p>A variable: baz</p>', rendered)
+
+    def get_fragment_cache_extension(self, jinja):
+        return jinja.env.extensions['gn_django.template.extensions.FragmentCacheExtension']
+
+    @override_settings(FRAGMENT_CACHE_ALIAS='fragments', CACHES={
+        'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'default'},
+        'fragments': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'fragments'},
+    })
+    def test_fragment_cache_extension(self):
+        jinja = Jinja2(self.get_jinja_config())
+        template = jinja.from_string("{% cache 60 'nav', section %}{{ counter() }}{% endcache %}")
+        counter = mock.Mock(side_effect=range(100))
+        try:
+            set_current_site('eurogamer.net')
+            self.assertEqual(template.render({'counter': counter, 'section': 'news'}), '0')
+            self.assertEqual(template.render({'counter': counter, 'section': 'news'}), '0')
+            self.assertEqual(template.render({'counter': counter, 'section': 'reviews'}), '1')
+            set_current_site('rockpapershotgun.com')
+            self.assertEqual(template.render({'counter': counter, 'section': 'news'}), '2')
+        finally:
+            clear_current_site()
+        self.assertEqual(counter.call_count, 3)
+        self.assertEqual(len(caches['fragments']._cache), 3)
+        self.assertEqual(len(caches['default']._cache), 0)
+        self.assertEqual(self.get_fragment_cache_extension(jinja).stats(), {
+            'hits': 1, 'misses': 3, 'stale_hits': 0, 'recomputes': 0,
+        })
+        caches['fragments'].clear()
+
+    def test_fragment_cache_keys(self):
+        """
+        Test that fragment cache keys match django's, and that vary on values
+        don't collide when they contain separators.
+        """
+        jinja = Jinja2(self.get_jinja_config())
+        template = jinja.from_string("{% cache 60 'nav' a b %}{{ counter() }}{% endcache %}")
+        counter = mock.Mock(side_effect=range(100))
+        self.assertEqual(template.render({'counter': counter, 'a': 'x|y', 'b': 'z'}), '0')
+        self.assertEqual(template.render({'counter': counter, 'a': 'x', 'b': 'y|z'}), '1')
+        self.assertEqual(make_fragment_cache_key('nav', ['x', 'y']), make_template_fragment_key('nav', ['x', 'y']))
+        self.assertNotEqual(make_fragment_cache_key('nav', ['x:y']), make_fragment_cache_key('nav', ['x', 'y']))
+
+        # Fragments can be invalidated by their key
+        caches['default'].delete(make_fragment_cache_key('nav', ['x|y', 'z']))
+        self.assertEqual(template.render({'counter': counter, 'a': 'x|y', 'b': 'z'}), '2')
+        try:
+            set_current_site('eurogamer.net')
+            self.assertEqual(template.render({'counter': counter, 'a': 'x|y', 'b': 'z'}), '3')
+            caches['default'].delete(make_fragment_cache_key('nav', ['x|y', 'z'], 'eurogamer.net'))
+            self.assertEqual(template.render({'counter': counter, 'a': 'x|y', 'b': 'z'}), '4')
+        finally:
+            clear_current_site()
+        caches['default'].clear()
+
+    def test_fragment_cache_legacy_values(self):
+        """
+        Test that values left by django-jinja's `cache` tag under the same keys
+        are treated as misses and overwritten.
+        """
+        jinja = Jinja2(self.get_jinja_config())
+        template = jinja.from_string("{% cache 60 'nav' a %}{{ counter() }}{% endcache %}")
+        counter = mock.Mock(side_effect=range(100))
+        for i, legacy in enumerate(('legacy output', 'ab')):
+            cache_key = make_template_fragment_key('nav', [legacy])
+            caches['default'].set(cache_key, legacy)
+            self.assertEqual(template.render({'counter': counter, 'a': legacy}), str(i))
+            self.assertIsInstance(caches['default'].get(cache_key), tuple)
+        self.assertEqual(counter.call_count, 2)
+        caches['default'].clear()
+
+    def test_fragment_cache_extension_stale_while_recomputing(self):
+        jinja = Jinja2(self.get_jinja_config())
+        extension = self.get_fragment_cache_extension(jinja)
+        template = jinja.from_string("{% cache 10 'footer' %}{{ counter() }}{% endcache %}")
+        counter = mock.Mock(side_effect=range(100))
+        cache_key = extension._get_cache_key('footer', [])
+        with mock.patch('gn_django.template.extensions.time.time', return_value=1000.0) as mock_time:
+            self.assertEqual(template.render({'counter': counter}), '0')
+            mock_time.return_value = 1020.0
+            # Another render is recomputing the fragment, so the stale output is used
+            caches['default'].add('%s:lock' % cache_key, 1)
+            self.assertEqual(template.render({'counter': counter}), '0')
+            caches['default'].delete('%s:lock' % cache_key)
+            self.assertEqual(template.render({'counter': counter}), '1')
+            self.assertEqual(template.render({'counter': counter}), '1')
+        self.assertIsNone(caches['default'].get('%s:lock' % cache_key))
+        self.assertEqual(extension.stats(), {
+            'hits': 1, 'misses': 1, 'stale_hits': 1, 'recomputes': 1,
+        })
+        caches['default'].clear()
+
     def test_include_with_extension(self):
         class ExampleModel:
 
@@ -166,6 +407,32 @@ class TestJinja2(TestCase):
 
         self.assertEquals(result, expected)
 
+    def test_include_with_extension_streams(self):
+        template_dir = os.path.join(BASE_DIR, "test_files", "include_with_templates")
+        jinja_config = self.get_jinja_config()
+        jinja_config['DIRS'].append(template_dir)
+        jinja = Jinja2(jinja_config)
+
+        source = jinja.env.compile("{% include_with 'i3.j2' foo=bar %}", raw=True)
+        self.assertNotIn('IncludeWithExtension', source)
+        self.assertIn('root_render_func', source)
+
+        template = jinja.from_string("{% for i in range(2) %}{% include_with 'i3.j2' foo=i %}{% endfor %}")
+        rendered = template.render({'foo': 'parent'})
+        self.assertIn('<p>A variable: 0</p>', rendered)
+        self.assertIn('<p>A variable: 1</p>', rendered)
+        self.assertNotIn('parent', rendered)
+
+    def test_include_with_extension_without_code_generator(self):
+        from jinja2 import Environment as JinjaEnvironment
+        from gn_django.template.extensions import IncludeWithExtension
+        template_dir = os.path.join(BASE_DIR, "test_files", "include_with_templates")
+        env = JinjaEnvironment(loader=FileSystemLoader(template_dir), extensions=[IncludeWithExtension])
+        source = env.compile("{% include_with 'i3.j2' foo=bar %}", raw=True)
+        self.assertIn('IncludeWithExtension', source)
+        rendered = env.from_string("{% include_with 'i3.j2' foo=bar %}").render({'bar': 'baz'})
+        self.assertIn('<p>A variable: baz</p>', rendered)
+
     def test_include_raw_extension(self):
         template_dir = os.path.join(BASE_DIR, "test_files", "include_raw_templates")
 
@@ -183,6 +450,105 @@ class TestJinja2(TestCase):
 
             self.assertEquals(result, expected)
 
+    def test_static_link_extension(self):
+        static_settings = {
+            'DEBUG': False,
+            'STATICLINK_VERSION': '1.2.3',
+            'STATICLINK_FILE_MAP': {'js': 'scripts'},
+        }
+        with self.settings(**static_settings):
+            jinja = Jinja2(self.get_jinja_config())
+            test_cases = [
+                ["{% css 'main' %}", '<link href="/static/css/main.css?v=1.2.3" rel="stylesheet" type="text/css" />'],
+                ["{% js 'app' %}", '<script src="/static/scripts/app.js?v=1.2.3" type="application/javascript"></script>'],
+                ["{% load_compilers %}", ''],
+            ]
+            for template_str, expected_result in test_cases:
+                template = jinja.from_string(template_str)
+                self.assertEqual(template.render(), expected_result)
+
+    def test_static_link_extension_caches_output(self):
+        with self.settings(STATICLINK_VERSION='1'):
+            jinja = Jinja2(self.get_jinja_config())
+            template = jinja.from_string("{% for i in range(3) %}{% css 'main' %}{% endfor %}")
+            with mock.patch.object(jinja.env, 'globals', dict(jinja.env.globals)) as env_globals:
+                env_globals['static'] = mock.Mock(return_value='/static/css/main.css')
+                self.assertEqual(template.render().count('?v=1'), 3)
+                self.assertEqual(env_globals['static'].call_count, 1)
+
+        # Changing settings should rebuild the tag output
+        with self.settings(STATICLINK_VERSION='2'):
+            self.assertIn('?v=2', template.render())
+
+    def test_include_raw_extension_caches_contents(self):
+        with tempfile.TemporaryDirectory() as static_dir:
+            css_path = os.path.join(static_dir, 'critical.css')
+            with open(css_path, 'w') as f:
+                f.write('body { color: red; }')
+
+            with self.settings(STATICFILES_DIRS=[static_dir]):
+                jinja = Jinja2(self.get_jinja_config())
+                template = jinja.from_string("{% include_raw 'critical.css' %}")
+                with mock.patch('gn_django.template.extensions.open', side_effect=open) as mock_open:
+                    self.assertEquals(template.render(), 'body { color: red; }')
+                    self.assertEquals(template.render(), 'body { color: red; }')
+                    self.assertEquals(mock_open.call_count, 1)
+
+                # Changes to the file should be picked up
+                with open(css_path, 'w') as f:
+                    f.write('body { color: blue; }')
+                os.utime(css_path, (0, 0))
+                self.assertEquals(template.render(), 'body { color: blue; }')
+
+                # Missing files render nothing
+                template = jinja.from_string("{% include_raw 'missing.css' %}")
+                self.assertEquals(template.render(), '')
+
+    def test_include_raw_extension_byte_budget(self):
+        with tempfile.TemporaryDirectory() as static_dir:
+            for name in ('a.css', 'b.css'):
+                with open(os.path.join(static_dir, name), 'w') as f:
+                    f.write('x' * 10)
+
+            with self.settings(STATICFILES_DIRS=[static_dir], INCLUDE_RAW_CACHE_SIZE=15):
+                jinja = Jinja2(self.get_jinja_config())
+                extension = jinja.env.extensions['gn_django.template.extensions.IncludeRawExtension']
+                jinja.from_string("{% include_raw 'a.css' %}{% include_raw 'b.css' %}").render()
+                self.assertEquals(list(extension._files), [os.path.join(static_dir, 'b.css')])
+                self.assertEquals(extension._cached_bytes, 10)
+
+    def test_include_raw_extension_inline(self):
+        with tempfile.TemporaryDirectory() as static_dir:
+            css_path = os.path.join(static_dir, 'critical.css')
+            with open(css_path, 'w') as f:
+                f.write('body { color: red; }')
+
+            with self.settings(STATICFILES_DIRS=[static_dir], INCLUDE_RAW_INLINE=True):
+                jinja = Jinja2(self.get_jinja_config())
+                template = jinja.from_string("<style>{% include_raw 'critical.css' %}</style>")
+            os.remove(css_path)
+            self.assertEquals(template.render(), '<style>body { color: red; }</style>')
+
+    def test_include_raw_extension_inline_with_bytecode_cache(self):
+        """
+        Test that files aren't inlined in to templates when their bytecode can
+        be cached, as cached bytecode wouldn't pick up changes to the files.
+        """
+        with tempfile.TemporaryDirectory() as static_dir:
+            css_path = os.path.join(static_dir, 'critical.css')
+            with open(css_path, 'w') as f:
+                f.write('body { color: red; }')
+
+            with self.settings(STATICFILES_DIRS=[static_dir], INCLUDE_RAW_INLINE=True):
+                jinja = Jinja2(self.get_jinja_config())
+                jinja.env.bytecode_cache = BundleBytecodeCache()
+                template = jinja.from_string("<style>{% include_raw 'critical.css' %}</style>")
+                self.assertEquals(template.render(), '<style>body { color: red; }</style>')
+                with open(css_path, 'w') as f:
+                    f.write('body { color: blue; }')
+                os.utime(css_path, (time.time() + 10, time.time() + 10))
+                self.assertEquals(template.render(), '<style>body { color: blue; }</style>')
+
 class TestHierarchyLoader(TestCase):
     """
     Tests for the HierarchyLoader class.
@@ -271,6 +637,121 @@ class TestHierarchyLoader(TestCase):
         self.assertRaises(TemplateDoesNotExist, jinja.get_template, ("core:wibble.j2"))
         self.assertRaises(TemplateDoesNotExist, jinja.get_template, ("eurogamer_parent:wibble.j2"))
 
+    def test_resolution_cache_probes_winning_loader(self):
+        jinja_config = self.get_jinja_config()
+        loader = jinja_config['OPTIONS']['loader']
+        jinja = Jinja2(jinja_config)
+
+        source, filename, uptodate = loader.get_source(jinja.env, "base.j2")
+        self.assertEquals(filename, self.get_template_dir("core/base.j2"))
+        self.assertEquals(loader.resolution_cache.get("base.j2"), ("core", "base.j2"))
+
+        # A warm lookup should only touch the loader that yielded the template
+        for name, child_loader in loader.hierarchy.items():
+            child_loader.get_source = mock.Mock(wraps=child_loader.get_source)
+        source, filename, uptodate = loader.get_source(jinja.env, "base.j2")
+        self.assertEquals(filename, self.get_template_dir("core/base.j2"))
+        self.assertFalse(loader.hierarchy["eurogamer_net"].get_source.called)
+        self.assertFalse(loader.hierarchy["eurogamer"].get_source.called)
+        self.assertEquals(loader.hierarchy["core"].get_source.call_count, 1)
+
+    def test_resolution_cache_records_misses(self):
+        jinja_config = self.get_jinja_config()
+        loader = jinja_config['OPTIONS']['loader']
+        jinja = Jinja2(jinja_config)
+
+        self.assertRaises(TemplateDoesNotExist, jinja.get_template, "wibble.j2")
+        for name, child_loader in loader.hierarchy.items():
+            child_loader.get_source = mock.Mock(wraps=child_loader.get_source)
+        self.assertRaises(TemplateDoesNotExist, jinja.get_template, "wibble.j2")
+        for name, child_loader in loader.hierarchy.items():
+            self.assertFalse(child_loader.get_source.called)
+
+        # Clearing the resolution cache should make the loader probe again
+        loader.clear_resolution_cache()
+        self.assertRaises(TemplateDoesNotExist, jinja.get_template, "wibble.j2")
+        for name, child_loader in loader.hierarchy.items():
+            self.assertTrue(child_loader.get_source.called)
+
+    def test_resolution_cache_misses_expire(self):
+        jinja_config = self.get_jinja_config()
+        loader = jinja_config['OPTIONS']['loader']
+        jinja = Jinja2(jinja_config)
+
+        with mock.patch('gn_django.template.loaders.time.monotonic', return_value=100):
+            self.assertRaises(TemplateDoesNotExist, jinja.get_template, "wibble.j2")
+        self.assertEquals(loader.resolution_cache.get("wibble.j2").expires, 100 + loader.miss_ttl)
+        for name, child_loader in loader.hierarchy.items():
+            child_loader.get_source = mock.Mock(wraps=child_loader.get_source)
+        with mock.patch('gn_django.template.loaders.time.monotonic', return_value=100 + loader.miss_ttl - 1):
+            self.assertRaises(TemplateDoesNotExist, jinja.get_template, "wibble.j2")
+        for name, child_loader in loader.hierarchy.items():
+            self.assertFalse(child_loader.get_source.called)
+
+        # Once the miss has expired the loaders are probed again
+        with mock.patch('gn_django.template.loaders.time.monotonic', return_value=100 + loader.miss_ttl):
+            self.assertRaises(TemplateDoesNotExist, jinja.get_template, "wibble.j2")
+        for name, child_loader in loader.hierarchy.items():
+            self.assertTrue(child_loader.get_source.called)
+
+    def test_resolution_cache_bypassed_with_auto_reload(self):
+        jinja_config = self.get_jinja_config()
+        jinja_config['OPTIONS']['auto_reload'] = True
+        loader = jinja_config['OPTIONS']['loader']
+        jinja = Jinja2(jinja_config)
+
+        jinja.get_template("article.j2")
+        self.assertRaises(TemplateDoesNotExist, jinja.get_template, "wibble.j2")
+        self.assertEquals(len(loader.resolution_cache), 0)
+
+    @mock.patch.dict(directory_listings, clear=True)
+    def test_directory_listings_cached(self):
+        loader = Jinja2(self.get_jinja_config()).env.loader
+        with mock.patch('jinja2.loaders.os.walk', side_effect=os.walk) as walk:
+            first = loader.list_templates()
+            self.assertEqual(walk.call_count, 3)
+            self.assertEqual(loader.list_templates(), first)
+            self.assertEqual(loader.list_template_identifiers(), loader.list_template_identifiers())
+            self.assertEqual(walk.call_count, 3)
+            clear_directory_listings(self.get_template_dir("core"))
+            loader.list_templates()
+            self.assertEqual(walk.call_count, 4)
+            clear_directory_listings()
+            loader.list_templates()
+            self.assertEqual(walk.call_count, 7)
+        self.assertIn("core:base.j2", first)
+
+    def test_get_effective_templates(self):
+        loader = Jinja2(self.get_jinja_config()).env.loader
+        self.assertEqual(loader.get_effective_templates(), OrderedDict((
+            ("article.j2", "eurogamer"),
+            ("base.j2", "core"),
+            ("home.j2", "core"),
+            ("widgets/comments.j2", "eurogamer_net"),
+        )))
+
+    def test_parse_template_identifier(self):
+        loader = self.get_jinja_config()['OPTIONS']['loader']
+        test_cases = (
+            ("base.j2", ("sequential", None, "base.j2")),
+            ("widgets/comments.j2", ("sequential", None, "widgets/comments.j2")),
+            ("core:base.j2", ("namespace", "core", "base.j2")),
+            ("eurogamer_net_parent:base.j2", ("ancestor", "eurogamer_net", "base.j2")),
+            ("eurogamer:foo_parent:base.j2", ("namespace", "eurogamer", "foo_parent:base.j2")),
+        )
+        for template, expected in test_cases:
+            self.assertEquals(loader.parse_template_identifier(template), expected)
+            self.assertEquals(loader.identify_loading_mode(template), expected[0])
+
+    def test_ancestor_loader_names(self):
+        loader = self.get_jinja_config()['OPTIONS']['loader']
+        self.assertEquals(loader.get_ancestor_loader_names("eurogamer_net"), ("eurogamer", "core"))
+        self.assertEquals(loader.get_ancestor_loader_names("eurogamer"), ("core",))
+        self.assertEquals(loader.get_ancestor_loader_names("core"), ())
+        self.assertRaises(TemplateNotFound, loader.get_ancestor_loader_names, "wibble")
+        with self.assertRaises(TypeError):
+            loader.loader_index[("ancestor", "core")] = ("eurogamer",)
+
     def test_init_name_has_parent_at_end(self):
         hierarchy = OrderedDict((
             ("eurogamer_net", FileSystemLoader(self.get_template_dir("eurogamer_net"))),
@@ -374,6 +855,20 @@ class TestMultiHierarchyLoader(TestCase):
             t = jinja.get_template(template_name)
             self.assertEquals(t.template.filename, expected_template_location)
 
+    @mock.patch.dict(directory_listings, clear=True)
+    def test_list_templates_walks_shared_directories_once(self):
+        loader = self.get_jinja_config(mock.Mock())['OPTIONS']['loader']
+        with mock.patch('jinja2.loaders.os.walk', side_effect=os.walk) as walk:
+            templates = loader.list_templates()
+            # 4 site directories, 2 family directories and core
+            self.assertEqual(walk.call_count, 7)
+        self.assertIn('vg247_pl:core:base.j2', templates)
+
+        effective = loader.get_effective_templates()
+        self.assertEqual(effective['eurogamer_de']['widgets/comments.j2'], 'eurogamer_de')
+        self.assertEqual(effective['vg247_com']['article.j2'], 'vg247')
+        self.assertEqual(effective['vg247_com']['base.j2'], 'core')
+
     def test_get_template_sequential(self):
         test_cases = (
             ('eurogamer_net', 'base.j2', self.get_template_dir('core/base.j2')),
@@ -510,6 +1005,335 @@ class TestLoaderBuilders(TestCase):
 
         self.assertEquals(len(file_system_loaders), 7)
 
+class TestBytecodeBundles(TestCase):
+    """
+    Tests for precompiled bytecode bundles.
+    """
+
+    def get_template_dir(self, dirname):
+        template_base = os.path.join(BASE_DIR, "test_files", "sparse_templates")
+        return os.path.join(template_base, dirname)
+
+    def get_loader(self):
+        return HierarchyLoader(OrderedDict((
+            ("eurogamer_net", FileSystemLoader(self.get_template_dir("eurogamer_net"))),
+            ("eurogamer", FileSystemLoader(self.get_template_dir("eurogamer"))),
+            ("core", FileSystemLoader(self.get_template_dir("core"))),
+        )))
+
+    def test_list_template_identifiers(self):
+        identifiers = self.get_loader().list_template_identifiers()
+        for identifier in ("base.j2", "widgets/comments.j2", "core:base.j2",
+                           "eurogamer_net:widgets/comments.j2",
+                           "eurogamer_net_parent:article.j2", "eurogamer_parent:base.j2"):
+            self.assertIn(identifier, identifiers)
+        self.assertNotIn("core_parent:base.j2", identifiers)
+
+    def get_jinja_config(self, loader, **options):
+        options.update({
+            'match_extension': None,
+            'loader': loader,
+        })
+        return {
+            "APP_DIRS": True,
+            "OPTIONS": options,
+            "NAME": "djangojinja",
+            "DIRS": [],
+        }
+
+    def test_bundle_avoids_compilation(self):
+        loader = self.get_loader()
+        jinja = Jinja2(self.get_jinja_config(loader))
+        cache, errors = compile_bundle(jinja.env, loader)
+        self.assertEquals(errors, [])
+        self.assertEquals(len(cache.bundle), len(loader.list_template_identifiers()))
+
+        with tempfile.TemporaryDirectory() as bundle_dir:
+            cache.save(os.path.join(bundle_dir, "default.bundle"))
+            jinja = Jinja2(self.get_jinja_config(loader, bytecode_bundle=bundle_dir))
+        self.assertIsInstance(jinja.env.bytecode_cache, BundleBytecodeCache)
+        with mock.patch.object(Environment, 'compile') as mock_compile:
+            for name in ("article.j2", "eurogamer_net_parent:article.j2", "core:home.j2"):
+                jinja.get_template(name)
+            self.assertFalse(mock_compile.called)
+
+    def test_missing_bundle(self):
+        env = Environment(loader=self.get_loader(), bytecode_bundle="/does/not/exist")
+        self.assertEquals(env.bytecode_cache, None)
+
+    def test_compile_template_bundles_command(self):
+        with tempfile.TemporaryDirectory() as bundle_dir:
+            call_command(compile_template_bundles.Command(), output=bundle_dir, stdout=mock.Mock())
+            self.assertEquals(os.listdir(bundle_dir), ["backend-default.bundle"])
+            cache = BundleBytecodeCache.load(bundle_dir)
+        self.assertTrue(cache.bundle)
+
+@override_settings(CACHES={
+    'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+    'bytecode': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'bytecode'},
+})
+class TestDjangoCacheBytecodeCache(TestCase):
+    """
+    Tests for the django cache backed bytecode cache.
+    """
+
+    def setUp(self):
+        caches['bytecode'].clear()
+
+    def tearDown(self):
+        clear_current_site()
+
+    def get_jinja_config(self):
+        template_dir = os.path.join(BASE_DIR, "test_files", "include_with_templates")
+        return {
+            "APP_DIRS": True,
+            "OPTIONS": {
+                'match_extension': None,
+                'bytecode_cache': {
+                    'name': 'bytecode',
+                    'backend': 'gn_django.template.bytecode.DjangoCacheBytecodeCache',
+                    'enabled': True,
+                },
+            },
+            "NAME": "djangojinja",
+            "DIRS": [template_dir],
+        }
+
+    def test_bytecode_shared_between_environments(self):
+        jinja = Jinja2(self.get_jinja_config())
+        self.assertIsInstance(jinja.env.bytecode_cache, DjangoCacheBytecodeCache)
+        jinja.get_template("i1.j2")
+
+        # A fresh environment, e.g. in another worker, should not need to compile
+        jinja = Jinja2(self.get_jinja_config())
+        with mock.patch.object(Environment, 'compile') as mock_compile:
+            jinja.get_template("i1.j2")
+            self.assertFalse(mock_compile.called)
+
+    def test_cache_key_varies_on_site(self):
+        cache = DjangoCacheBytecodeCache('bytecode')
+        set_current_site('eurogamer.net')
+        eurogamer_key = cache.get_cache_key('article.j2', '/templates/article.j2')
+        set_current_site('vg247.com')
+        vg247_key = cache.get_cache_key('article.j2', '/templates/article.j2')
+        self.assertNotEqual(eurogamer_key, vg247_key)
+        self.assertTrue(vg247_key.startswith(cache.key_prefix))
+        self.assertEquals(vg247_key, cache.get_cache_key('article.j2', '/templates/article.j2'))
+
+class TestTemplateCacheKeys(TestCase):
+    """
+    Tests for template cache key generation.
+    """
+
+    def tearDown(self):
+        clear_current_site()
+
+    def test_loader_ref_is_reused(self):
+        loader = FileSystemLoader(BASE_DIR)
+        ref = get_loader_ref(loader)
+        self.assertIs(ref(), loader)
+        self.assertIs(get_loader_ref(loader), ref)
+
+    def test_default_cache_key(self):
+        loader = FileSystemLoader(BASE_DIR)
+        env = Environment(loader=loader)
+        self.assertEquals(env.get_template_cache_key('foo.j2'), (get_loader_ref(loader), 'foo.j2'))
+
+    def test_cache_key_cb_resolved_once(self):
+        loader = FileSystemLoader(BASE_DIR)
+        env = Environment(
+            loader=loader,
+            template_cache_key_cb='gn_django.site.template.get_template_cache_key_with_site'
+        )
+        self.assertIs(env.template_cache_key_cb, get_template_cache_key_with_site)
+        set_current_site('eurogamer.net')
+        self.assertEquals(
+            env.get_template_cache_key('foo.j2'),
+            (get_loader_ref(loader), 'eurogamer.net', 'foo.j2')
+        )
+
+class TestPartitionedTemplateCache(TestCase):
+    """
+    Tests for the per-site partitioned template cache.
+    """
+
+    def tearDown(self):
+        clear_current_site()
+
+    def test_sites_do_not_evict_each_other(self):
+        cache = PartitionedTemplateCache(capacity=2, capacities={'eurogamer.net': 3})
+        set_current_site('vg247.com')
+        cache['quiet'] = 'quiet template'
+        set_current_site('eurogamer.net')
+        for i in range(5):
+            cache['busy%d' % i] = 'busy template'
+        self.assertEquals(cache.get('busy0'), None)
+        self.assertEquals(cache.get('busy4'), 'busy template')
+        set_current_site('vg247.com')
+        self.assertEquals(cache.get('quiet'), 'quiet template')
+
+        stats = cache.stats()
+        self.assertEquals(stats['eurogamer.net'], {
+            'hits': 1, 'misses': 1, 'evictions': 2, 'size': 3, 'capacity': 3,
+        })
+        self.assertEquals(stats['vg247.com'], {
+            'hits': 1, 'misses': 0, 'evictions': 0, 'size': 1, 'capacity': 2,
+        })
+
+    def test_least_recently_used_is_evicted(self):
+        cache = PartitionedTemplateCache(capacity=2)
+        cache['a'] = 1
+        cache['b'] = 2
+        cache.get('a')
+        cache['c'] = 3
+        self.assertIn('a', cache)
+        self.assertNotIn('b', cache)
+
+    def test_max_entries(self):
+        cache = PartitionedTemplateCache(capacity=10, max_entries=3)
+        set_current_site('eurogamer.net')
+        cache['a'] = 1
+        cache['b'] = 2
+        set_current_site('vg247.com')
+        cache['c'] = 3
+        cache['d'] = 4
+        self.assertEquals(len(cache), 3)
+        set_current_site('eurogamer.net')
+        self.assertNotIn('a', cache)
+        self.assertIn('b', cache)
+
+    def test_environment_option(self):
+        template_dir = os.path.join(BASE_DIR, "test_files", "include_with_templates")
+        jinja = Jinja2({
+            "APP_DIRS": True,
+            "OPTIONS": {
+                'match_extension': None,
+                'partitioned_cache': {'capacity': 5},
+                'template_cache_key_cb': 'gn_django.site.template.get_template_cache_key_with_site',
+            },
+            "NAME": "djangojinja",
+            "DIRS": [template_dir],
+        })
+        self.assertIsInstance(jinja.env.cache, PartitionedTemplateCache)
+        set_current_site('eurogamer.net')
+        jinja.get_template('i1.j2')
+        jinja.get_template('i1.j2')
+        self.assertEquals(jinja.env.cache.stats()['eurogamer.net']['hits'], 1)
+
+    def test_remove_cached_templates(self):
+        cache = PartitionedTemplateCache()
+        for site in ('eurogamer.net', 'vg247.com'):
+            set_current_site(site)
+            cache['a'] = mock.Mock(filename='/templates/a.j2')
+            cache['b'] = mock.Mock(filename='/templates/b.j2')
+        removed = remove_cached_templates(cache, lambda template: template.filename == '/templates/a.j2')
+        self.assertEquals(removed, 2)
+        self.assertEquals(len(cache), 2)
+        self.assertNotIn('a', cache)
+
+        cache = {'a': mock.Mock(filename='/templates/a.j2')}
+        self.assertEquals(remove_cached_templates(cache, lambda template: True), 1)
+        self.assertEquals(cache, {})
+        self.assertEquals(remove_cached_templates(None, lambda template: True), 0)
+
+class TestTemplateManifest(TestCase):
+    """
+    Tests for the template manifest and manifest backed loaders.
+    """
+
+    def get_template_dir(self, dirname):
+        template_base = os.path.join(BASE_DIR, "test_files", "sparse_templates")
+        return os.path.join(template_base, dirname)
+
+    def get_directories(self):
+        return (
+            ('eurogamer_net', self.get_template_dir('eurogamer_net')),
+            ('eurogamer', self.get_template_dir('eurogamer')),
+            ('core', self.get_template_dir('core')),
+        )
+
+    def get_jinja_config(self, loader):
+        return {
+            "APP_DIRS": True,
+            "OPTIONS": {
+                'match_extension': None,
+                'loader': loader,
+            },
+            "NAME": "djangojinja",
+            "DIRS": [],
+        }
+
+    def test_build_save_and_load(self):
+        manifest = TemplateManifest.build([self.get_template_dir('core')])
+        entries = manifest.get_entries(self.get_template_dir('core'))
+        self.assertEquals(sorted(entries), ['article.j2', 'base.j2', 'home.j2', 'widgets/comments.j2'])
+        self.assertEquals(entries['widgets/comments.j2'], self.get_template_dir('core/widgets/comments.j2'))
+
+        with tempfile.NamedTemporaryFile(suffix='.json') as f:
+            manifest.save(f.name)
+            loaded = TemplateManifest.load(f.name)
+        self.assertEquals(loaded.directories, manifest.directories)
+        self.assertEquals(loaded.get_entries(self.get_template_dir('eurogamer')), None)
+
+    @mock.patch.dict(file_system_loaders, clear=True)
+    def test_hierarchy_loader_uses_manifest(self):
+        manifest = TemplateManifest.build([directory for name, directory in self.get_directories()])
+        loader = get_hierarchy_loader(self.get_directories(), manifest=manifest)
+        for name, child_loader in loader.hierarchy.items():
+            self.assertIsInstance(child_loader, ManifestFileSystemLoader)
+        jinja = Jinja2(self.get_jinja_config(loader))
+
+        t = jinja.get_template("widgets/comments.j2")
+        self.assertEquals(t.template.filename, self.get_template_dir("eurogamer_net/widgets/comments.j2"))
+        t = jinja.get_template("eurogamer_net_parent:base.j2")
+        self.assertEquals(t.template.filename, self.get_template_dir("core/base.j2"))
+
+        # Misses are resolved from the manifest without touching the filesystem
+        with mock.patch('gn_django.template.manifest.open') as mock_open:
+            self.assertRaises(TemplateDoesNotExist, jinja.get_template, "wibble.j2")
+            self.assertFalse(mock_open.called)
+
+    def test_uptodate_after_edit(self):
+        """
+        Test that a template loaded after an edit to its file is up to date.
+        """
+        template_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, template_dir)
+        path = os.path.join(template_dir, 'page.j2')
+        with open(path, 'w') as f:
+            f.write('before')
+        loader = ManifestFileSystemLoader(template_dir, TemplateManifest.build([template_dir]))
+        env = Environment(loader=loader)
+
+        source, filename, uptodate = loader.get_source(env, 'page.j2')
+        self.assertTrue(uptodate())
+        with open(path, 'w') as f:
+            f.write('after')
+        os.utime(path, (time.time() + 10, time.time() + 10))
+        self.assertFalse(uptodate())
+
+        source, filename, uptodate = loader.get_source(env, 'page.j2')
+        self.assertEquals(source, 'after')
+        self.assertTrue(uptodate())
+
+    @mock.patch.dict(file_system_loaders, clear=True)
+    def test_missing_manifest_file(self):
+        loader = get_hierarchy_loader(self.get_directories(), manifest='/does/not/exist.json')
+        for name, child_loader in loader.hierarchy.items():
+            self.assertIs(type(child_loader), FileSystemLoader)
+
+    @mock.patch.dict(file_system_loaders, clear=True)
+    def test_build_template_manifest_command(self):
+        get_hierarchy_loader(self.get_directories())
+        with tempfile.NamedTemporaryFile(suffix='.json') as f:
+            call_command(build_template_manifest.Command(), output=f.name, stdout=mock.Mock())
+            manifest = TemplateManifest.load(f.name)
+        self.assertEquals(
+            sorted(manifest.directories),
+            sorted(directory for name, directory in self.get_directories())
+        )
+        self.assertIn('article.j2', manifest.get_entries(self.get_template_dir('eurogamer')))
+
 class TestTemplateUtils(TestCase):
     """
     Tests for the Jinja2 class.
@@ -519,9 +1343,392 @@ class TestTemplateUtils(TestCase):
         rendered = utils.render_to_string("site.j2", {'site': 'eurogamer', 'namespace': 'core'})
         self.assertEquals(rendered, "Site: eurogamer\nNamespace: core")
 
+    def test_render_to_string_async(self):
+        rendered = asyncio.run(utils.render_to_string_async("site.j2", {'site': 'eurogamer', 'namespace': 'core'}))
+        self.assertEquals(rendered, "Site: eurogamer\nNamespace: core")
+
+    def test_render_to_stream(self):
+        context = {'site': 'eurogamer', 'namespace': 'core'}
+        unbuffered = list(utils.render_to_stream("site.j2", context, buffer_size=0))
+        buffered = list(utils.render_to_stream("site.j2", context, buffer_size=100))
+        self.assertEquals(''.join(unbuffered), "Site: eurogamer\nNamespace: core")
+        self.assertEquals(buffered, ["Site: eurogamer\nNamespace: core"])
+        self.assertGreater(len(unbuffered), len(buffered))
+
+    def test_render_to_streaming_response(self):
+        response = utils.render_to_streaming_response(
+            "site.j2", {'site': 'eurogamer', 'namespace': 'core'}, status=201)
+        self.assertIsInstance(response, StreamingHttpResponse)
+        self.assertEquals(response.status_code, 201)
+        self.assertEquals(b''.join(response.streaming_content), b"Site: eurogamer\nNamespace: core")
+
     def test_render_from_string(self):
         rendered = utils.render_from_string('<p>{{ foo }} {{ bar }}</p>', {
             'foo': 'Dr',
             'bar': 'Eggman'
         })
         self.assertEquals(rendered, '<p>Dr Eggman</p>')
+
+    def test_render_from_string_compiles_once(self):
+        template_string = '<p>{{ foo }} compiled once</p>'
+        with mock.patch.object(utils._string_environment, 'from_string', wraps=utils._string_environment.from_string) as from_string:
+            for i in range(3):
+                self.assertEquals(utils.render_from_string(template_string, {'foo': i}), '<p>%d compiled once</p>' % i)
+            self.assertEquals(from_string.call_count, 1)
+
+    def test_render_many(self):
+        rendered = utils.render_many('<p>{{ foo }}</p>', [{'foo': 'Dr'}, {'foo': 'Eggman'}])
+        self.assertEquals(rendered, ['<p>Dr</p>', '<p>Eggman</p>'])
+
+class TestTemplateProfiler(TestCase):
+    """
+    Tests for template render profiling.
+    """
+
+    def get_template_dir(self, dirname):
+        template_base = os.path.join(BASE_DIR, "test_files", "sparse_templates")
+        return os.path.join(template_base, dirname)
+
+    def get_environment(self, **kwargs):
+        loader = HierarchyLoader(OrderedDict((
+            ("eurogamer_net", FileSystemLoader(self.get_template_dir("eurogamer_net"))),
+            ("eurogamer", FileSystemLoader(self.get_template_dir("eurogamer"))),
+            ("core", FileSystemLoader(self.get_template_dir("core"))),
+        )))
+        return environment(loader=loader, profile=True, **kwargs)
+
+    def test_profile_option(self):
+        self.assertIsInstance(environment(profile=True), ProfilingEnvironment)
+        self.assertNotIsInstance(environment(), ProfilingEnvironment)
+
+    def test_bytecode_cache_not_shared(self):
+        """
+        Test that a profiling backend doesn't write bytecode in to a cache that
+        a regular backend reads.
+        """
+        config = {
+            "APP_DIRS": False,
+            "DIRS": [os.path.join(BASE_DIR, "test_files", "include_with_templates")],
+            "NAME": "djangojinja",
+            "OPTIONS": {
+                'match_extension': None,
+                'bytecode_cache': {
+                    'name': 'default',
+                    'backend': 'gn_django.template.bytecode.DjangoCacheBytecodeCache',
+                    'enabled': True,
+                },
+            },
+        }
+        context = {
+            'obj': mock.Mock(display_text='Text'),
+            'string': 'This is a message',
+            'parent_context': 'Parent context',
+        }
+        profiling_config = dict(config, OPTIONS=dict(config['OPTIONS'], profile=True))
+        profiling = Jinja2(profiling_config)
+        self.assertIsNone(profiling.env.bytecode_cache)
+        caches['default'].clear()
+        try:
+            with profile_templates():
+                profiled = profiling.get_template('include.j2').render(context)
+            regular = Jinja2(config)
+            self.assertIsNotNone(regular.env.bytecode_cache)
+            self.assertEqual(regular.get_template('include.j2').render(context), profiled)
+        finally:
+            caches['default'].clear()
+
+    def test_profiles_are_per_task(self):
+        """
+        Test that concurrent async renders record in to their own profiles.
+        """
+        env = self.get_environment(enable_async=True)
+
+        async def render(template):
+            with profile_templates() as profile:
+                await asyncio.sleep(0)
+                await env.get_template(template).render_async()
+                await asyncio.sleep(0)
+            return profile
+
+        async def render_all():
+            return await asyncio.gather(render('article.j2'), render('base.j2'))
+
+        article, base = asyncio.run(render_all())
+        self.assertEqual([r['template'] for r in article.records if r['event'] == 'render'], ['article.j2'])
+        self.assertEqual([r['template'] for r in base.records if r['event'] == 'render'], ['base.j2'])
+        self.assertIsNone(get_active_profile())
+
+    def test_records_loads_compiles_and_renders(self):
+        env = self.get_environment(auto_reload=False)
+        with profile_templates() as profile:
+            env.get_template('article.j2').render()
+        loads = dict((record['template'], record) for record in profile.records if record['event'] == 'load')
+        self.assertEqual(loads['article.j2']['loader'], 'eurogamer')
+        self.assertEqual(loads['eurogamer_parent:article.j2']['loader'], 'core')
+        self.assertEqual(loads['widgets/comments.j2']['loader'], 'eurogamer_net')
+        self.assertFalse(any(record['hit'] for record in loads.values()))
+        compiles = [record['template'] for record in profile.records if record['event'] == 'compile']
+        self.assertEqual(sorted(compiles), sorted(loads))
+        renders = [record['template'] for record in profile.records if record['event'] == 'render']
+        self.assertEqual(renders, ['article.j2'])
+
+        with profile_templates() as profile:
+            env.get_template('article.j2').render()
+        loads = [record for record in profile.records if record['event'] == 'load']
+        self.assertTrue(all(record['hit'] and record['loader'] is None for record in loads))
+        self.assertFalse([record for record in profile.records if record['event'] == 'compile'])
+
+    def test_records_include_with(self):
+        template_dir = os.path.join(BASE_DIR, "test_files", "include_with_templates")
+        env = environment(loader=FileSystemLoader(template_dir), profile=True,
+                          extensions=['gn_django.template.extensions.IncludeWithExtension'])
+        template = env.from_string("{% include_with 'i3.j2' foo=bar %}")
+        with profile_templates() as profile:
+            self.assertIn('A variable: baz', template.render({'bar': 'baz'}))
+        include_withs = [record for record in profile.records if record['event'] == 'include_with']
+        self.assertEqual(len(include_withs), 1)
+        self.assertEqual(include_withs[0]['template'], 'i3.j2')
+
+        with profile_templates() as profile:
+            self.assertIn('A variable: baz', ''.join(template.stream({'bar': 'baz'})))
+        events = [record['event'] for record in profile.records]
+        self.assertEqual(events.count('include_with'), 1)
+        self.assertEqual(events.count('render'), 1)
+
+    def test_no_records_without_profile(self):
+        env = self.get_environment()
+        env.get_template('article.j2').render()
+        self.assertIsNone(get_active_profile())
+
+    def test_middleware(self):
+        env = self.get_environment()
+
+        def get_response(request):
+            return HttpResponse(env.get_template('base.j2').render())
+
+        with tempfile.TemporaryDirectory() as log_dir:
+            log_path = os.path.join(log_dir, 'profile.log')
+            with self.settings(TEMPLATE_PROFILE_LOG=log_path):
+                middleware = TemplateProfilerMiddleware(get_response)
+                response = middleware(RequestFactory().get('/home'))
+                middleware(RequestFactory().get('/home'))
+            self.assertIn('loads=1; misses=1;', response['X-Template-Profile'])
+            self.assertIsNone(get_active_profile())
+
+            out = StringIO()
+            call_command(template_profile.Command(), input=log_path, json=True, event='load', stdout=out)
+            stats = dict((stat['template'], stat) for stat in json.loads(out.getvalue()))
+            self.assertEqual(sorted(stats), ['base.j2'])
+            self.assertEqual(stats['base.j2']['count'], 2)
+            self.assertEqual(stats['base.j2']['hits'], 1)
+            self.assertEqual(stats['base.j2']['loaders'], {'core': 1})
+
+            out = StringIO()
+            call_command(template_profile.Command(), input=log_path, stdout=out)
+            self.assertIn('base.j2 (core: 1)', out.getvalue())
+
+@override_settings(SITE_NAMESPACES={'eurogamer.net': 'eurogamer_net', 'vg247.com': 'vg247_com'})
+class TestTemplateWarmup(TestCase):
+    """
+    Tests for warming template caches.
+    """
+
+    def get_template_dir(self, dirname):
+        template_base = os.path.join(BASE_DIR, "test_files", "multi_hierarchy_sparse_templates")
+        return os.path.join(template_base, dirname)
+
+    def get_environment(self):
+        hierarchies = {}
+        for name, parent in (('eurogamer_net', 'eurogamer'), ('vg247_com', 'vg247')):
+            hierarchies[name] = HierarchyLoader(OrderedDict(
+                (dirname, FileSystemLoader(self.get_template_dir(dirname))) for dirname in (name, parent, 'core')
+            ))
+        loader = MultiHierarchyLoader('gn_django.site.get_namespace_for_site', hierarchies)
+        env = Environment(
+            loader=loader,
+            template_cache_key_cb='gn_django.site.template.get_template_cache_key_with_site',
+        )
+        env.filters['ordinal'] = lambda value: value
+        return env
+
+    def test_warm_templates(self):
+        env = self.get_environment()
+        report = warm_templates(env, workers=2)
+        self.assertFalse(report.failures)
+        self.assertEqual(report.skipped, 0)
+        self.assertEqual(report.over_capacity, 0)
+        loaded = set((site, template) for site, template, duration in report.loaded)
+        self.assertIn(('eurogamer.net', 'widgets/comments.j2'), loaded)
+        self.assertIn(('vg247.com', 'vg247_com_parent:widgets/comments.j2'), loaded)
+        self.assertIn(('vg247.com', 'core:base.j2'), loaded)
+        self.assertEqual(len(report.get_slowest(3)), 3)
+
+        with mock.patch.object(env.loader, 'load') as load:
+            for site in ('eurogamer.net', 'vg247.com'):
+                try:
+                    set_current_site(site)
+                    env.get_template('widgets/comments.j2')
+                    env.get_template('article.j2')
+                finally:
+                    clear_current_site()
+        self.assertFalse(load.called)
+
+    def test_warm_templates_budget(self):
+        report = warm_templates(self.get_environment(), budget=0)
+        self.assertFalse(report.loaded)
+        self.assertGreater(report.skipped, 0)
+
+    def test_warm_templates_cache_capacity(self):
+        """
+        Test that warming stops when the template cache is full, without
+        evicting templates which were already cached.
+        """
+        env = self.get_environment()
+        env.cache = LRUCache(5)
+        env.cache['cached'] = 'template'
+        with self.assertLogs('gn_django.template.warmup', 'WARNING'):
+            report = warm_templates(env, workers=2)
+        self.assertEqual(len(report.loaded), 4)
+        self.assertGreater(report.over_capacity, 0)
+        self.assertEqual(env.cache['cached'], 'template')
+        for site, template, duration in report.loaded:
+            self.assertNotIn(':', template)
+
+        env = self.get_environment()
+        env.cache = PartitionedTemplateCache(capacity=3)
+        with self.assertLogs('gn_django.template.warmup', 'WARNING'):
+            report = warm_templates(env, workers=2)
+        self.assertEqual(
+            sorted(site for site, template, duration in report.loaded),
+            ['eurogamer.net'] * 3 + ['vg247.com'] * 3
+        )
+        self.assertEqual(sum(stats['evictions'] for stats in env.cache.stats().values()), 0)
+
+    def test_warm_templates_failures(self):
+        env = self.get_environment()
+        with mock.patch.object(env, 'get_template', side_effect=TemplateNotFound('broken.j2')):
+            report = warm_templates(env)
+        self.assertFalse(report.loaded)
+        self.assertTrue(report.failures)
+
+    def test_command(self):
+        env = self.get_environment()
+        out = StringIO()
+        with mock.patch('gn_django.template.warmup.engines') as mock_engines:
+            mock_engines.all.return_value = [mock.Mock(env=env), mock.Mock(env=None)]
+            call_command(warm_templates_command.Command(), workers=2, slowest=2, stdout=out, stderr=StringIO())
+        self.assertIn('for 2 sites', out.getvalue())
+        self.assertIn('Slowest templates:', out.getvalue())
+
+    def test_app_config_ready(self):
+        app_config = GNDjangoConfig('gn_django', gn_django)
+        with mock.patch('gn_django.template.warmup.warm_all_templates') as warm_all_templates:
+            warm_all_templates.return_value = WarmupReport()
+            app_config.ready()
+            self.assertFalse(warm_all_templates.called)
+            with self.settings(TEMPLATE_WARMUP=True, TEMPLATE_WARMUP_BUDGET=5):
+                app_config.ready()
+            warm_all_templates.assert_called_once_with(workers=4, budget=5)
+
+class TestTemplateWatcher(TestCase):
+    """
+    Tests for invalidating template caches when template directories change.
+    """
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.site_dir = os.path.join(self.tmp_dir, 'eurogamer_net')
+        self.core_dir = os.path.join(self.tmp_dir, 'core')
+        os.makedirs(os.path.join(self.site_dir, 'widgets'))
+        os.makedirs(os.path.join(self.core_dir, 'widgets'))
+        self.write_template(self.core_dir, 'widgets/comments.j2', 'core comments')
+        self.write_template(self.core_dir, 'base.j2', 'core base')
+        self.loader = HierarchyLoader(OrderedDict((
+            ('eurogamer_net', FileSystemLoader(self.site_dir)),
+            ('core', FileSystemLoader(self.core_dir)),
+        )))
+        self.env = Environment(loader=self.loader, auto_reload=False)
+        self.watcher = TemplateWatcher(environments=[self.env], directories=[self.site_dir, self.core_dir])
+
+    def tearDown(self):
+        self.watcher.stop()
+        shutil.rmtree(self.tmp_dir)
+
+    def write_template(self, template_dir, template, source):
+        with open(os.path.join(template_dir, *template.split('/')), 'w') as f:
+            f.write(source)
+
+    def render(self, template):
+        return self.env.get_template(template).render()
+
+    def test_edited_template(self):
+        self.assertEquals(self.render('widgets/comments.j2'), 'core comments')
+        self.assertEquals(self.render('base.j2'), 'core base')
+        self.write_template(self.core_dir, 'widgets/comments.j2', 'edited comments')
+        self.assertEquals(self.render('widgets/comments.j2'), 'core comments')
+
+        with mock.patch.object(self.loader, 'forget_template') as forget_template:
+            self.watcher.invalidate_template(self.core_dir, 'widgets/comments.j2')
+        self.assertFalse(forget_template.called)
+        self.assertEquals(self.render('widgets/comments.j2'), 'edited comments')
+        self.assertEquals(len(self.env.cache), 2)
+
+    def test_added_template(self):
+        self.assertEquals(self.render('widgets/comments.j2'), 'core comments')
+        self.assertEquals(self.render('core:widgets/comments.j2'), 'core comments')
+        self.assertEquals(self.render('base.j2'), 'core base')
+        self.write_template(self.site_dir, 'widgets/comments.j2', 'site comments')
+        self.watcher.invalidate_template(self.site_dir, 'widgets/comments.j2', added_or_removed=True)
+
+        self.assertEquals(self.render('widgets/comments.j2'), 'site comments')
+        self.assertEquals(self.render('eurogamer_net:widgets/comments.j2'), 'site comments')
+        # Templates which don't resolve differently are still cached
+        self.assertIn('core:widgets/comments.j2', [key[1] for key in self.env.cache.keys()])
+        self.assertIn('base.j2', [key[1] for key in self.env.cache.keys()])
+        self.assertEquals(self.loader.resolution_cache.get('base.j2'), ('core', 'base.j2'))
+
+    def test_handle_event(self):
+        with mock.patch.object(self.watcher, 'invalidate_template') as invalidate_template, \
+                mock.patch.object(self.watcher, 'invalidate_directory') as invalidate_directory:
+            self.watcher.watches = {1: [(self.core_dir, 'widgets/')]}
+            self.watcher.handle_event(1, IN_CLOSE_WRITE, 'comments.j2')
+            invalidate_template.assert_called_once_with(self.core_dir, 'widgets/comments.j2', False)
+            self.watcher.handle_event(1, IN_CREATE, 'comments.j2')
+            invalidate_template.assert_called_with(self.core_dir, 'widgets/comments.j2', True)
+            self.watcher.handle_event(1, IN_CREATE | IN_ISDIR, 'new')
+            invalidate_directory.assert_called_once_with(self.core_dir)
+
+    @skipUnless(sys.platform.startswith('linux'), "Template watching requires inotify")
+    def test_watch(self):
+        self.assertEquals(self.render('widgets/comments.j2'), 'core comments')
+        self.watcher.start()
+        self.write_template(self.site_dir, 'widgets/comments.j2', 'site comments')
+        deadline = time.time() + 2
+        while self.render('widgets/comments.j2') != 'site comments' and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEquals(self.render('widgets/comments.j2'), 'site comments')
+
+        with self.assertRaises(TemplateNotFound):
+            self.render('new/widget.j2')
+        os.makedirs(os.path.join(self.site_dir, 'new'))
+        deadline = time.time() + 2
+        while len(self.watcher.watches) < 5 and time.time() < deadline:
+            time.sleep(0.01)
+        self.write_template(self.site_dir, 'new/widget.j2', 'new widget')
+        deadline = time.time() + 2
+        while time.time() < deadline:
+            try:
+                self.render('new/widget.j2')
+                break
+            except TemplateNotFound:
+                time.sleep(0.01)
+        self.assertEquals(self.render('new/widget.j2'), 'new widget')
+
+    def test_app_config_ready(self):
+        app_config = GNDjangoConfig('gn_django', gn_django)
+        with mock.patch('gn_django.template.watcher.TemplateWatcher.start') as start:
+            app_config.ready()
+            self.assertFalse(start.called)
+            with self.settings(TEMPLATE_WATCHER=True):
+                app_config.ready()
+            start.assert_called_once_with()